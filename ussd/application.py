@@ -0,0 +1,154 @@
+"""
+Long lived entry point for serving ussd requests.
+
+.. code-block:: python
+
+    from ussd.application import UssdApplication
+
+    # once per worker
+    application = UssdApplication(
+        journey_name="sample_journey",
+        journey_store=YamlJourneyStore("./journeys"),
+        session_store_backend=ShardedFilesystemStore("./session_data")
+    )
+
+    # per request
+    response = application.dispatch(session_id, phone_number, ussd_input)
+
+Creating a :class:`~ussd.core.UssdRequest` and
+:class:`~ussd.core.UssdEngine` by hand still works, the application just
+builds the parts that are the same for every request once.
+
+Only one application per process is supported. The template environment,
+the template cache and the compiled journeys are process wide, an
+application configuring the environment changes it for every other
+application and request of the process.
+"""
+import threading
+import time
+
+from simplekv import KeyValueStore
+from simplekv.fs import FilesystemStore
+from structlog import get_logger
+
+from ussd.core import UssdRequest, UssdEngine, UssdResponse, \
+    CompiledJourney, configure_environment, template_cache
+from ussd.session_store import compression_stats
+from ussd.store.journey_store import JourneyStore
+from ussd.store.journey_store.YamlJourneyStore import YamlJourneyStore
+
+
+class UssdApplication(object):
+    """
+    Owns the journey store, session store backend and logger shared by
+    every request of a worker and keeps request metrics.
+
+    ``environment_allow_list`` and ``environment_prefixes`` configure the
+    environment variables templates can see, see
+    :func:`ussd.core.configure_environment`. That setting, like the caches
+    reported by :meth:`stats`, belongs to the process, not the
+    application. Any other keyword argument is passed to every
+    :class:`~ussd.core.UssdRequest`.
+    """
+
+    def __init__(self, journey_name: str,
+                 journey_store: JourneyStore = None,
+                 journey_version=None,
+                 session_store_backend: KeyValueStore = None,
+                 default_language=None,
+                 use_built_in_session_management=False,
+                 expiry=180,
+                 environment_allow_list=None,
+                 environment_prefixes=None,
+                 **request_kwargs):
+        self.journey_name = journey_name
+        self.journey_store = journey_store or \
+            YamlJourneyStore("./ussd/tests/sample_screen_definition")
+        self.journey_version = journey_version
+        self.session_store_backend = session_store_backend or \
+            FilesystemStore("./session_data")
+        self.default_language = default_language or 'en'
+        self.use_built_in_session_management = \
+            use_built_in_session_management
+        self.expiry = expiry
+        self.request_kwargs = request_kwargs
+        self.logger = get_logger(__name__).bind(journey_name=journey_name)
+
+        if environment_allow_list is not None or \
+                environment_prefixes is not None:
+            # process wide, see the module docstring
+            configure_environment(environment_allow_list,
+                                  environment_prefixes)
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+
+    def warm_up(self, journey_version=None):
+        """
+        Loads and compiles the journey so the first request doesn't pay
+        for it.
+        """
+        version = journey_version or self.journey_version or \
+            self.journey_store.get_latest_version(self.journey_name)
+        return CompiledJourney.get(self.journey_store, self.journey_name,
+                                   version)
+
+    def dispatch(self, session_id, phone_number, ussd_input,
+                 language=None, **kwargs) -> UssdResponse:
+        """
+        Handles one request, ``kwargs`` override the request arguments
+        given to the application.
+        """
+        start = time.perf_counter()
+        try:
+            request_kwargs = dict(self.request_kwargs, **kwargs)
+            request_kwargs.setdefault('journey_version', self.journey_version)
+            request_kwargs.setdefault('expiry', self.expiry)
+            request_kwargs.setdefault('default_language',
+                                      self.default_language)
+            request_kwargs.setdefault(
+                'use_built_in_session_management',
+                self.use_built_in_session_management)
+            ussd_request = UssdRequest(
+                session_id, phone_number, ussd_input,
+                language or self.default_language,
+                self.journey_name,
+                journey_store=self.journey_store,
+                session_store_backend=self.session_store_backend,
+                **request_kwargs
+            )
+            logger = self.logger.bind(session_id=ussd_request.session_id,
+                                      phone_number=ussd_request.phone_number)
+            response = UssdEngine(ussd_request, logger=logger) \
+                .ussd_dispatcher()
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.requests += 1
+                self.total_seconds += elapsed
+        return response
+
+    def stats(self) -> dict:
+        """
+        Request counts and timings along with the caches' stats.
+        """
+        with self._lock:
+            requests = self.requests
+            stats = dict(
+                requests=requests,
+                errors=self.errors,
+                average_seconds=self.total_seconds / requests
+                if requests else None
+            )
+        stats.update(
+            template_cache=template_cache.stats(),
+            compiled_journey_cache=CompiledJourney._cache.stats(),
+            session_compression=compression_stats.stats()
+        )
+        return stats
@@ -5,19 +5,24 @@ import inspect
 import json
 import os
 import re
+import time
 import typing
-from collections import namedtuple
+from collections import namedtuple, ChainMap
 from copy import copy
 from datetime import datetime
+from types import MappingProxyType
 from urllib.parse import unquote
 
 import requests
-from jinja2 import Environment
+from jinja2 import Environment, Undefined
 from structlog import get_logger
 
 from ussd import defaults as ussd_airflow_variables
 from ussd import utilities
+from ussd.utils.cache import LRUCache
 from ussd.tasks import report_session
+from ussd import interaction_log
+from ussd import session_lock
 from .graph import Graph, Link, Vertex, convert_graph_to_mermaid_text
 from ussd.screens.schema import UssdBaseScreenSchema
 from ussd.store.journey_store import JourneyStore
@@ -25,6 +30,9 @@ from ussd.store.journey_store.YamlJourneyStore import YamlJourneyStore
 from simplekv import KeyValueStore
 from simplekv.fs import FilesystemStore
 from ussd.session_store import SessionStore
+from ussd.utils.module_loading import import_string
+from ussd.utils.functional import cached_property
+from ussd.utils import gsm
 from marshmallow.schema import SchemaMeta
 
 _registered_ussd_handlers = {}
@@ -37,6 +45,173 @@ env = Environment(keep_trailing_newline=True)
 env.filters.update(_registered_filters)
 
 
+class TemplateCache(LRUCache):
+    """
+    Cache of compiled jinja templates.
+
+    Journey text and expressions are the same for every session, so
+    compiling them on each evaluation is wasted work. Entries are keyed by
+    the template source and the mode it was compiled in, either
+    :attr:`EXPRESSION` (``env.compile_expression``) or :attr:`TEMPLATE`
+    (``env.from_string``).
+
+    Sources that fail to compile are cached as well so that a broken
+    expression does not get re-parsed on every request, the original error
+    is raised on every lookup.
+    """
+    EXPRESSION = 'expression'
+    TEMPLATE = 'template'
+
+    def __init__(self, maxsize=ussd_airflow_variables.template_cache_size,
+                 environment=None):
+        super(TemplateCache, self).__init__(maxsize)
+        self.environment = environment or env
+
+    def compile(self, source, mode=TEMPLATE):
+        key = (mode, source)
+        entry = self.get(key)
+        if entry is None:
+            # compile outside the lock, worst case two threads compile the
+            # same source and the last one wins.
+            entry = self._compile(source, mode)
+            self.set(key, entry)
+
+        if isinstance(entry, _FailedCompilation):
+            raise entry.error.with_traceback(None)
+        return entry
+
+    def get_template(self, source):
+        return self.compile(source, self.TEMPLATE)
+
+    def get_expression(self, source):
+        return self.compile(source, self.EXPRESSION)
+
+    def _compile(self, source, mode):
+        try:
+            if mode == self.EXPRESSION:
+                return self.environment.compile_expression(source)
+            return self.environment.from_string(source)
+        except Exception as e:
+            return _FailedCompilation(e)
+
+
+class _FailedCompilation(object):
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+
+template_cache = TemplateCache()
+
+
+_environment_filter = dict(
+    allow_list=ussd_airflow_variables.template_environment_allow_list,
+    prefixes=ussd_airflow_variables.template_environment_prefixes
+)
+_environment = MappingProxyType({})
+
+
+def _split_names(names) -> tuple:
+    if isinstance(names, str):
+        names = names.split(',')
+    return tuple(i.strip() for i in names or () if i.strip())
+
+
+def refresh_environment() -> typing.Mapping:
+    """
+    Rebuild the snapshot of os environment variables templates can see.
+
+    The snapshot is taken once when ussd.core is imported, call this if
+    you change the environment after that.
+    """
+    global _environment
+    allow_list = _split_names(_environment_filter['allow_list'])
+    prefixes = _split_names(_environment_filter['prefixes'])
+
+    if allow_list or prefixes:
+        variables = {
+            key: value for key, value in os.environ.items()
+            if key in allow_list or key.startswith(prefixes)
+        }
+    else:
+        variables = dict(os.environ)
+    _environment = MappingProxyType(variables)
+    return _environment
+
+
+def configure_environment(allow_list=None, prefixes=None) -> typing.Mapping:
+    """
+    Only expose the environment variables named in ``allow_list`` or
+    starting with one of ``prefixes`` (e.g ``USSD_``) to templates.
+
+    Both accept a list or a comma separated string, when both are empty
+    every environment variable is exposed.
+    """
+    _environment_filter.update(allow_list=allow_list, prefixes=prefixes)
+    return refresh_environment()
+
+
+def get_environment() -> typing.Mapping:
+    return _environment
+
+
+refresh_environment()
+
+
+class RenderContext(ChainMap):
+    """
+    Layered view of everything a template can reference.
+
+    Layers are looked up in order without being copied into a new dict,
+    the first layer is a per call dict so writes never reach the session
+    or the process wide layers underneath it.
+    """
+
+    def new_child(self, m=None):
+        # keep the per call layer on top so writes don't land in ``m``
+        return self.__class__({}, *([m or {}] + self.maps))
+
+
+def _render_template(template, context):
+    """
+    Render a template without jinja copying the context into a new dict.
+
+    Sharing the context goes through ``Template.root_render_func``, which
+    isn't public api. It is the same in the jinja versions allowed by
+    default.txt, templates without it are rendered with ``Template.render``.
+    """
+    render_func = getattr(template, 'root_render_func', None)
+    if render_func is None or not isinstance(context, RenderContext):
+        return template.render(context)
+    jinja_context = template.new_context(context, shared=True)
+    try:
+        return ''.join(render_func(jinja_context))
+    except Exception:
+        # like Template.render, reraises with the template in the traceback
+        template.environment.handle_exception()
+
+
+def _evaluate_expression(expression, context):
+    """
+    Same as calling the compiled expression but shares the context
+    instead of copying it, falls back to calling it like
+    :func:`_render_template` does.
+    """
+    template = getattr(expression, '_template', None)
+    render_func = getattr(template, 'root_render_func', None)
+    if render_func is None or not isinstance(context, RenderContext):
+        return expression(context)
+    jinja_context = template.new_context(context, shared=True)
+    for _ in render_func(jinja_context):
+        pass
+    results = jinja_context.vars['result']
+    if getattr(expression, '_undefined_to_none', True) and \
+            isinstance(results, Undefined):
+        return None
+    return results
+
+
 class MissingAttribute(Exception):
     pass
 
@@ -52,11 +227,18 @@ class DuplicateSessionId(Exception):
 def register_filter(func_name, *args, **kwargs):
     filter_name = func_name.__name__
     _registered_filters[filter_name] = func_name
+    # filters are resolved when a template is compiled
+    template_cache.clear()
 
 
 def register_function(func_name, *args, **kwargs):
     function_name = func_name.__name__
     _built_in_functions[function_name] = func_name
+    template_cache.clear()
+
+
+SINGLE_VAR_RE = re.compile(r"^{{\s*(\w*)\s*}}$")
+CLEAN_VAR_RE = re.compile(r'^{{\s*(\S*)\s*}}$')
 
 
 class UssdRequest(object):
@@ -117,7 +299,8 @@ class UssdRequest(object):
         then the session_id should be None and expiry can't be None. 
         :param expiry: Its only used if use_built_in_session_management has
         been enabled. 
-        :param kwargs: All other extra arguments
+        :param kwargs: All other extra arguments, e.g request_id, the
+        gateway's id of the request, retries of a request have the same one.
         """
 
         self.expiry = expiry
@@ -154,8 +337,8 @@ class UssdRequest(object):
         # session store config
         self.use_built_in_session_management = use_built_in_session_management
         self.session_store_backend = session_store_backend
-        self.session = self.get_session()
-        self.session.set_expiry(self.expiry)
+        # read when first used, UssdEngine takes the session lock first
+        self._session = None
 
         # journey config
         if journey_store is None:
@@ -172,6 +355,17 @@ class UssdRequest(object):
             if not hasattr(self, key):
                 setattr(self, key, value)
 
+    @property
+    def session(self) -> SessionStore:
+        if self._session is None:
+            self._session = self.get_session()
+            self._session.set_expiry(self.expiry)
+        return self._session
+
+    @session.setter
+    def session(self, session: SessionStore):
+        self._session = session
+
     def forward(self, handler_name):
         """
         Forwards a copy of the current request to a new
@@ -187,10 +381,23 @@ class UssdRequest(object):
         all_variables = copy(self.__dict__)
 
         # delete session if it exist
-        all_variables.pop("session", None)
+        all_variables.pop("_session", None)
+        # and the journey loaded for this request
+        all_variables.pop("_journey", None)
 
         return all_variables
 
+    def session_variables(self):
+        """
+        Request variables kept in the session. The stores are left out, they
+        would only be saved as their class names and never compare equal to
+        what is loaded back, making every request write the session.
+        """
+        session_variables = self.all_variables()
+        session_variables.pop("journey_store", None)
+        session_variables.pop("session_store_backend", None)
+        return session_variables
+
     def built_in_session_management(self):
         if self.session_id is None:
             raise TypeError("Session id should not be null")
@@ -206,8 +413,10 @@ class UssdRequest(object):
         return session
 
     def get_session_from_store(self) -> SessionStore:
-        return SessionStore(session_key=self.session_id,
-                            kv_store=self.session_store_backend)
+        session_store_class = import_string(
+            ussd_airflow_variables.session_store_class)
+        return session_store_class(session_key=self.session_id,
+                                   kv_store=self.session_store_backend)
 
     def get_session(self) -> SessionStore:
         if self.use_built_in_session_management:
@@ -215,11 +424,26 @@ class UssdRequest(object):
         return self.get_session_from_store()
 
     def get_screens(self, screen_name=None):
-        return self.journey_store.get(
-            self.journey_name,
-            self.journey_version,
-            screen_name
-        )
+        """
+        Returns the journey or one of its screens. They are served from the
+        journey loaded for this request, so a request reads the journey
+        from the journey store at most once however many screens it goes
+        through.
+        """
+        journey = self.get_journey().journey
+        if screen_name is None:
+            return journey
+        return journey.get(screen_name)
+
+    def get_journey(self) -> 'CompiledJourney':
+        # forwarded requests are copies and share the loaded journey
+        if getattr(self, '_journey', None) is None:
+            self._journey = CompiledJourney.get(
+                self.journey_store,
+                self.journey_name,
+                self.journey_version
+            )
+        return self._journey
 
 
 class UssdResponse(object):
@@ -277,42 +501,74 @@ class UssdHandlerMetaClass(type):
 
 
 class UssdHandlerAbstract(object, metaclass=UssdHandlerMetaClass):
+    """
+    Handlers are created for every hop. The parts that only depend on the
+    journey are built once per compiled screen by :meth:`build_prototype`
+    and shared, the rest is computed when it's first used.
+    """
     abstract = True
 
+    SINGLE_VAR = SINGLE_VAR_RE
+    clean_regex = CLEAN_VAR_RE
+
     def __init__(self, ussd_request: UssdRequest,
                  handler: str, screen_content: dict,
                  initial_screen: dict, logger=None,
-                 raw_text=False):
+                 raw_text=False, compiled_screen=None):
         self.ussd_request = ussd_request
         self.handler = handler
         self.screen_content = screen_content
         self.raw_text = raw_text
+        self.compiled_screen = compiled_screen
+        if logger is not None:
+            self.logger = logger
+        self.initial_screen = initial_screen
+
+        self.prototype = compiled_screen.prototype \
+            if compiled_screen is not None else \
+            self.build_prototype(screen_content, initial_screen)
+        self.pagination_config = self.prototype['pagination_config']
+        self.ussd_text_limit = self.prototype['ussd_text_limit']
+
+    @classmethod
+    def build_prototype(cls, screen_content, initial_screen) -> dict:
+        """
+        Returns the parts of the handler that are the same for every
+        session. Subclasses add their own to the dict.
+        """
+        pagination_config = initial_screen.get('pagination_config', {})
+        return dict(
+            pagination_config=pagination_config,
+            ussd_text_limit=pagination_config.get(
+                "ussd_text_limit", ussd_airflow_variables.ussd_text_limit),
+            ussd_text_encoding=pagination_config.get(
+                "ussd_text_encoding",
+                ussd_airflow_variables.ussd_text_encoding)
+        )
 
-        self.SINGLE_VAR = re.compile(r"^%s\s*(\w*)\s*%s$" % (
-            '{{', '}}'))
-        self.clean_regex = re.compile(r'^{{\s*(\S*)\s*}}$')
-        self.logger = logger or get_logger(__name__).bind(
+    @cached_property
+    def logger(self):
+        return get_logger(__name__).bind(
             handler=self.handler,
             screen_type=getattr(self, 'screen_type', 'custom_screen'),
-            **self.ussd_request.all_variables(),
+            **self.ussd_request.all_variables()
         )
-        self.initial_screen = initial_screen
-
-        self.pagination_config = self.initial_screen.get('pagination_config',
-                                                         {})
 
-        self.pagination_more_option = self._add_end_line(
+    @cached_property
+    def pagination_more_option(self):
+        return self._add_end_line(
             self.get_text(
                 self.pagination_config.get('more_option', "more\n")
             )
         )
-        self.pagination_back_option = self._add_end_line(
+
+    @cached_property
+    def pagination_back_option(self):
+        return self._add_end_line(
             self.get_text(
                 self.pagination_config.get('back_option', "back\n")
             )
         )
-        self.ussd_text_limit = self.pagination_config. \
-            get("ussd_text_limit", ussd_airflow_variables.ussd_text_limit)
 
     def handle(self):
         if not self.ussd_request.input:
@@ -324,6 +580,12 @@ class UssdHandlerAbstract(object, metaclass=UssdHandlerMetaClass):
     def get_text_limit(self):
         return self.ussd_text_limit
 
+    def text_length(self, text):
+        """
+        Length of the text to compare with :meth:`get_text_limit`
+        """
+        return gsm.text_length(text, self.prototype['ussd_text_encoding'])
+
     def show_ussd_content(self, **kwargs):
         raise NotImplementedError
 
@@ -335,16 +597,19 @@ class UssdHandlerAbstract(object, metaclass=UssdHandlerMetaClass):
         iterates all the options executing expression comand.
         """
         if route_options is None:
-            route_options = self.screen_content["next_screen"]
+            route_options = self.compiled_screen.next_screen \
+                if self.compiled_screen is not None \
+                else self.screen_content["next_screen"]
 
         if isinstance(route_options, str):
             return self.ussd_request.forward(route_options)
 
+        route_options = CompiledScreen.normalise_routes(route_options)
+
         loop_items = [0]
         if self.screen_content.get("with_items"):
-            loop_items = self.evaluate_jija_expression(
-                self.screen_content["with_items"],
-                session=self.ussd_request.session
+            loop_items = self.evaluate_compiled_expression(
+                self.screen_content["with_items"]
             ) or loop_items
 
         for item in loop_items:
@@ -360,43 +625,38 @@ class UssdHandlerAbstract(object, metaclass=UssdHandlerMetaClass):
                     )
                 )
 
-            for option in route_options:
-                if self.evaluate_jija_expression(
-                        option.get('expression') or option['condition'],
-                        session=self.ussd_request.session,
+            for expression, next_screen in route_options:
+                if self.evaluate_compiled_expression(
+                        expression,
                         extra_context=extra_context
                 ):
-                    return self.ussd_request.forward(option['next_screen'])
+                    return self.ussd_request.forward(next_screen)
         return self.ussd_request.forward(
             self.screen_content['default_next_screen']
         )
 
     @staticmethod
-    def get_session_items(session) -> dict:
-        return dict(iter(session.items()))
+    def get_session_items(session) -> typing.Mapping:
+        if isinstance(session, SessionStore):
+            return session.mapping()
+        return session
 
     @classmethod
-    def get_context(cls, session, extra_context=None):
-        context = cls.get_session_items(session)
-
-        context.update(
-            dict(os.environ)
+    def get_context(cls, session, extra_context=None) -> RenderContext:
+        # Lookup precedence from the highest: built in functions, now,
+        # extra context, os environment snapshot and lastly the session.
+        # jinja globals are at the bottom since the context is shared with
+        # the template instead of being merged with them.
+        return RenderContext(
+            {},
+            _built_in_functions,
+            dict(now=datetime.now()),
+            extra_context or {},
+            _environment,
+            cls.get_session_items(session),
+            env.globals
         )
 
-        if extra_context is not None:
-            context.update(extra_context)
-
-        # add timestamp in the context
-        context.update(
-            dict(now=datetime.now())
-        )
-
-        # add all built in functions
-        context.update(
-            _built_in_functions
-        )
-        return context
-
     @staticmethod
     def render_text(session, text, context=None, extra=None, encode=None):
         if context is None:
@@ -405,10 +665,13 @@ class UssdHandlerAbstract(object, metaclass=UssdHandlerMetaClass):
             )
 
         if extra:
-            context.update(extra)
+            if isinstance(context, RenderContext):
+                context = context.new_child(extra)
+            else:
+                context.update(extra)
 
-        template = env.from_string(text or '')
-        text = template.render(context)
+        template = template_cache.get_template(text or '')
+        text = _render_template(template, context)
         return json.dumps(text) if encode is 'json' else text
 
     def get_text(self, text_context=None):
@@ -425,11 +688,51 @@ class UssdHandlerAbstract(object, metaclass=UssdHandlerMetaClass):
 
         if self.raw_text:
             return text_context
+
+        journey = self.compiled_screen.journey \
+            if self.compiled_screen is not None else None
+        if journey is not None and isinstance(text_context, str) and \
+                text_context in journey.templates:
+            template = journey.templates[text_context]
+            if template is None:
+                return text_context
+            return _render_template(
+                template, self.get_context(self.ussd_request.session))
+
         return self.render_text(
             self.ussd_request.session,
             text_context
         )
 
+    def evaluate_compiled_expression(self, expression, extra_context=None,
+                                     default=None):
+        """
+        Same as :meth:`evaluate_jija_expression` with the session of this
+        request, but uses the expression compiled with the journey.
+        Expressions that fail when they are evaluated are logged and give
+        ``default``, they aren't evaluated a second time.
+        """
+        journey = self.compiled_screen.journey \
+            if self.compiled_screen is not None else None
+        if journey is not None and isinstance(expression, str) and \
+                expression in journey.expressions:
+            try:
+                return _evaluate_expression(
+                    journey.expressions[expression],
+                    self.get_context(self.ussd_request.session,
+                                     extra_context=extra_context)
+                )
+            except Exception:
+                self.logger.warning("expression_failed",
+                                    expression=expression, exc_info=True)
+                return default
+        return self.evaluate_jija_expression(
+            expression,
+            session=self.ussd_request.session,
+            extra_context=extra_context,
+            default=default
+        )
+
     @classmethod
     def evaluate_jija_expression(cls, expression, session,
                                  extra_context=None,
@@ -444,13 +747,14 @@ class UssdHandlerAbstract(object, metaclass=UssdHandlerMetaClass):
             session, extra_context=extra_context)
 
         try:
-            expr = env.compile_expression(
+            expr = template_cache.get_expression(
                 expression.replace("{{", "").replace("}}", "")
             )
-            return expr(context)
+            return _evaluate_expression(expr, context)
         except Exception:
             try:
-                return env.from_string(expression or '').render(context)
+                return _render_template(
+                    template_cache.get_template(expression or ''), context)
             except Exception:
                 return default
 
@@ -486,16 +790,17 @@ class UssdHandlerAbstract(object, metaclass=UssdHandlerMetaClass):
         return loop_items
 
     @classmethod
-    def render_request_conf(cls, session, data):
+    def render_request_conf(cls, session, data, extra_context=None):
         if isinstance(data, str):
-            jinja_results = cls.evaluate_jija_expression(data, session)
+            jinja_results = cls.evaluate_jija_expression(
+                data, session, extra_context=extra_context)
             return data if jinja_results is None else jinja_results
 
         elif isinstance(data, list):
             list_data = []
             for i in data:
                 list_data.append(cls.render_request_conf(
-                    session, i))
+                    session, i, extra_context))
 
             return list_data
 
@@ -504,7 +809,7 @@ class UssdHandlerAbstract(object, metaclass=UssdHandlerMetaClass):
             for key, value in data.items():
                 dict_data.update(
                     {key: cls.render_request_conf(
-                        session, value)}
+                        session, value, extra_context)}
                 )
             return dict_data
         else:
@@ -611,25 +916,217 @@ class UssdHandlerAbstract(object, metaclass=UssdHandlerMetaClass):
                         render_graph(ussd_journey, graph)
 
 
+class CompiledScreen(object):
+    """
+    The parts of a screen that are the same for every session. The handler
+    class is resolved and routing options are normalised to
+    ``(expression, next_screen)`` pairs once when the journey is compiled.
+    """
+
+    def __init__(self, name: str, content, journey: 'CompiledJourney'):
+        self.name = name
+        self.content = content
+        self.journey = journey
+
+        if name == "initial_screen" and isinstance(content, str):
+            self.screen_type = "initial_screen"
+            self.next_screen = content
+        else:
+            self.screen_type = content.get('type')
+            try:
+                self.next_screen = self.normalise_routes(
+                    content.get('next_screen'))
+            except (KeyError, TypeError, AttributeError):
+                # not a routing list, let the handler deal with it
+                self.next_screen = content.get('next_screen')
+
+        # unknown screen types fail when the screen is used, like they
+        # used to, instead of failing the whole journey.
+        self.handler = _registered_ussd_handlers.get(self.screen_type)
+
+        # pages of screens that don't depend on the session, keyed by
+        # whatever else they depend on, e.g language.
+        self.layouts = {}
+
+    @cached_property
+    def prototype(self) -> dict:
+        """
+        Static parts of the screen's handler, built the first time the
+        screen is used.
+        """
+        if self.handler is None:
+            return {}
+        return self.handler.build_prototype(self.content,
+                                            self.journey.initial_screen)
+
+    @staticmethod
+    def normalise_routes(route_options):
+        if route_options is None or isinstance(route_options, str):
+            return route_options
+        return tuple(
+            option if isinstance(option, tuple) else
+            (option.get('expression') or option['condition'],
+             option['next_screen'])
+            for option in route_options
+        )
+
+    def get_handler(self, ussd_request: UssdRequest, initial_screen: dict,
+                    **kwargs) -> UssdHandlerAbstract:
+        if self.handler is None:
+            raise KeyError(self.screen_type)
+        return self.handler(ussd_request, self.name, self.content,
+                            initial_screen=initial_screen,
+                            compiled_screen=self, **kwargs)
+
+
+class CompiledJourney(object):
+    """
+    A journey with every screen and template parsed once.
+
+    Texts are compiled into jinja templates, texts without any template
+    markers are flagged as static so they are returned as they are.
+    Routing conditions and ``with_items`` are compiled into jinja
+    expressions. This leaves only the session dependent rendering to be
+    done on each request.
+
+    Compiled journeys are cached per journey store, name and version.
+    Journeys without a version or in edit mode can change so they are
+    compiled on every request.
+    """
+    text_keys = ('text', 'error_message', 'more_option', 'back_option')
+    expression_keys = ('expression', 'condition', 'with_items')
+
+    _cache = LRUCache(ussd_airflow_variables.compiled_journey_cache_size)
+
+    def __init__(self, journey: dict, name=None, version=None):
+        self.journey = journey
+        self.name = name
+        self.version = version
+        self.templates = {}
+        self.expressions = {}
+
+        self.initial_screen = UssdEngine.get_initial_screen(journey)
+
+        self.screens = {}
+        for screen_name, screen_content in journey.items():
+            if isinstance(screen_content, dict) or \
+                    screen_name == "initial_screen":
+                self.screens[screen_name] = CompiledScreen(
+                    screen_name, screen_content, self)
+            self._compile(screen_content)
+
+    def get_screen(self, screen_name: str) -> CompiledScreen:
+        return self.screens[screen_name]
+
+    def is_static(self, text) -> bool:
+        return isinstance(text, str) and text in self.templates and \
+            self.templates[text] is None
+
+    def _compile(self, content, key=None):
+        if isinstance(content, dict):
+            for key_, value in content.items():
+                # texts can be translated, {"en": "...", "sw": "..."}
+                self._compile(value, key if key in self.text_keys else key_)
+        elif isinstance(content, list):
+            for i in content:
+                self._compile(i, key)
+        elif isinstance(content, str):
+            if key in self.text_keys:
+                self._compile_text(content)
+            elif key in self.expression_keys:
+                self._compile_expression(content)
+
+    def _compile_text(self, text):
+        # jinja normalises line endings, only texts that render to
+        # themselves are static.
+        if not UssdHandlerAbstract._contains_vars(text) and \
+                '\r' not in text:
+            self.templates[text] = None
+            return
+        try:
+            self.templates[text] = template_cache.get_template(text)
+        except Exception:
+            # leave it to the handler to report when it's rendered
+            pass
+
+    def _compile_expression(self, expression):
+        try:
+            self.expressions[expression] = template_cache.get_expression(
+                expression.replace("{{", "").replace("}}", "")
+            )
+        except Exception:
+            pass
+
+    @classmethod
+    def get(cls, journey_store: JourneyStore, name: str,
+            version=None) -> 'CompiledJourney':
+        cacheable = version is not None and \
+            version != journey_store.edit_mode_version
+        key = (journey_store.cache_key, name, version)
+
+        compiled_journey = cls._cache.get(key) if cacheable else None
+        if compiled_journey is None:
+            compiled_journey = cls(journey_store.get(name, version),
+                                   name, version)
+            if cacheable:
+                cls._cache.set(key, compiled_journey)
+        return compiled_journey
+
+    @classmethod
+    def invalidate(cls, journey_store: JourneyStore, name: str, version=None):
+        for key in cls._cache.keys():
+            if key[0] == journey_store.cache_key and key[1] == name and \
+                    (version is None or key[2] == version):
+                cls._cache.pop(key)
+
+
 NextScreens = namedtuple("NextScreens", "next_screens links")
 
 
 class UssdEngine(object):
 
-    def __init__(self, ussd_request: UssdRequest):
+    def __init__(self, ussd_request: UssdRequest, logger=None):
         self.ussd_request = ussd_request
-        initial_screen = ussd_request.get_screens('initial_screen')
-        self.initial_screen = initial_screen \
-            if isinstance(initial_screen, dict) \
-            else {"initial_screen": initial_screen}
-        self.logger = get_logger(__name__).bind(**ussd_request.all_variables())
+        self.logger = logger or \
+            get_logger(__name__).bind(**ussd_request.all_variables())
+
+    @cached_property
+    def journey(self) -> CompiledJourney:
+        # the journey version can be pinned in the session, which is only
+        # read once the session lock is held
+        self.pin_journey_version()
+        return self.ussd_request.get_journey()
+
+    @property
+    def initial_screen(self) -> dict:
+        return self.journey.initial_screen
 
     def ussd_dispatcher(self):
+        lock = session_lock.get_session_lock()
+        if lock is None:
+            return self.dispatch()
+
+        with lock.lock(self.ussd_request.session_id):
+            # the session is read for the first time with the lock held
+            return self.dispatch()
+
+    def dispatch(self):
+        replay = self.get_replay()
+        if replay is not None:
+            self.logger.debug('gateway_retry', text=replay.dumps())
+            return replay
+        request_input = self.ussd_request.input
+        hop = self.ussd_request.session.get('_ussd_state', {}).get(
+            'interaction_count',
+            len(self.ussd_request.session.get('ussd_interaction', [])))
 
         # Clear input and initialize session if we are starting up
         if '_ussd_state' not in self.ussd_request.session:
             self.ussd_request.input = ''
-            self.ussd_request.session['_ussd_state'] = {'next_screen': ''}
+            self.ussd_request.session['_ussd_state'] = {
+                'next_screen': '',
+                'journey_version': self.ussd_request.journey_version
+            }
             self.ussd_request.session['ussd_interaction'] = []
             self.ussd_request.session['posted'] = False
             self.ussd_request.session['submit_data'] = {}
@@ -638,13 +1135,14 @@ class UssdEngine(object):
 
         # update self.ussd_request variable to session and template variables
         # to be used later for jinja2 evaluation
-        self.ussd_request.session.update(self.ussd_request.all_variables())
+        self.ussd_request.session.update(
+            self.ussd_request.session_variables())
 
         # for backward compatibility
         # there are some jinja template using ussd_request
         # eg. {{ussd_request.session_id}}
         self.ussd_request.session.update(
-            {"ussd_request": self.ussd_request.all_variables()}
+            {"ussd_request": self.ussd_request.session_variables()}
         )
 
         self.logger.debug('gateway_request', text=self.ussd_request.input)
@@ -652,6 +1150,16 @@ class UssdEngine(object):
         # Invoke handlers
         ussd_response = self.run_handlers()
 
+        if ussd_airflow_variables.session_replay_ttl:
+            self.ussd_request.session['_ussd_state']['last_response'] = dict(
+                input=request_input,
+                request_id=getattr(self.ussd_request, 'request_id', None),
+                hop=hop,
+                text=ussd_response.text,
+                status=ussd_response.status,
+                time=time.time()
+            )
+
         # Save session
         self.ussd_request.session.save()
         self.logger.debug('gateway_response', text=ussd_response.dumps(),
@@ -659,6 +1167,57 @@ class UssdEngine(object):
 
         return ussd_response
 
+    def get_replay(self) -> UssdResponse:
+        """
+        Returns the previous response if this request is a gateway retry
+        of it, it came within ``session_replay_ttl`` seconds and no other
+        request was handled since.
+
+        Requests with a ``request_id`` are retries if the previous one had
+        the same id. Without one the input is all there is to go by, a
+        user sending the same input again looks like a retry.
+        """
+        replay_ttl = ussd_airflow_variables.session_replay_ttl
+        ussd_state = self.ussd_request.session.get('_ussd_state')
+        last_response = ussd_state.get('last_response') \
+            if replay_ttl and ussd_state else None
+        if not last_response or \
+                last_response['hop'] + 1 != \
+                ussd_state.get('interaction_count') or \
+                time.time() - last_response['time'] > replay_ttl:
+            return None
+        request_id = getattr(self.ussd_request, 'request_id', None)
+        if request_id is not None or \
+                last_response.get('request_id') is not None:
+            is_retry = last_response.get('request_id') == request_id
+        else:
+            is_retry = last_response['input'] == self.ussd_request.input
+        if not is_retry:
+            return None
+        return UssdResponse(last_response['text'], last_response['status'],
+                            self.ussd_request.session)
+
+    def pin_journey_version(self):
+        """
+        When no journey version is requested the latest version is resolved
+        once, when the session starts, and kept in the session. The rest of
+        the session uses that version even if a new one is saved meanwhile.
+        """
+        if self.ussd_request.journey_version is not None:
+            return
+
+        ussd_state = self.ussd_request.session.get('_ussd_state')
+        version = ussd_state.get('journey_version') if ussd_state else None
+
+        if version is None:
+            version = self.ussd_request.journey_store.get_latest_version(
+                self.ussd_request.journey_name)
+            if ussd_state is not None and version is not None:
+                # session started before versions were pinned
+                ussd_state['journey_version'] = version
+
+        self.ussd_request.journey_version = version
+
     def run_handlers(self):
 
         handler = self.ussd_request.session['_ussd_state']['next_screen'] \
@@ -667,44 +1226,42 @@ class UssdEngine(object):
 
         ussd_response = (self.ussd_request, handler)
 
+        interactions = self.ussd_request.session["ussd_interaction"]
+        ussd_state = self.ussd_request.session['_ussd_state']
+        interaction_count = ussd_state.get('interaction_count',
+                                           len(interactions))
+
         if handler != "initial_screen":
             # get start time
             start_time = utilities.string_to_datetime(
-                self.ussd_request.session["ussd_interaction"][-1]["start_time"])
+                interactions[-1]["start_time"])
             end_time = datetime.now()
             # Report in milliseconds
             duration = (end_time - start_time).total_seconds() * 1000
-            self.ussd_request.session["ussd_interaction"][-1].update(
+            interactions[-1].update(
                 {
                     "input": self.ussd_request.input,
                     "end_time": utilities.datetime_to_string(end_time),
                     "duration": duration
                 }
             )
+            self.log_interaction(interaction_count - 1, interactions[-1])
 
         # Handle any forwarded Requests; loop until a Response is
         # eventually returned.
         while not isinstance(ussd_response, UssdResponse):
             self.ussd_request, handler = ussd_response
 
-            screen_content = self.ussd_request.get_screens(handler)
-
-            screen_type = 'initial_screen' \
-                if handler == "initial_screen" and \
-                   isinstance(screen_content, str) \
-                else screen_content['type']
-
-            ussd_response = _registered_ussd_handlers[screen_type](
+            ussd_response = self.journey.get_screen(handler).get_handler(
                 self.ussd_request,
-                handler,
-                screen_content,
                 initial_screen=self.initial_screen,
                 logger=self.logger
             ).handle()
 
         self.ussd_request.session['_ussd_state']['next_screen'] = handler
 
-        self.ussd_request.session['ussd_interaction'].append(
+        interactions = self.ussd_request.session['ussd_interaction']
+        interactions.append(
             {
                 "screen_name": handler,
                 "screen_text": str(ussd_response),
@@ -712,11 +1269,26 @@ class UssdEngine(object):
                 "start_time": utilities.datetime_to_string(datetime.now())
             }
         )
+        self.ussd_request.session['_ussd_state']['interaction_count'] = \
+            interaction_count + 1
+        if not ussd_response.status:
+            # the user won't reply to this one
+            self.log_interaction(interaction_count, interactions[-1])
+
+        limit = ussd_airflow_variables.interaction_history_limit
+        if limit and len(interactions) > limit:
+            del interactions[:-limit]
         # Attach session to outgoing response
         ussd_response.session = self.ussd_request.session
 
         return ussd_response
 
+    def log_interaction(self, position, interaction):
+        log = interaction_log.get_interaction_log()
+        if log is not None:
+            log.append(self.ussd_request.session['session_id'], position,
+                       interaction)
+
     @staticmethod
     def validate_ussd_journey(ussd_content: dict) -> (bool, dict):
         errors = {}
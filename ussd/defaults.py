@@ -1,4 +1,9 @@
+import os
+
 ussd_text_limit = 182
+# how texts are measured against ussd_text_limit, gsm7 counts them in the
+# encoding they are sent in (see ussd.utils.gsm), chars counts characters
+ussd_text_encoding = os.environ.get('USSD_TEXT_ENCODING', 'gsm7')
 
 
 # ************ Ussd airflow session variables **************
@@ -6,9 +11,81 @@ last_update = '_ussd_airflow_last_updated'
 expiry = '_ussd_airflow_expiry'
 previous_session_id = '_ussd_airflow_previous_session_id'
 session_expiry = '_session_expiry'
+# seconds of inactivity session_expiry is worked out from
+session_expiry_age = '_session_expiry_age'
+# serializer used to save sessions, sessions saved with any other
+# serializer can still be read. The default is the original base64 json
+# format, ussd.session_store.CompactJSONSerializer (utf-8 json) and
+# ussd.session_store.MsgpackSerializer (binary, needs msgpack) skip base64.
+# Workers that don't have the new serializers can't read the sessions they
+# write, switch once every worker has been upgraded.
+session_serializer = os.environ.get(
+    'USSD_SESSION_SERIALIZER', 'ussd.session_store.JSONSerializer')
+# compression of saved sessions bigger than session_compression_threshold
+# bytes, zlib, lzma or a dotted path to a SessionCompressor, off if empty.
+# Compressed sessions can be read whatever this is set to, but not by
+# workers of older versions, so only turn it on once every worker has been
+# upgraded. Sessions in the original base64 json format are never
+# compressed, see session_serializer.
+session_compression = os.environ.get('USSD_SESSION_COMPRESSION', '')
+session_compression_threshold = int(
+    os.environ.get('USSD_SESSION_COMPRESSION_THRESHOLD') or 1024)
+# session store class, ussd.session_store.FieldSessionStore keeps each key
+# in its own record.
+session_store_class = os.environ.get(
+    'USSD_SESSION_STORE_CLASS', 'ussd.session_store.SessionStore')
+# number of interactions kept in session['ussd_interaction'], the oldest
+# are dropped first. Empty keeps all of them, see ussd.interaction_log to
+# keep the full history outside the session.
+interaction_history_limit = int(
+    os.environ.get('USSD_INTERACTION_HISTORY_LIMIT') or 0) or None
+# directory of the FileInteractionLog, no interaction log if empty
+interaction_log_directory = os.environ.get(
+    'USSD_INTERACTION_LOG_DIRECTORY', '')
+# directory of the session expiry index used by
+# ussd.store.session_store.sweeper, sessions are not indexed if empty
+session_expiry_index_directory = os.environ.get(
+    'USSD_SESSION_EXPIRY_INDEX_DIRECTORY', '')
+# directory of the FileSessionLock held while a request of a session is
+# handled, requests are not serialized if empty. See ussd.session_lock
+session_lock_directory = os.environ.get('USSD_SESSION_LOCK_DIRECTORY', '')
+# seconds to wait for the session lock before giving up
+session_lock_timeout = float(
+    os.environ.get('USSD_SESSION_LOCK_TIMEOUT') or 10)
+# seconds a gateway retry gets the previous response instead of running
+# the screens again, 0 turns it off. A retry is a request with the same
+# request_id as the last one, or, for requests without a request_id, the
+# same input. Without request ids only turn it on if users can't send the
+# same input twice in that time, e.g gateways that send the whole input
+# history ("1*2*1").
+session_replay_ttl = float(os.environ.get('USSD_SESSION_REPLAY_TTL') or 0)
+# FieldSessionStore, values bigger than this (bytes) are kept in their own
+# record and only read when used.
+session_inline_field_size = 512
 # **********************************************************
 
 
 # ****************** Ussd airflow util variables ***********
 index_format = ". "
 # **********************************************************
+
+
+# ****************** Ussd airflow template variables *******
+# os environment variables exposed to templates. Comma separated names
+# and prefixes (e.g USSD_), if both are empty all variables are exposed.
+template_environment_allow_list = os.environ.get(
+    'USSD_TEMPLATE_ENVIRONMENT_ALLOW_LIST', '')
+template_environment_prefixes = os.environ.get(
+    'USSD_TEMPLATE_ENVIRONMENT_PREFIXES', '')
+# **********************************************************
+
+
+# ****************** Ussd airflow cache variables **********
+# number of compiled jinja templates and expressions to keep in memory
+template_cache_size = 1024
+# number of compiled journeys to keep in memory
+compiled_journey_cache_size = 128
+# CachingJourneyStore, number of journeys and how long (seconds) to keep them
+journey_cache_size = 128
+journey_cache_ttl = 300
+# **********************************************************
@@ -0,0 +1,128 @@
+"""
+Append only log of the screens each session went through.
+
+The session only keeps the last ``interaction_history_limit`` interactions,
+an interaction log keeps all of them outside the session so that
+``report_session`` and analytics can still get the full history.
+
+.. code-block:: python
+
+    from ussd.interaction_log import FileInteractionLog, \
+        configure_interaction_log
+
+    configure_interaction_log(FileInteractionLog("./interactions"))
+
+The log can also be configured with the ``USSD_INTERACTION_LOG_DIRECTORY``
+environment variable.
+"""
+import json
+import os
+from urllib.parse import quote
+
+from simplekv import KeyValueStore
+
+from ussd import defaults as ussd_airflow_variables
+
+
+class InteractionLog(object):
+    """
+    Interactions are appended once they are complete, i.e when the user
+    has replied to the screen or the screen ended the session. ``position``
+    is the index of the interaction in the session's full history.
+    """
+
+    def append(self, session_id: str, position: int, interaction: dict):
+        raise NotImplementedError
+
+    def read(self, session_id: str) -> list:
+        raise NotImplementedError
+
+
+class FileInteractionLog(InteractionLog):
+    """
+    One json lines file per session in ``directory``.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _get_file_path(self, session_id):
+        return os.path.join(self.directory,
+                            "{0}.jsonl".format(quote(str(session_id), safe='')))
+
+    def append(self, session_id, position, interaction):
+        with open(self._get_file_path(session_id), 'a') as log_file:
+            log_file.write(json.dumps(interaction, separators=(',', ':')))
+            log_file.write('\n')
+
+    def read(self, session_id):
+        try:
+            with open(self._get_file_path(session_id)) as log_file:
+                return [json.loads(line) for line in log_file if line.strip()]
+        except FileNotFoundError:
+            return []
+
+
+class KeyValueInteractionLog(InteractionLog):
+    """
+    One record per interaction in a simplekv store,
+    ``<session_id>.interaction.<position>``.
+    """
+
+    def __init__(self, kv_store: KeyValueStore):
+        self.kv_store = kv_store
+
+    @staticmethod
+    def _prefix(session_id):
+        return "{0}.interaction.".format(session_id)
+
+    def append(self, session_id, position, interaction):
+        self.kv_store.put(
+            "{0}{1:08d}".format(self._prefix(session_id), position),
+            json.dumps(interaction, separators=(',', ':')).encode('utf-8')
+        )
+
+    def read(self, session_id):
+        return [
+            json.loads(self.kv_store.get(key).decode('utf-8'))
+            for key in sorted(self.kv_store.keys(self._prefix(session_id)))
+        ]
+
+
+_interaction_log = None
+
+
+def configure_interaction_log(interaction_log: InteractionLog = None):
+    """
+    Sets the interaction log used by the engine and ``report_session``,
+    ``None`` disables it.
+    """
+    global _interaction_log
+    _interaction_log = interaction_log
+
+
+def get_interaction_log() -> InteractionLog:
+    return _interaction_log
+
+
+def get_full_history(session) -> list:
+    """
+    Every interaction of the session, from the interaction log followed by
+    the ones that are only in the session yet.
+    """
+    interactions = list(session.get('ussd_interaction') or [])
+    if _interaction_log is None:
+        return interactions
+
+    logged = _interaction_log.read(session.get('session_id'))
+    count = (session.get('_ussd_state') or {}).get(
+        'interaction_count', len(interactions))
+    first_position = count - len(interactions)
+    return logged + interactions[max(len(logged) - first_position, 0):]
+
+
+if ussd_airflow_variables.interaction_log_directory:
+    configure_interaction_log(
+        FileInteractionLog(ussd_airflow_variables.interaction_log_directory))
@@ -181,3 +181,58 @@ class Page(collections.abc.Sequence):
         if self.number == self.paginator.num_pages:
             return self.paginator.count
         return self.number * self.paginator.per_page
+
+
+class LazyPages(object):
+    """
+    1-based pages taken from ``pages``, an iterable, as they are asked for.
+    Pages after the one asked for, and so the number of pages, are only
+    generated when something needs them.
+    """
+
+    def __init__(self, pages):
+        if isinstance(pages, (list, tuple)):
+            self._generated = pages
+            self._iterator = None
+        else:
+            self._generated = []
+            self._iterator = iter(pages)
+
+    def _generate(self, number):
+        while self._iterator is not None and len(self._generated) < number:
+            try:
+                self._generated.append(next(self._iterator))
+            except StopIteration:
+                self._iterator = None
+
+    def has_page(self, number) -> bool:
+        if number < 1:
+            return False
+        self._generate(number)
+        return number <= len(self._generated)
+
+    def page(self, number):
+        if not self.has_page(number):
+            raise EmptyPage(_('That page contains no results'))
+        return self._generated[number - 1]
+
+    @property
+    def generated(self) -> list:
+        """
+        The pages generated so far.
+        """
+        return list(self._generated)
+
+    @property
+    def exhausted(self) -> bool:
+        return self._iterator is None
+
+    def __len__(self):
+        self._generate(float('inf'))
+        return len(self._generated)
+
+    def __iter__(self):
+        number = 1
+        while self.has_page(number):
+            yield self._generated[number - 1]
+            number += 1
@@ -1,6 +1,7 @@
 from ussd.core import UssdHandlerAbstract
 from ussd.screens.schema import UssdBaseScreenSchema, NextUssdScreenSchema
 from ussd.graph import Vertex, Link
+from ussd.utils import gsm
 import typing
 from marshmallow import Schema, fields, validate
 
@@ -28,6 +29,8 @@ class UssdReportSessionSchema(Schema):
 
 class PaginatorConfigSchema(Schema):
     ussd_text_limit = fields.Integer(required=False, default=180)
+    ussd_text_encoding = fields.Str(required=False,
+                                    validate=validate.OneOf(gsm.ENCODINGS))
     more_option = fields.Dict()
     back_option = fields.Dict()
 
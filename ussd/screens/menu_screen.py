@@ -1,6 +1,11 @@
 from ussd.core import UssdHandlerAbstract, UssdResponse
-from ussd.paginator import Paginator
+from ussd.paginator import LazyPages, Paginator
+from ussd.utils.functional import cached_property
+import collections
+import itertools
+import math
 import textwrap
+from collections.abc import Sized
 from ussd.graph import Link, Vertex
 import typing
 from marshmallow import validates_schema, fields, ValidationError
@@ -147,120 +152,361 @@ class MenuScreen(UssdHandlerAbstract):
     screen_type = "menu_screen"
     serializer = MenuScreenSchema
 
-    def __init__(self, *args, **kwargs):
-        super(MenuScreen, self).__init__(*args, **kwargs)
-        self.list_options = [] if self.screen_content.get('items') is None \
+    @classmethod
+    def build_prototype(cls, screen_content, initial_screen):
+        prototype = super(MenuScreen, cls).build_prototype(
+            screen_content, initial_screen)
+        prototype['option_specs'] = tuple(
+            dict(input_value=option.get('input_value'),
+                 input_display=option.get('input_display'),
+                 next_screen=option['next_screen'],
+                 text=option['text'])
+            for option in screen_content.get('options') or ()
+        )
+        pagination_config = prototype['pagination_config']
+        texts = [screen_content.get('text'),
+                 pagination_config.get('more_option'),
+                 pagination_config.get('back_option')] + \
+            [option['text'] for option in prototype['option_specs']]
+        # pages of screens without session variables are the same for
+        # every session
+        prototype['static_layout'] = \
+            screen_content.get('items') is None and \
+            not any(cls._contains_vars(text)
+                    for text_context in texts if text_context
+                    for text in (text_context.values()
+                                 if isinstance(text_context, dict)
+                                 else (text_context,)))
+        return prototype
+
+    # options are only rendered when the screen is displayed, selecting
+    # an option doesn't need them.
+    @cached_property
+    def list_options(self):
+        return [] if self.screen_content.get('items') is None \
             else self.get_items()
-        self.menu_options = [] if self.screen_content.get('options') is None \
+
+    @cached_property
+    def menu_options(self):
+        return [] if self.screen_content.get('options') is None \
             else self.get_menu_options()
-        self.error_message = "Please enter a valid choice.\n" \
+
+    @cached_property
+    def error_message(self):
+        return "Please enter a valid choice.\n" \
             if not self.screen_content.get('error_message') \
             else self.get_text(self.screen_content["error_message"])
 
+    @cached_property
+    def options(self):
         # all options
-        self.options = self.list_options + \
-                       ([] if self.screen_content.get('options') is None else
-                        self.get_menu_options(
-                            start_index=len(self.list_options) + 1))
+        return list(self.iter_options())
+
+    def iter_options(self, start=0):
+        """
+        Items are rendered as the options are consumed, menu options
+        follow them. ``start`` is the index of the first option.
+        """
+        if self.screen_content.get('items') is None:
+            return self.iter_menu_options(start=start)
+        items_count = self.items_count
+        items = self.record_items(
+            self.iter_items(start + 1, self.slice_items(start))
+            if start else self.iter_items(), start)
+        if self.screen_content.get('options') is None:
+            return items
+        return itertools.chain(
+            items,
+            self.iter_menu_options(start_index=items_count + 1,
+                                   start=max(start - items_count, 0)))
+
+    @cached_property
+    def item_values(self) -> dict:
+        """
+        Values of the items rendered so far by their number, as a string
+        so the table survives the session's serialization.
+        """
+        return {}
+
+    def record_items(self, items, start=0):
+        for number, item in enumerate(items, start + 1):
+            self.item_values[str(number)] = item.value
+            yield item
+
+    def save_item_values(self):
+        """
+        Keeps the values of the displayed items in the session, selecting
+        one of them doesn't need the items to be rendered again.
+        """
+        if self.raw_text or self.screen_content.get('items') is None:
+            return
+        self.ussd_request.session['_ussd_state']['items'] = dict(
+            screen=self.handler,
+            count=self.items_count,
+            values=dict(self.item_values)
+        )
+
+    def get_saved_items(self) -> dict:
+        saved_items = self.ussd_request.session.get(
+            '_ussd_state', {}).get('items')
+        if saved_items and saved_items['screen'] == self.handler:
+            return saved_items
+        return None
 
-        self.paginator = self.get_paginator()
+    @cached_property
+    def pages(self) -> LazyPages:
+        return self.get_lazy_pages()
+
+    @cached_property
+    def paginator(self):
+        return self.get_paginator()
 
     def show_ussd_content(self):
         if not self.raw_text:
             self.ussd_request.session['_ussd_state']['page'] = 1
-        return self._render_page(1)
+        text = self._render_page(1)
+        self.save_pages()
+        self.save_item_values()
+        return text
 
-    def _render_page(self, index):
-        return self.paginator.page(index).object_list[0]
+    # where the first page starts, see page_starts
+    first_page_start = (None, 0, False)
 
-    def get_paginator(self):
-        pages = []
-        ussd_title = self._add_end_line(self.get_text())
+    @cached_property
+    def page_starts(self) -> list:
+        """
+        Where the pages rendered so far and the one after them start, read
+        from the session while paging. A start is ``[title, option,
+        has_previous]``, the part of the text left for the page (None for
+        all of it), the index of the page's first option and whether
+        there's a page before it. None after the last page.
+        """
+        saved_pages = self.get_saved_pages()
+        # sessions saved before the starts were kept have the pages' text
+        if saved_pages is not None and 'starts' in saved_pages:
+            return list(saved_pages['starts'])
+        return [list(self.first_page_start)]
 
-        # get ussd text limit
-        ussd_text_limit = self.get_text_limit()
+    def save_pages(self):
+        """
+        Keeps where the pages start in the session so that "98" and "00"
+        only render the page asked for. Pages of static screens are
+        looked up in the compiled screen's layouts instead.
+        """
+        if self.raw_text:
+            return
+        ussd_state = self.ussd_request.session['_ussd_state']
+        if self.get_layout_key() is not None:
+            ussd_state.pop('pages', None)
+            return
+        ussd_state['pages'] = dict(
+            screen=self.handler,
+            starts=list(self.page_starts)
+        )
 
-        # paginate menu screen text
-        while len(ussd_title) > ussd_text_limit:
-            # Lets create pages
-            text = ""
-            if len(pages) > 0:
-                text += "00. {back_option}".format(
-                    back_option=self.pagination_back_option)
-            text += "98. {more_option}".format(
-                more_option=self.pagination_more_option
-            )
+    def get_saved_pages(self) -> dict:
+        saved_pages = self.ussd_request.session.get(
+            '_ussd_state', {}).get('pages')
+        if saved_pages and saved_pages['screen'] == self.handler:
+            return saved_pages
+        return None
 
-            # update ussd_text_limit to the one that considers pages
-            ussd_text_limit = ussd_text_limit - len(text) - 1
+    def get_page(self, page_number):
+        """
+        Renders the page from where it starts if that's known, from the
+        first page otherwise. None if the screen has no such page.
+        """
+        if page_number < 1:
+            return None
+        starts = self.page_starts
+        if self.get_layout_key() is None and page_number <= len(starts):
+            start = starts[page_number - 1]
+            if start is None:
+                return None
+            text, next_start = next(self.iter_pages(start))
+            starts[page_number:] = [next_start]
+        elif self.pages.has_page(page_number):
+            text = self._render_page(page_number)
+        else:
+            return None
+        self.save_pages()
+        self.save_item_values()
+        return text
 
-            ussd_text_subsets = textwrap.wrap(
-                ussd_title, width=ussd_text_limit
-            )
+    def _render_page(self, index):
+        return self.pages.page(index)
 
-            pages.append(
-                self._add_end_line(ussd_text_subsets[0]) + text
-            )
+    def get_layout_key(self):
+        """
+        Key of the screen's pages in the compiled screen's layouts, None
+        if they have to be rendered for this session.
+        """
+        if self.raw_text or self.compiled_screen is None or \
+                not self.prototype.get('static_layout'):
+            return None
+        return (
+            self.ussd_request.session.get('override_language') or
+            self.ussd_request.language,
+            self.ussd_request.default_language,
+            self.get_text_limit(),
+            self.ussd_request.menu_index_format
+        )
+
+    def get_lazy_pages(self) -> LazyPages:
+        key = self.get_layout_key()
+        if key is None:
+            return LazyPages(self.get_pages())
+        layouts = self.compiled_screen.layouts
+        pages = layouts.get(key)
+        if pages is None:
+            pages = layouts[key] = tuple(self.get_pages())
+        return LazyPages(pages)
+
+    def get_paginator(self):
+        return Paginator(list(self.pages), 1)
 
-            ussd_title = self._add_end_line(' '.join(ussd_text_subsets[1:]))
+    def get_pages(self):
+        """
+        Generates the pages of the screen, options are only rendered
+        when the page they are on is generated.
+        """
+        pages = self.iter_pages(self.first_page_start)
+        for number, (page, next_start) in enumerate(pages, 1):
+            self.page_starts[number:number + 1] = [next_start]
+            yield page
+
+    def iter_pages(self, start):
+        """
+        Generates the pages from ``start``, see :attr:`page_starts`, along
+        with where the page after each of them starts.
+        """
+        ussd_title, option_index, has_previous = start
+        if ussd_title is None:
+            ussd_title = self._add_end_line(self.get_text())
 
-        self.paginate_options(ussd_title, pages, self.options[:])
+        # get ussd text limit
+        ussd_text_limit = self.get_text_limit()
+        back_text, more_text = self.get_page_footers()
 
-        return Paginator(pages, 1)
+        # paginate menu screen text
+        while self.text_length(ussd_title) > ussd_text_limit:
+            # Lets create pages
+            text = (back_text if has_previous else "") + more_text
+            page_text, ussd_title = self.split_text(
+                ussd_title, ussd_text_limit - self.text_length(text))
+            has_previous = True
+            yield page_text + text, [ussd_title, 0, True]
+
+        options = self.iter_options(option_index)
+        for page, count, more in self.count_option_pages(
+                ussd_title, has_previous, options):
+            option_index += count
+            yield page, ["", option_index, True] if more else None
 
     def paginate_options(self, ussd_text, pages, options):
         """
-        Assumptions:
-            - ussd_text is within the limit
+        Adds the pages of ``options`` to ``pages``, the first one starting
+        with ``ussd_text``, which has to be within the limit, and returns
+        ``pages``. Kept for subclasses that build pages themselves, the
+        screen generates its pages with :meth:`iter_option_pages`.
         """
-        # Todo use back off strategy to generate the pages
-        text = ""
-        if len(pages) > 0:
-            text += "00. {back_option}".format(
-                back_option=self.pagination_back_option)
+        pages.extend(self.iter_option_pages(ussd_text, bool(pages), options))
+        return pages
+
+    def get_page_footers(self) -> tuple:
+        return (
+            "00. {back_option}".format(
+                back_option=self.pagination_back_option),
+            "98. {more_option}".format(
+                more_option=self.pagination_more_option)
+        )
 
-        if not options:
-            pages.append(
-                ussd_text + text
-            )
-            return pages
-
-        ussd_text_cadidate = ussd_text + options[0].text
-        # detect if there might be more optoins
-        text += "98. {more_option}".format(more_option=
-                                           self.pagination_more_option) \
-            if len(ussd_text_cadidate) > self.get_text_limit() - len(text) \
-            else ''
-        if len(ussd_text_cadidate) <= self.get_text_limit() - len(text):
-            ussd_text = ussd_text + options[0].text
-        else:
-            pages.append(
-                ussd_text + text
-            )
-            ussd_text = options[0].text
-        return self.paginate_options(
-                ussd_text,
-                pages,
-                options[1:]
-            )
+    def split_text(self, text, limit) -> tuple:
+        """
+        Splits text on words into the part that fits in limit, with its
+        end line, and the rest.
+        """
+        width = limit - 1
+        while True:
+            ussd_text_subsets = textwrap.wrap(text, width=max(width, 1))
+            page_text = self._add_end_line(ussd_text_subsets[0])
+            excess = self.text_length(page_text) - limit
+            if excess <= 0 or width <= 1:
+                break
+            # characters of the text can count more than one
+            width -= max(1, math.ceil(
+                excess * len(page_text) / self.text_length(page_text)))
+        return page_text, \
+            self._add_end_line(' '.join(ussd_text_subsets[1:]))
+
+    def iter_option_pages(self, ussd_text, has_previous, options):
+        """
+        Fills every page with as many options as fit along with the "00"
+        and "98" options, the last page doesn't need "98". Filling the
+        pages in order like this gives the fewest pages.
+        """
+        for page, _, _ in self.count_option_pages(ussd_text, has_previous,
+                                                  options):
+            yield page
+
+    def count_option_pages(self, ussd_text, has_previous, options):
+        """
+        Same as :meth:`iter_option_pages`, along with the number of options
+        on each page and whether there's a page after it.
+        """
+        ussd_text_limit = self.get_text_limit()
+        back_text, more_text = self.get_page_footers()
+
+        options = iter(options)
+        # options looked at ahead that belong to the next page
+        pending = collections.deque()
+
+        def next_option():
+            return pending.popleft() if pending else next(options, None)
+
+        count = 0
+        option = next_option()
+        while option is not None:
+            text = back_text if has_previous else ""
+            candidate = ussd_text + option.text
+            # an option too long for any page gets one of its own
+            if not ussd_text or self.text_length(
+                    candidate + text + more_text) <= ussd_text_limit:
+                ussd_text = candidate
+                count += 1
+                option = next_option()
+                continue
+
+            # without "98" the rest of the options might fit
+            rest = [option]
+            while self.text_length(candidate + text) <= ussd_text_limit:
+                next_option_ = next_option()
+                if next_option_ is None:
+                    yield candidate + text, count + len(rest), False
+                    return
+                rest.append(next_option_)
+                candidate += next_option_.text
+            pending.extendleft(reversed(rest[1:]))
+
+            yield ussd_text + text + more_text, count, True
+            has_previous = True
+            ussd_text = ""
+            count = 0
+            option = rest[0]
+        yield ussd_text + (back_text if has_previous else ""), count, False
 
     def handle_ussd_input(self, ussd_input):
         # check if input is for previous or next page
         if self.ussd_request.input.strip() in ("98", "00"):
-            page = self.paginator.page(
-                self.ussd_request.session['_ussd_state']['page']
-            )
-            if self.ussd_request.input.strip() == "98" and page.has_next():
-                new_page_number = page.next_page_number()
+            page_number = self.ussd_request.session['_ussd_state']['page']
+            new_page_number = page_number + 1 \
+                if self.ussd_request.input.strip() == "98" \
+                else page_number - 1
+            text = self.get_page(new_page_number)
+            if text is not None:
                 self.ussd_request.session['_ussd_state']['page'] = \
                     new_page_number
-                return UssdResponse(self._render_page(new_page_number))
-            elif self.ussd_request.input.strip() == '00' and \
-                    page.has_previous():
-                new_page_number = page.previous_page_number()
-                self.ussd_request.session['_ussd_state']['page'] = \
-                    new_page_number
-                return UssdResponse(self._render_page(new_page_number))
+                return UssdResponse(text)
         next_screen = self.evaluate_input()
         if next_screen:
             return self.route_options(next_screen)
@@ -276,57 +522,120 @@ class MenuScreen(UssdHandlerAbstract):
                 not int(self.ussd_request.input) <= 0:
             ussd_input = int(self.ussd_request.input)
             ussd_input_index = ussd_input - 1
-            if ussd_input <= len(self.list_options):
+            saved_items = self.get_saved_items()
+            items_count = saved_items['count'] \
+                if saved_items is not None else self.items_count
+            if ussd_input <= items_count:
                 # save input in the session
-                selected_item = self.list_options[ussd_input_index]
+                if saved_items is not None and \
+                        str(ussd_input) in saved_items['values']:
+                    value = saved_items['values'][str(ussd_input)]
+                else:
+                    # not displayed yet
+                    value = self.get_item(ussd_input_index).value
                 self.ussd_request.session[
-                    self.screen_content['items']['session_key']] = \
-                    selected_item.value
+                    self.screen_content['items']['session_key']] = value
                 # forward request to the next screen
                 return self.screen_content['items']['next_screen']
-            elif ussd_input <= len(self.menu_options):
-                return self.menu_options[ussd_input_index].next_screen
+            elif ussd_input <= len(self.option_specs):
+                return self.option_specs[ussd_input_index]['next_screen']
         else:
-            for option in self.menu_options:
-                if option.index_value == self.ussd_request.input:
-                    return option.next_screen
+            for index, option in enumerate(self.option_specs, 1):
+                if (option['input_value'] or index) == \
+                        self.ussd_request.input:
+                    return option['next_screen']
         return False
 
+    @property
+    def option_specs(self):
+        return self.prototype.get('option_specs', ())
+
     def get_items(self, start_index: int = 1) -> list:
         """
         This gets ListItems
         :return:
         """
-        items_section = self.screen_content['items']
-
-        text = self.screen_content['items']['text']
-        value = self.screen_content['items']['value']
+        return list(self.iter_items(start_index))
 
+    def get_loop(self) -> tuple:
+        """
+        Returns the loop method and expression of the items section
+        """
         loop_method = ""
         loop_value = ""
-        for key, value_ in items_section.items():
+        for key, value_ in self.screen_content['items'].items():
             if key.startswith("with_"):
                 loop_method = "_" + key
                 loop_value = value_
+        return loop_method, loop_value
 
-        items = self.evaluate_jija_expression(loop_value,
+    @cached_property
+    def loop_items(self):
+        """
+        The evaluated with_items or with_dict expression, items are
+        rendered from it as they are needed.
+        """
+        items = self.evaluate_jija_expression(self.get_loop()[1],
                                               session=self.ussd_request.session,
                                               default=[]
                                               )
+        if items is not None and not isinstance(items, Sized):
+            items = list(items)
+        return items
+
+    @property
+    def items_count(self) -> int:
+        if self.screen_content.get('items') is None:
+            return 0
+        if self.loop_items is None:
+            return 1 if self.raw_text else 0
+        return len(self.loop_items)
+
+    def iter_items(self, start_index: int = 1, items=None):
+        items_section = self.screen_content['items']
+
+        text = items_section['text']
+        value = items_section['value']
+        loop_method, loop_value = self.get_loop()
+
+        if items is None:
+            items = self.loop_items
         if items is None and self.raw_text:
             txt = loop_value or value
             txt += '\n'
-            return [ListItem(txt, items_section['session_key'])]
-        return getattr(self, loop_method)(
+            return iter([ListItem(txt, items_section['session_key'])])
+        return iter(getattr(self, loop_method)(
             text, value, items, start_index
-        )
+        ))
+
+    def get_item(self, index: int) -> ListItem:
+        """
+        Renders only the item at ``index``
+        """
+        return next(self.iter_items(index + 1,
+                                    self.slice_items(index, index + 1)))
+
+    def slice_items(self, start, stop=None):
+        """
+        The loop items from ``start`` to ``stop``, dicts stay dicts.
+        """
+        items = self.loop_items
+        if isinstance(items, dict):
+            return {key: items[key]
+                    for key in itertools.islice(items, start, stop)}
+        return items[start:stop]
 
     def get_menu_options(self, start_index: int = 1) -> list:
-        menu_options = []
-        for i, option in enumerate(self.screen_content.get('options', []),
-                                   start_index):
-            input_value = option.get('input_value') or i
-            input_display = option.get('input_display') or "{index}{index_format}".format(
+        return list(self.iter_menu_options(start_index))
+
+    def iter_menu_options(self, start_index: int = 1, start: int = 0):
+        """
+        Renders the menu options from the one at ``start``.
+        """
+        option_specs = itertools.islice(self.option_specs, start, None)
+        for i, option in enumerate(option_specs, start_index + start):
+            input_value = option['input_value'] or i
+            input_display = option['input_display'] or "{index}{index_format}".format(
                 index=input_value,
                 index_format=self.ussd_request.menu_index_format
             )
@@ -337,16 +646,13 @@ class MenuScreen(UssdHandlerAbstract):
                     self.get_text(text_context=option['text'])
                 )
             )
-            menu_options.append(
-                MenuOption(
-                    text,
-                    option['next_screen'],
-                    input_display,
-                    input_value,
-                    self.get_text(text_context=option['text'])
-                )
+            yield MenuOption(
+                text,
+                option['next_screen'],
+                input_display,
+                input_value,
+                self.get_text(text_context=option['text'])
             )
-        return menu_options
 
     def handle_invalid_input(self):
         return UssdResponse(
@@ -356,7 +662,7 @@ class MenuScreen(UssdHandlerAbstract):
         )
 
     def _with_items(self, text, value, items, start_index):
-        list_items = []
+        context_ = self.get_context(self.ussd_request.session)
         for index, item in enumerate(items, start_index):
             context = {}
             extra = {
@@ -377,24 +683,22 @@ class MenuScreen(UssdHandlerAbstract):
                 index=index,
                 index_format=self.ussd_request.menu_index_format)
 
-            list_items.append(
-                ListItem(
-                    self._add_end_line("{index_text}{text}".format(
-                        index_text=index_text,
-                        text=UssdHandlerAbstract.render_text(
-                            self.ussd_request.session,
-                            text,
-                            extra=context
-                        )
+            yield ListItem(
+                self._add_end_line("{index_text}{text}".format(
+                    index_text=index_text,
+                    text=UssdHandlerAbstract.render_text(
+                        self.ussd_request.session,
+                        text,
+                        context=context_,
+                        extra=context
                     )
-                    ),
-                    self.evaluate_jija_expression(value,
-                                                  session=
-                                                  self.ussd_request.session,
-                                                  extra_context=context)
                 )
+                ),
+                self.evaluate_jija_expression(value,
+                                              session=
+                                              self.ussd_request.session,
+                                              extra_context=context)
             )
-        return list_items
 
     def _with_dict(self, text, value, items, start_index):
         return self._with_items(text, value, items, start_index)
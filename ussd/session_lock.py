@@ -0,0 +1,148 @@
+"""
+Locks that let only one request of a session run at a time.
+
+Gateways resend a request when the reply is slow, without a lock the
+retry runs alongside the original and the last one to save the session
+wins.
+
+.. code-block:: python
+
+    from ussd.session_lock import FileSessionLock, configure_session_lock
+
+    configure_session_lock(FileSessionLock("./session_locks"))
+
+The lock can also be configured with the ``USSD_SESSION_LOCK_DIRECTORY``
+environment variable.
+"""
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from ussd import defaults as ussd_airflow_variables
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+class SessionLockTimeout(Exception):
+    """
+    The session lock could not be acquired in time.
+    """
+    pass
+
+
+class SessionLock(object):
+    """
+    ``acquire`` blocks until the session is free or ``timeout`` seconds
+    have passed and returns a handle to pass to ``release``.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = ussd_airflow_variables.session_lock_timeout \
+            if timeout is None else timeout
+
+    def acquire(self, session_id: str):
+        raise NotImplementedError
+
+    def release(self, handle):
+        raise NotImplementedError
+
+    @contextmanager
+    def lock(self, session_id: str):
+        handle = self.acquire(session_id)
+        try:
+            yield
+        finally:
+            self.release(handle)
+
+    @staticmethod
+    def stripe(session_id, stripes) -> int:
+        digest = hashlib.md5(str(session_id).encode('utf-8')).hexdigest()
+        return int(digest[:8], 16) % stripes
+
+
+class LocalSessionLock(SessionLock):
+    """
+    Lock for the threads of one process. Sessions share ``stripes`` locks
+    so memory doesn't grow with the number of sessions.
+    """
+
+    def __init__(self, timeout=None, stripes=1024):
+        super(LocalSessionLock, self).__init__(timeout)
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def acquire(self, session_id):
+        lock = self._locks[self.stripe(session_id, len(self._locks))]
+        if not lock.acquire(timeout=self.timeout):
+            raise SessionLockTimeout(session_id)
+        return lock
+
+    def release(self, handle):
+        handle.release()
+
+
+class FileSessionLock(SessionLock):
+    """
+    ``flock`` on one of ``stripes`` files in ``directory``, works across
+    worker processes on the same host and for threads in a process.
+    """
+
+    poll_interval = 0.01
+
+    def __init__(self, directory, timeout=None, stripes=1024):
+        if fcntl is None:  # pragma: no cover
+            raise RuntimeError("FileSessionLock needs fcntl")
+        super(FileSessionLock, self).__init__(timeout)
+        self.directory = os.path.abspath(directory)
+        self.stripes = stripes
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _lock_file_path(self, session_id):
+        return os.path.join(self.directory, "{0}.lock".format(
+            self.stripe(session_id, self.stripes)))
+
+    def acquire(self, session_id):
+        fd = os.open(self._lock_file_path(session_id),
+                     os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    os.close(fd)
+                    raise SessionLockTimeout(session_id)
+                time.sleep(self.poll_interval)
+
+    def release(self, handle):
+        try:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+        finally:
+            os.close(handle)
+
+
+_session_lock = None
+
+
+def configure_session_lock(session_lock: SessionLock = None):
+    """
+    Sets the lock the engine holds while it handles a request, ``None``
+    disables locking.
+    """
+    global _session_lock
+    _session_lock = session_lock
+
+
+def get_session_lock() -> SessionLock:
+    return _session_lock
+
+
+if ussd_airflow_variables.session_lock_directory:
+    configure_session_lock(
+        FileSessionLock(ussd_airflow_variables.session_lock_directory))
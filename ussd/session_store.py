@@ -7,10 +7,17 @@ from simplekv.fs import FilesystemStore
 import random
 import string
 import base64
+import hashlib
 from datetime import datetime, timedelta
 import json
+import threading
+import time
+import zlib
 from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
 from ussd import defaults as ussd_airflow_variables
+from ussd.utils.module_loading import import_string
+from ussd.store.session_store.expiry_index import get_expiry_index
 
 def get_random_string(length=12,
                       allowed_chars='abcdefghijklmnopqrstuvwxyz'
@@ -50,14 +57,331 @@ class JSONSerializer:
     """
     Simple wrapper around json to be used in signing.dumps and
     signing.loads.
+
+    This is the original session format, sessions are stored as base64
+    encoded json without a header. It's still used to read sessions saved
+    before serializers had a header.
     """
     def dumps(self, obj):
         return json.dumps(obj, separators=(',', ':'), cls=CustomJsonEncoder).encode('latin-1')
 
+    def dumps_items(self, items):
+        return b'{' + b','.join(
+            json.dumps(key).encode('latin-1') + b':' + value
+            for key, value in items) + b'}'
+
     def loads(self, data):
         return json.loads(data.decode('latin-1'), object_pairs_hook=datetime_parser)
 
 
+# Sessions written by a SessionSerializer start with this marker followed by
+# the serializer's format_id. base64 never produces it so sessions without it
+# are in the original base64 json format.
+SERIALIZER_MARKER = b'\x00'
+
+_session_serializers = {}
+
+
+def register_serializer(serializer_class):
+    """
+    Registers a serializer so that sessions it has written can be read
+    whichever serializer is configured.
+    """
+    assert len(serializer_class.format_id) == 1, "format_id should be one byte"
+    _session_serializers[serializer_class.format_id] = serializer_class
+    return serializer_class
+
+
+class SessionSerializer(object):
+    """
+    Base class of session serializers.
+
+    ``format_id`` is a single byte written in front of every session, it's
+    used to pick the serializer that reads the session back, so it should
+    never change once sessions have been written with it.
+
+    Serializers can also have a ``dumps_items(items)`` method that returns
+    the serialized dict of ``items``, a list of (str key, serialized value)
+    pairs.
+    Sessions are then serialized from values the save has serialized
+    already.
+    """
+    format_id = None
+
+    def dumps(self, obj) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data: bytes):
+        raise NotImplementedError
+
+
+class CompactJSONEncoder(CustomJsonEncoder):
+
+    def __init__(self, *args, **kwargs):
+        super(CompactJSONEncoder, self).__init__(*args, **kwargs)
+        self.datetimes = 0
+
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            self.datetimes += 1
+            return {CompactJSONSerializer.datetime_key: obj.strftime(date_format)}
+        return super(CompactJSONEncoder, self).default(obj)
+
+
+@register_serializer
+class CompactJSONSerializer(SessionSerializer):
+    """
+    utf-8 json without base64, datetimes are stored as
+    ``{"$datetime": "<date_format>"}`` and come back as datetimes.
+
+    Single key dicts whose key starts with ``$`` are written with an extra
+    ``$`` in front of the key so that user data can't be read back as a
+    datetime.
+    """
+    format_id = b'j'
+    datetime_key = '$datetime'
+
+    @classmethod
+    def object_hook(cls, dct):
+        if len(dct) == 1:
+            key = next(iter(dct))
+            if key == cls.datetime_key:
+                return datetime.strptime(dct[key], date_format)
+            if key.startswith('$$'):
+                return {key[1:]: dct[key]}
+        return dct
+
+    @classmethod
+    def escape(cls, obj):
+        if isinstance(obj, dict):
+            if len(obj) == 1:
+                key, value = next(iter(obj.items()))
+                if isinstance(key, str) and key.startswith('$'):
+                    return {'$' + key: cls.escape(value)}
+            return {key: cls.escape(value) for key, value in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return [cls.escape(value) for value in obj]
+        return obj
+
+    def encode(self, obj):
+        encoder = CompactJSONEncoder(separators=(',', ':'),
+                                     ensure_ascii=False)
+        return encoder.encode(obj), encoder.datetimes
+
+    def dumps(self, obj):
+        serialized, datetimes = self.encode(obj)
+        # every '{"$' starts a dict whose first key starts with $, strings
+        # have their quotes escaped. Unless they are all datetimes, the
+        # session has dicts that need escaping.
+        if serialized.count('{"$') != datetimes:
+            serialized, _ = self.encode(self.escape(obj))
+        return serialized.encode('utf-8')
+
+    def dumps_items(self, items):
+        if len(items) == 1 and items[0][0].startswith('$'):
+            items = [('$' + items[0][0], items[0][1])]
+        return b'{' + b','.join(
+            json.dumps(key, ensure_ascii=False).encode('utf-8') + b':' + value
+            for key, value in items) + b'}'
+
+    def loads(self, data):
+        return json.loads(data.decode('utf-8'), object_hook=self.object_hook)
+
+
+@register_serializer
+class MsgpackSerializer(SessionSerializer):
+    """
+    msgpack, datetimes are stored as an extension type. Needs the
+    ``msgpack`` package, which is only imported when it's used.
+    """
+    format_id = b'm'
+    datetime_ext_type = 1
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return self.msgpack.ExtType(
+                self.datetime_ext_type,
+                obj.strftime(date_format).encode('ascii'))
+        return obj.__class__.__name__
+
+    def ext_hook(self, code, data):
+        if code == self.datetime_ext_type:
+            return datetime.strptime(data.decode('ascii'), date_format)
+        return self.msgpack.ExtType(code, data)
+
+    def dumps(self, obj):
+        return self.msgpack.packb(obj, default=self.default, use_bin_type=True)
+
+    def dumps_items(self, items):
+        packer = self.msgpack.Packer(use_bin_type=True)
+        return packer.pack_map_header(len(items)) + b''.join(
+            packer.pack(key) + value for key, value in items)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data, ext_hook=self.ext_hook, raw=False,
+                                    strict_map_key=False)
+
+
+# Compressed sessions start with this marker followed by the compressor's
+# codec_id, the rest is the compressed session as it would be written
+# uncompressed. Neither base64 nor SERIALIZER_MARKER produce it.
+COMPRESSION_MARKER = b'\x01'
+
+_session_compressors = {}
+
+
+def register_compressor(compressor_class):
+    """
+    Registers a compressor by ``name``, for configuration, and by
+    ``codec_id``, to read sessions it has compressed.
+    """
+    assert len(compressor_class.codec_id) == 1, "codec_id should be one byte"
+    _session_compressors[compressor_class.name] = compressor_class
+    _session_compressors[compressor_class.codec_id] = compressor_class
+    return compressor_class
+
+
+class SessionCompressor(object):
+    """
+    Base class of session compressors, like serializers ``codec_id``
+    should never change once sessions have been written with it.
+    """
+    name = None
+    codec_id = None
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+
+@register_compressor
+class ZlibCompressor(SessionCompressor):
+    name = 'zlib'
+    codec_id = b'z'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+@register_compressor
+class LzmaCompressor(SessionCompressor):
+    """
+    Smaller than zlib but slower, ``lzma`` is only imported when it's used
+    because some python builds leave it out.
+    """
+    name = 'lzma'
+    codec_id = b'x'
+
+    def __init__(self):
+        import lzma
+        self.lzma = lzma
+
+    def compress(self, data):
+        return self.lzma.compress(data, format=self.lzma.FORMAT_RAW,
+                                  filters=self.filters)
+
+    def decompress(self, data):
+        return self.lzma.decompress(data, format=self.lzma.FORMAT_RAW,
+                                    filters=self.filters)
+
+    @property
+    def filters(self):
+        # raw stream, the .xz container headers cost more than small
+        # sessions gain
+        return [dict(id=self.lzma.FILTER_LZMA2, preset=6)]
+
+
+def get_compressor(compressor=None):
+    """
+    Returns a compressor instance or ``None`` for no compression.
+    ``compressor`` can be an instance, a class, a registered name or a
+    dotted path, it defaults to ``defaults.session_compression``.
+    """
+    if compressor is None:
+        compressor = ussd_airflow_variables.session_compression
+    if not compressor:
+        return None
+    if isinstance(compressor, str):
+        compressor = _session_compressors.get(compressor) or \
+            import_string(compressor)
+    if isinstance(compressor, type):
+        compressor = compressor()
+    return compressor
+
+
+class CompressionStats(object):
+    """
+    Counts of sessions that were compressed and of the ones that were too
+    small or didn't get smaller, ``ratio`` is compressed bytes over
+    original bytes of the compressed ones.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.compressed = 0
+            self.skipped = 0
+            self.original_bytes = 0
+            self.compressed_bytes = 0
+
+    def record(self, original_size, compressed_size=None):
+        with self._lock:
+            if compressed_size is None:
+                self.skipped += 1
+            else:
+                self.compressed += 1
+                self.original_bytes += original_size
+                self.compressed_bytes += compressed_size
+
+    @property
+    def ratio(self):
+        if not self.original_bytes:
+            return None
+        return self.compressed_bytes / self.original_bytes
+
+    def stats(self) -> dict:
+        return dict(
+            compressed=self.compressed,
+            skipped=self.skipped,
+            original_bytes=self.original_bytes,
+            compressed_bytes=self.compressed_bytes,
+            ratio=self.ratio
+        )
+
+
+compression_stats = CompressionStats()
+
+
+def get_serializer(serializer=None):
+    """
+    Returns a serializer instance, ``serializer`` can be an instance, a
+    class or a dotted path to one, it defaults to
+    ``defaults.session_serializer``.
+    """
+    if serializer is None:
+        serializer = ussd_airflow_variables.session_serializer
+    if isinstance(serializer, str):
+        serializer = import_string(serializer)
+    if isinstance(serializer, type):
+        serializer = serializer()
+    return serializer
+
+
 # session_key should not be case sensitive because some backends can store it
 # on case insensitive file systems.
 VALID_KEY_CHARS = string.ascii_lowercase + string.digits
@@ -80,19 +404,75 @@ class UpdateError(Exception):
     """
 
 
+class SessionView(Mapping):
+    """
+    Read only mapping of a :class:`SessionStore`, see
+    :meth:`SessionStore.mapping`.
+    """
+
+    def __init__(self, session_store: 'SessionStore'):
+        self.session_store = session_store
+
+    def __getitem__(self, key):
+        return self.session_store[key]
+
+    def __contains__(self, key):
+        return key in self.session_store
+
+    def __iter__(self):
+        return iter(self.session_store.keys())
+
+    def __len__(self):
+        return len(self.session_store.keys())
+
+
 class SessionStore(object):
+    """
+    Dict like session saved in a simplekv store.
+
+    Changes are tracked per top level key. Keys that are set to a different
+    value or deleted are dirty. Nested changes, e.g.
+    ``session['_ussd_state']['page'] = 2``, are picked up by comparing
+    fingerprints of dict and list values taken the first time they are
+    read, values that are never read can't have changed and aren't
+    serialized until they are written. During a save each value is
+    serialized at most once, the bytes compared are the bytes written.
+    :meth:`save` skips the write when nothing changed and otherwise hands
+    the changed keys to :meth:`_save_changes`, so backends that can update
+    part of a session only write what changed.
+    """
 
     __not_given = object()
+    _mutable_types = (dict, list)
 
     def __init__(self, session_key=None,
                  kv_store: KeyValueStore = None,
-                 default_session_cookie_age: int = SESSION_COOKIE_AGE):
+                 default_session_cookie_age: int = SESSION_COOKIE_AGE,
+                 serializer=None, compression=None,
+                 compression_threshold=None):
         if kv_store is None:
             kv_store = FilesystemStore("./.session_data")
         self._session_key = session_key
         self.accessed = False
         self.modified = False
-        self.serializer = JSONSerializer
+        self.serializer = get_serializer(serializer)
+        # sessions in the original base64 format are left as they are
+        self.compressor = get_compressor(compression) \
+            if getattr(self.serializer, 'format_id', None) else None
+        self.compression_threshold = \
+            ussd_airflow_variables.session_compression_threshold \
+            if compression_threshold is None else compression_threshold
+        self._dirty_keys = set()
+        self._deleted_keys = set()
+        # fingerprints of the mutable values read since the session was
+        # loaded or saved
+        self._snapshot = {}
+        # bytes of the values serialized during a save
+        self._serialized = None
+        self._cleared = False
+        self._in_store = False
+        # loaded session was written by another serializer
+        self._stale_format = False
         self.defaul_session_cookie_age = default_session_cookie_age
         self.kv_store = kv_store
 
@@ -100,16 +480,35 @@ class SessionStore(object):
         return key in self._session
 
     def __getitem__(self, key):
-        return self._session[key]
+        value = self._session[key]
+        if key not in self._snapshot:
+            self._track(key, value)
+        return value
 
     def __setitem__(self, key, value):
+        if self._value_changed(key, value):
+            self._mark_dirty(key)
         self._session[key] = value
         self.modified = True
 
     def __delitem__(self, key):
         del self._session[key]
+        self._mark_deleted(key)
         self.modified = True
 
+    def _value_changed(self, key, value):
+        session = self._session
+        return key not in session or \
+            session[key] is not value and session[key] != value
+
+    def _mark_dirty(self, key):
+        self._dirty_keys.add(key)
+        self._deleted_keys.discard(key)
+
+    def _mark_deleted(self, key):
+        self._deleted_keys.add(key)
+        self._dirty_keys.discard(key)
+
     def load(self):
         try:
             data = self.kv_store.get(self.session_key)
@@ -125,19 +524,25 @@ class SessionStore(object):
             return False
 
     def get(self, key, default=None):
-        return self._session.get(key, default)
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
     def pop(self, key, default=__not_given):
         self.modified = self.modified or key in self._session
+        if key in self._session:
+            self._mark_deleted(key)
         args = () if default is self.__not_given else (default,)
         return self._session.pop(key, *args)
 
     def setdefault(self, key, value):
         if key in self._session:
-            return self._session[key]
+            return self[key]
         else:
             self.modified = True
             self._session[key] = value
+            self._mark_dirty(key)
             return value
 
     def delete(self, session_key=None):
@@ -156,10 +561,140 @@ class SessionStore(object):
             return self.create()
         data = self._get_session(no_load=must_create)
 
-        self.set_expiry(self.get_expiry_date())
-        self.kv_store.put(self.session_key, self.encode(data))
+        self._serialized = {}
+        try:
+            changed_keys = self.get_changed_keys()
+            full_write = must_create or self._cleared or \
+                not self._in_store or self._stale_format
+            if not (full_write or changed_keys or self._deleted_keys):
+                # nothing to write
+                return
+
+            self._refresh_expiry()
+            changed_keys.update(self._dirty_keys)
+
+            deleted_keys = set(self._deleted_keys)
+            self._save_changes(data, changed_keys, deleted_keys, full_write)
+
+            self._dirty_keys.clear()
+            self._deleted_keys.clear()
+            self._cleared = False
+            self._in_store = True
+            self._stale_format = False
+            self._update_snapshot(data, changed_keys, deleted_keys)
+        finally:
+            self._serialized = None
+
+        expiry_index = get_expiry_index()
+        if expiry_index is not None and \
+                not getattr(self.kv_store, 'ttl_support', False):
+            expiry_index.add(self.session_key,
+                             self.get_expiry_date().timestamp())
+
+    def _save_changes(self, data, changed_keys, deleted_keys, full_write):
+        """
+        Writes the session. Stores that keep the whole session in a single
+        value, like this one, rewrite it. Subclasses can override this to
+        only write ``changed_keys`` and remove ``deleted_keys`` unless
+        ``full_write`` is set, in which case the session should be written
+        from scratch.
+        """
+        self.put_record(self.session_key,
+                        self.encode(data, self._serialize_session(data)))
+
+    def put_record(self, key, data, ttl_secs=None):
+        """
+        Writes a record of this session, stores with time to live support
+        get the session expiry as the record's ttl unless ``ttl_secs`` is
+        given.
+        """
+        if getattr(self.kv_store, 'ttl_support', False):
+            if ttl_secs is None:
+                ttl_secs = max(self.get_expiry_age(), 1)
+            return self.kv_store.put(key, data, ttl_secs=ttl_secs)
+        return self.kv_store.put(key, data)
+
+    def get_changed_keys(self) -> set:
+        """
+        Returns keys whose values have changed since the session was
+        loaded or saved, deleted keys are not included.
+        """
+        session = self._session
+        changed_keys = set(self._dirty_keys)
+        for key, fingerprint in self._snapshot.items():
+            if key not in changed_keys and key in session and \
+                    self._fingerprint(
+                        self._dumps(key, session[key])) != fingerprint:
+                changed_keys.add(key)
+        return changed_keys
+
+    def _track(self, key, value):
+        """
+        Fingerprints a value the first time it's read, dirty keys are
+        written anyway.
+        """
+        if isinstance(value, self._mutable_types) and \
+                key not in self._dirty_keys:
+            self._snapshot[key] = self._fingerprint(self._dumps(key, value))
+
+    def _track_all(self):
+        for key, value in list(self._loaded_items(self._session)):
+            if key not in self._snapshot:
+                self._track(key, value)
+
+    @staticmethod
+    def _loaded_items(data):
+        return data.items()
+
+    def _update_snapshot(self, data, changed_keys, deleted_keys):
+        """
+        Fingerprints the values written by a save from the bytes that were
+        written, callers may still hold and change them.
+        """
+        for key in deleted_keys:
+            self._snapshot.pop(key, None)
+        for key in changed_keys:
+            value = data[key]
+            if isinstance(value, self._mutable_types):
+                self._snapshot[key] = self._fingerprint(
+                    self._dumps(key, value))
+            else:
+                self._snapshot.pop(key, None)
+
+    def _dumps(self, key, value) -> bytes:
+        """
+        Serializes the value of ``key``, during a save the bytes are kept
+        so that checking, writing and snapshotting a value serialize it once.
+        """
+        if self._serialized is None:
+            return self.serializer.dumps(value)
+        try:
+            return self._serialized[key]
+        except KeyError:
+            serialized = self._serialized[key] = self.serializer.dumps(value)
+            return serialized
+
+    @staticmethod
+    def _fingerprint(serialized: bytes) -> bytes:
+        return hashlib.sha1(serialized).digest()
+
+    def _serialize_session(self, data) -> bytes:
+        """
+        Serializes the session, serializers with ``dumps_items`` build it
+        from the bytes of its values so values already serialized by the
+        save aren't serialized again.
+        """
+        dumps_items = getattr(self.serializer, 'dumps_items', None)
+        if dumps_items is None or self._serialized is None or \
+                not all(isinstance(key, str) for key in data):
+            return self.serializer.dumps(data)
+        return dumps_items([(key, self._dumps(key, value))
+                            for key, value in data.items()])
 
     def update(self, dict_):
+        for key, value in dict_.items():
+            if self._value_changed(key, value):
+                self._mark_dirty(key)
         self._session.update(dict_)
         self.modified = True
 
@@ -170,30 +705,91 @@ class SessionStore(object):
         return self._session.keys()
 
     def values(self):
+        self._track_all()
         return self._session.values()
 
     def items(self):
+        self._track_all()
         return self._session.items()
 
     def key_pair(self):
+        self._track_all()
         return self._session
 
+    def mapping(self) -> Mapping:
+        """
+        Read only view of the session, unlike :meth:`key_pair` values are
+        only fingerprinted when they are read through it.
+        """
+        return SessionView(self)
+
     def clear(self):
         # To avoid unnecessary persistent storage accesses, we set up the
         # internals directly (loading data wastes time, since we are going to
         # set it to an empty dict anyway).
         self._session_cache = {}
+        self._dirty_keys.clear()
+        self._deleted_keys.clear()
+        self._snapshot = {}
+        self._cleared = True
         self.accessed = True
         self.modified = True
 
-    def encode(self, session_dict):
-        """Return the given session dictionary serialized and encoded as a string."""
-        serialized = self.serializer().dumps(session_dict)
-        return base64.b64encode(serialized)
+    def encode(self, session_dict, serialized=None):
+        """
+        Return the given session dictionary serialized and encoded as bytes,
+        ``serialized`` is the dictionary already serialized.
+        """
+        if serialized is None:
+            serialized = self.serializer.dumps(session_dict)
+        format_id = getattr(self.serializer, 'format_id', None)
+        if format_id is None:
+            # original format, no header
+            return base64.b64encode(serialized)
+        return self.compress(SERIALIZER_MARKER + format_id + serialized)
+
+    def compress(self, data):
+        """
+        Compresses encoded data over ``compression_threshold`` bytes, data
+        that doesn't get smaller is returned as it is.
+        """
+        if self.compressor is None:
+            return data
+        if len(data) <= self.compression_threshold:
+            compression_stats.record(len(data))
+            return data
+        compressed = COMPRESSION_MARKER + self.compressor.codec_id + \
+            self.compressor.compress(data)
+        if len(compressed) >= len(data):
+            compression_stats.record(len(data))
+            return data
+        compression_stats.record(len(data), len(compressed))
+        return compressed
+
+    @staticmethod
+    def decompress(data):
+        if data[:1] != COMPRESSION_MARKER:
+            return data
+        codec_id = data[1:2]
+        compressor = _session_compressors[codec_id]()
+        return compressor.decompress(data[2:])
 
     def decode(self, session_data):
-        encoded_data = base64.b64decode(session_data)
-        return self.serializer().loads(encoded_data)
+        session_data = self.decompress(session_data)
+        format_id = session_data[1:2] \
+            if session_data[:1] == SERIALIZER_MARKER else None
+        same_format = getattr(self.serializer, 'format_id', None) == format_id
+        if not same_format:
+            self._stale_format = True
+
+        if format_id is None:
+            encoded_data = base64.b64decode(session_data)
+            serializer = self.serializer if same_format else JSONSerializer()
+            return serializer.loads(encoded_data)
+
+        serializer = self.serializer \
+            if same_format else _session_serializers[format_id]()
+        return serializer.loads(session_data[2:])
 
     def _get_new_session_key(self):
         "Return session key that isn't being used."
@@ -215,6 +811,7 @@ class SessionStore(object):
                 self._session_cache = {}
             else:
                 self._session_cache = self.load()
+                self._in_store = bool(self._session_cache)
         return self._session_cache
 
     @staticmethod
@@ -301,17 +898,45 @@ class SessionStore(object):
 
         If ``value`` is ``None``, the session uses the global session expiry
         policy.
+
+        Setting the expiry the session already has is a no-op, so it can be
+        set on every request without making the session dirty.
         """
+        key = ussd_airflow_variables.session_expiry
+        age_key = ussd_airflow_variables.session_expiry_age
         if value is None:
             # Remove any custom expiration for this session.
-            try:
-                del self['_session_expiry']
-            except KeyError:
-                pass
+            for expiry_key in (key, age_key):
+                try:
+                    del self[expiry_key]
+                except KeyError:
+                    pass
             return
         if isinstance(value, timedelta):
             value = datetime.now() + value
-        self[ussd_airflow_variables.session_expiry] = value
+        if isinstance(value, datetime):
+            if self.get(key) != value:
+                self[key] = value
+                self.pop(age_key, None)
+        elif self.get(age_key) != value or \
+                not isinstance(self.get(key), datetime):
+            self[key] = value
+
+    def _refresh_expiry(self):
+        """
+        Turns seconds of inactivity into the date the session expires, the
+        date moves with every write.
+        """
+        key = ussd_airflow_variables.session_expiry
+        expiry = self.get(key)
+        if isinstance(expiry, datetime):
+            expiry = self.get(ussd_airflow_variables.session_expiry_age)
+            if expiry is None:
+                # expires at a set date
+                return
+        elif expiry is not None:
+            self[ussd_airflow_variables.session_expiry_age] = expiry
+        self[key] = self.get_expiry_date(expiry=expiry)
 
     def flush(self):
         """
@@ -349,3 +974,271 @@ class SessionStore(object):
         self.save()
 
         return new_key
+
+
+class LazyFields(MutableMapping):
+    """
+    Session data of a :class:`FieldSessionStore`. Inline fields are
+    available straight away, the other fields are read from the store the
+    first time they are accessed.
+    """
+
+    def __init__(self, session_store: 'FieldSessionStore', session_key,
+                 inline=None, fields=()):
+        self.session_store = session_store
+        self.session_key = session_key
+        self.values = dict(inline or {})
+        # fields stored in their own records and not read yet
+        self.unloaded = set(fields)
+        self.fields = set(fields)
+        # time (epoch seconds) the field records expire, for stores with
+        # time to live support
+        self.fields_expiry = None
+
+    def is_loaded(self, key):
+        return key not in self.unloaded
+
+    def loaded_items(self):
+        return self.values.items()
+
+    def __getitem__(self, key):
+        if key in self.unloaded:
+            self.unloaded.discard(key)
+            try:
+                self.values[key] = self.session_store.load_field(
+                    self.session_key, key)
+            except KeyError:
+                self.fields.discard(key)
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        self.unloaded.discard(key)
+        self.values[key] = value
+
+    def __delitem__(self, key):
+        if key in self.unloaded:
+            self.unloaded.discard(key)
+        else:
+            del self.values[key]
+
+    def __contains__(self, key):
+        return key in self.values or key in self.unloaded
+
+    def __iter__(self):
+        return iter(list(self.values) + list(self.unloaded))
+
+    def __len__(self):
+        return len(self.values) + len(self.unloaded)
+
+
+class FieldSessionStore(SessionStore):
+    """
+    Session store that keeps top level keys as separate records so that a
+    request only reads the keys it uses and only writes the keys it
+    changed.
+
+    The session key holds an index record with the small values inline
+    and the names of the keys stored in their own records,
+    ``<session_key>.field.<hex encoded key>``. Values whose serialized size
+    is over ``inline_size`` bytes get their own record and are only read
+    when they are accessed, e.g large http responses saved in the session.
+
+    Works with any simplekv store. Sessions are written with
+    :class:`CompactJSONSerializer` unless ``serializer`` or
+    ``session_serializer`` is set to a serializer with a format_id.
+    """
+
+    def __init__(self, session_key=None,
+                 kv_store: KeyValueStore = None,
+                 default_session_cookie_age: int = SESSION_COOKIE_AGE,
+                 serializer=None,
+                 inline_size=None, compression=None,
+                 compression_threshold=None):
+        if serializer is None:
+            serializer = get_serializer()
+            if getattr(serializer, 'format_id', None) is None:
+                # the original format can't be split into records, sessions
+                # of this store are new so no worker reads them with the
+                # original format
+                serializer = CompactJSONSerializer
+        super(FieldSessionStore, self).__init__(
+            session_key, kv_store, default_session_cookie_age, serializer,
+            compression=compression,
+            compression_threshold=compression_threshold)
+        if getattr(self.serializer, 'format_id', None) is None:
+            raise ValueError("FieldSessionStore needs a serializer with a "
+                             "format_id")
+        self.inline_size = ussd_airflow_variables.session_inline_field_size \
+            if inline_size is None else inline_size
+
+    @staticmethod
+    def field_key(session_key, key):
+        return "{0}.field.{1}".format(
+            session_key, str(key).encode('utf-8').hex())
+
+    def load(self):
+        index = self._load_index(self.session_key)
+        if index is None:
+            return {}
+        data = LazyFields(self, self.session_key, index['inline'],
+                          index['fields'])
+        data.fields_expiry = index.get('fields_expiry')
+        return data
+
+    def _load_index(self, session_key):
+        try:
+            data = self.kv_store.get(session_key)
+        except KeyError:
+            return None
+        index = self.decode(data)
+        if 'inline' not in index:
+            # saved by SessionStore, every key is inline
+            self._stale_format = True
+            return dict(inline=index, fields=())
+        return index
+
+    def load_field(self, session_key, key):
+        data = self.decompress(
+            self.kv_store.get(self.field_key(session_key, key)))
+        value = self.decode(data)
+        if isinstance(value, self._mutable_types) and \
+                session_key == self.session_key:
+            self._snapshot[key] = self._fingerprint(data[2:])
+        return value
+
+    def _value_changed(self, key, value):
+        session = self._session
+        if isinstance(session, LazyFields) and not session.is_loaded(key):
+            # don't read a big field just to overwrite it
+            return True
+        return super(FieldSessionStore, self)._value_changed(key, value)
+
+    @staticmethod
+    def _loaded_items(data):
+        return data.loaded_items() \
+            if isinstance(data, LazyFields) else data.items()
+
+    def _save_changes(self, data, changed_keys, deleted_keys, full_write):
+        if isinstance(data, LazyFields) and \
+                data.session_key == self.session_key:
+            inline = {key: value for key, value in data.loaded_items()
+                      if key not in data.fields}
+            fields = set(data.fields)
+            fields_expiry = data.fields_expiry
+        else:
+            inline, fields = {}, set()
+            fields_expiry = None
+
+        if full_write:
+            # fields of whatever was saved under this key before
+            index = self._load_index(self.session_key)
+            stale_fields = set(index['fields']) if index else set()
+            changed_keys = set(data.keys())
+            inline, fields = {}, set()
+            fields_expiry = None
+        else:
+            stale_fields = set()
+        index_changed = full_write or bool(deleted_keys)
+
+        # field records outlive the session by one more expiry so that
+        # unchanged fields only have to be rewritten every other expiry
+        # to keep up with the index
+        field_ttl = None
+        if getattr(self.kv_store, 'ttl_support', False):
+            field_ttl = 2 * max(self.get_expiry_age(), 1)
+
+        for key in changed_keys:
+            serialized = self._dumps(key, data[key])
+            if len(serialized) > self.inline_size:
+                self._put_field(key, serialized, field_ttl)
+                if key not in fields:
+                    inline.pop(key, None)
+                    fields.add(key)
+                    stale_fields.discard(key)
+                    index_changed = True
+            else:
+                inline[key] = data[key]
+                index_changed = True
+                if key in fields:
+                    fields.discard(key)
+                    stale_fields.add(key)
+
+        for key in deleted_keys:
+            inline.pop(key, None)
+            if key in fields:
+                fields.discard(key)
+                stale_fields.add(key)
+
+        if field_ttl is not None and fields:
+            now = time.time()
+            if fields_expiry is None or \
+                    fields_expiry < now + field_ttl / 2:
+                for key in fields - changed_keys:
+                    try:
+                        value = data[key]
+                    except KeyError:
+                        # expired already
+                        continue
+                    self._put_field(key, self._dumps(key, value),
+                                    field_ttl)
+                fields_expiry = now + field_ttl
+                index_changed = True
+
+        if index_changed:
+            index = dict(inline=inline, fields=list(fields))
+            if field_ttl is not None:
+                index['fields_expiry'] = fields_expiry
+            self.put_record(self.session_key,
+                            self.encode(index, self._serialize_index(index)))
+
+        for key in stale_fields - fields:
+            self._delete_field(self.session_key, key)
+
+        if isinstance(data, LazyFields):
+            data.session_key = self.session_key
+            data.fields = fields
+            data.fields_expiry = fields_expiry
+        else:
+            self._session_cache = LazyFields(self, self.session_key,
+                                             inline, ())
+            self._session_cache.fields = fields
+            self._session_cache.fields_expiry = fields_expiry
+            self._session_cache.values.update(
+                (key, data[key]) for key in fields)
+
+    def _serialize_index(self, index):
+        """
+        Serializes the index with the inline values the save has serialized
+        already, None if the serializer can't.
+        """
+        dumps_items = getattr(self.serializer, 'dumps_items', None)
+        if dumps_items is None:
+            return None
+        return dumps_items([
+            (key, self._serialize_session(value) if key == 'inline'
+             else self.serializer.dumps(value))
+            for key, value in index.items()])
+
+    def _put_field(self, key, serialized, ttl_secs):
+        self.put_record(
+            self.field_key(self.session_key, key),
+            self.compress(
+                SERIALIZER_MARKER + self.serializer.format_id + serialized),
+            ttl_secs)
+
+    def _delete_field(self, session_key, key):
+        try:
+            self.kv_store.delete(self.field_key(session_key, key))
+        except KeyError:
+            pass
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        index = self._load_index(session_key)
+        if index is not None:
+            for key in index['fields']:
+                self._delete_field(session_key, key)
+        self.kv_store.delete(session_key)
@@ -9,7 +9,12 @@ For ussd session each session has its own record and all users use the same jour
 
 users ussd session store
 ========================
-comming soon
+
+.. automodule:: ussd.store.session_store
+
+.. autoclass:: ussd.store.session_store.MemoryStore.MemoryStore
+
+.. autoclass:: ussd.store.session_store.ShardedFilesystemStore.ShardedFilesystemStore
 
 
 Customer journey store
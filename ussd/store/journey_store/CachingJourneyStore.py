@@ -0,0 +1,95 @@
+from copy import deepcopy
+from ussd.store.journey_store import JourneyStore
+from ussd.utils.cache import TTLCache
+from ussd import defaults as ussd_airflow_variables
+
+
+# cache key for the latest version of a journey, (name, _LATEST_VERSION)
+_LATEST_VERSION = object()
+
+
+class CachingJourneyStore(JourneyStore):
+    """
+    Read through cache that can wrap any other journey store.
+
+    Whole journeys are kept in memory per (name, version) and screens are
+    served from the cached journey, so a request that goes through several
+    screens reads the journey from the backend at most once.
+
+    Entries expire after ``ttl`` seconds, at most ``maxsize`` journeys are
+    kept. Saving or deleting a journey through this store drops its cached
+    versions, journeys changed by other processes are picked up once the
+    ttl runs out. Journeys in edit mode are never cached. Callers get copies
+    of the cached journeys so changing them doesn't change the cache.
+
+    .. code-block:: python
+
+        journey_store = CachingJourneyStore(DynamoDb("journeys"), ttl=60)
+    """
+
+    def __init__(self, store: JourneyStore, ttl=None, maxsize=None):
+        self.store = store
+        self.cache = TTLCache(
+            ussd_airflow_variables.journey_cache_size
+            if maxsize is None else maxsize,
+            ussd_airflow_variables.journey_cache_ttl if ttl is None else ttl
+        )
+
+    @property
+    def cache_key(self):
+        return self.store.cache_key
+
+    def _get(self, name, version, screen_name, **kwargs):
+        if version == self.edit_mode_version:
+            return self.store.get(name, version, screen_name,
+                                  propagate_error=False)
+
+        journey = self.cache.get((name, version))
+        if journey is None:
+            journey = self.store.get(name, version, propagate_error=False)
+            if journey is None:
+                return None
+            self.cache.set((name, version), journey)
+
+        if screen_name is not None:
+            journey = journey.get(screen_name)
+        return deepcopy(journey)
+
+    def _get_latest_version(self, name):
+        version = self.cache.get((name, _LATEST_VERSION))
+        if version is None:
+            version = self.store.get_latest_version(name)
+            if version is not None:
+                self.cache.set((name, _LATEST_VERSION), version)
+        return version
+
+    def _all(self):
+        return self.store.all()
+
+    def _save(self, name, journey, version):
+        # save has validated the journey, the store doesn't do it again
+        results = self.store._save(name, journey, version)
+        self.invalidate(name)
+        return results
+
+    def _delete(self, name, version=None):
+        results = self.store.delete(name, version)
+        self.invalidate(name)
+        return results
+
+    def _get_all_journey_version(self, name):
+        return self.store.get_all_journey_version(name)
+
+    def flush(self):
+        self.cache.clear()
+        return self.store.flush()
+
+    def invalidate(self, name=None):
+        """
+        Drops cached versions of the journey, or every journey if name
+        is not given. The latest version is cached under version ``None``
+        so that goes as well.
+        """
+        for key in self.cache.keys():
+            if name is None or key[0] == name:
+                self.cache.pop(key)
@@ -1,4 +1,4 @@
-from ..journey_store import JourneyStore
+from ..journey_store import JourneyStore, version_sort_key
 from collections import OrderedDict
 
 store = OrderedDict()
@@ -15,12 +15,16 @@ class DummyStore(JourneyStore):
             store[user] = {}
         self.store = store[user]
             
+    @property
+    def cache_key(self):
+        return self.__class__.__name__, self.user
+
     def _get(self, name, version, screen_name, **kwargs):
         if version == 'edit_mode':
             return self.store.get('edit_mode', {}).get(name)
         if self.store.get(name):
-            if version is None:  # get the latest journey created
-                journey = self.store[name][next(reversed(self.store[name]))]
+            if version is None:
+                journey = self.store[name][self._get_latest_version(name)]
             else:
                 journey = self.store[name].get(version)
             if screen_name is not None:
@@ -28,6 +32,11 @@ class DummyStore(JourneyStore):
             return journey
         return None
 
+    def _get_latest_version(self, name):
+        if self.store.get(name):
+            return max(self.store[name], key=version_sort_key)
+        return None
+
     def _get_all_journey_version(self, name):
         return self.store.get(name, {})
 
@@ -1,9 +1,10 @@
-from ..journey_store import JourneyStore
+from ..journey_store import JourneyStore, version_sort_key
 import boto3
 from structlog import get_logger
 from botocore.config import Config
+from botocore.exceptions import ClientError
 from copy import deepcopy
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.conditions import Attr, Key
 import os
 
 BOTO_CORE_CONFIG = os.environ.get('BOTO_CORE_CONFIG', None)
@@ -106,15 +107,34 @@ def append_dynamo_key_with_user(func):
 
 
 class DynamoDb(JourneyStore):
+    """
+    Stores each journey version as an item, keyed on the user and
+    ``<journey>#<version>#``.
+
+    The latest version of each journey is kept in a small pointer item,
+    ``#latest#<journey>#``, so finding it is a single read however many
+    versions there are. Pointer items are updated by :meth:`save` and
+    :meth:`delete`, journeys saved before pointers existed get one the
+    first time their latest version is looked up. Pointers are only written
+    if they still hold the version that was read, when another writer moved
+    it in between the update is worked out again.
+    """
     edit_mode_version = "-1"
     hash_key = "username"
     sort_key = "journeyAndVersion"
+    latest_version_prefix = "#latest#"
+    latest_version_attribute = "latestVersion"
+    latest_version_update_attempts = 5
 
     def __init__(self, table_name, endpoint=None, user="default"):
         self.table_name = table_name
         self.table = dynamodb_table(table_name, endpoint=endpoint)
         self.user = user
 
+    @property
+    def cache_key(self):
+        return self.__class__.__name__, self.table_name, self.user
+
     @staticmethod
     def _sort_key_journey(name):
         return "{0}#".format(name)
@@ -126,26 +146,45 @@ class DynamoDb(JourneyStore):
     def _generate_sort_key(self, name, version):
         return "{0}{1}".format(self._sort_key_journey(name), self._sort_key_version(version))
 
+    @staticmethod
+    def _projection(*attributes):
+        """
+        ProjectionExpression for the attributes, going through
+        ExpressionAttributeNames so that screen names that are DynamoDb
+        reserved words (e.g "name", "data") or contain special
+        characters can be projected.
+        """
+        names = {"#p{0}".format(index): attribute
+                 for index, attribute in enumerate(attributes)}
+        return dict(
+            ProjectionExpression=", ".join(names),
+            ExpressionAttributeNames=names
+        )
+
+    def _latest_version_key(self, name):
+        return {
+            self.hash_key: self.user,
+            self.sort_key: "{0}{1}".format(self.latest_version_prefix,
+                                           self._sort_key_journey(name))
+        }
+
     def _get(self, name, version, screen_name, **kwargs):
         screen_kwarg = {}
         if screen_name is not None:
-            screen_kwarg["ProjectionExpression"] = screen_name
+            screen_kwarg = self._projection(screen_name)
 
         if version is None:
-            response = self.table.query(
-                KeyConditionExpression=Key(self.hash_key).eq(self.user) &
-                                       Key(self.sort_key).begins_with(self._sort_key_journey(name)),
-                **kwargs
-            )
-            item = response.get("Items")[-1]
-        else:
-            key = {
-                self.hash_key: self.user,
-                self.sort_key: self._generate_sort_key(name, version)
-            }
+            version = self._get_latest_version(name)
+            if version is None:
+                return None
+
+        key = {
+            self.hash_key: self.user,
+            self.sort_key: self._generate_sort_key(name, version)
+        }
 
-            response = self.table.get_item(Key=key, **screen_kwarg)
-            item = response.get('Item')
+        response = self.table.get_item(Key=key, **screen_kwarg)
+        item = response.get('Item')
 
         if item:
             if item.get(self.hash_key):
@@ -157,6 +196,77 @@ class DynamoDb(JourneyStore):
                 item = item.get(screen_name)
         return item or None
 
+    def _read_latest_version(self, name, consistent=False):
+        response = self.table.get_item(
+            Key=self._latest_version_key(name),
+            ConsistentRead=consistent,
+            **self._projection(self.latest_version_attribute)
+        )
+        item = response.get('Item')
+        return item[self.latest_version_attribute] if item else None
+
+    def _get_latest_version(self, name):
+        version = self._read_latest_version(name)
+        if version is not None:
+            return version
+
+        version = self._find_latest_version(name)
+        if version is not None:
+            version = self._update_latest_version(
+                name, lambda current: self._higher_version(current, version))
+        return version
+
+    @staticmethod
+    def _higher_version(current, version):
+        if current is None or \
+                version_sort_key(version) > version_sort_key(current):
+            return version
+        return current
+
+    def _find_latest_version(self, name):
+        versions = [
+            i[self.sort_key].split("#")[1]
+            for i in self._query(name, **self._projection(self.sort_key))
+        ]
+        versions = [i for i in versions if i != self.edit_mode_version]
+        return max(versions, key=version_sort_key) if versions else None
+
+    def _update_latest_version(self, name, update):
+        """
+        Points the latest version of the journey to ``update(current)``,
+        ``current`` being the version the pointer has, ``None`` removes the
+        pointer. The write is conditional on the pointer being unchanged and
+        retried with the new pointer when it was moved.
+        """
+        key = self._latest_version_key(name)
+        for attempt in range(self.latest_version_update_attempts):
+            current = self._read_latest_version(name, consistent=True)
+            version = update(current)
+            if version == current:
+                return version
+
+            if current is None:
+                condition = Attr(self.latest_version_attribute).not_exists()
+            else:
+                condition = Attr(self.latest_version_attribute).eq(current)
+            try:
+                if version is None:
+                    self.table.delete_item(Key=key,
+                                           ConditionExpression=condition)
+                else:
+                    item = dict(key)
+                    item[self.latest_version_attribute] = version
+                    self.table.put_item(Item=item,
+                                        ConditionExpression=condition)
+                return version
+            except ClientError as e:
+                if e.response['Error']['Code'] != \
+                        'ConditionalCheckFailedException' or \
+                        attempt == self.latest_version_update_attempts - 1:
+                    raise
+                logger.debug("latest_version_moved", journey=name,
+                             version=current)
+
     def _get_all_journey_version(self, name):
         results = {}
         for i in self._query(name):
@@ -167,12 +277,20 @@ class DynamoDb(JourneyStore):
         return results
 
     def _query(self, name, **kwargs):
-        response = self.table.query(
+        return self._query_all_pages(
             KeyConditionExpression=Key(self.hash_key).eq(self.user) &
                                    Key(self.sort_key).begins_with(self._sort_key_journey(name)),
             **kwargs
         )
-        return response.get('Items')
+
+    def _query_all_pages(self, **kwargs):
+        items = []
+        while True:
+            response = self.table.query(**kwargs)
+            items.extend(response.get('Items', []))
+            if not response.get('LastEvaluatedKey'):
+                return items
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
 
     def _save(self, name, journey, version):
         item = {
@@ -185,6 +303,10 @@ class DynamoDb(JourneyStore):
             Item=item
         )
 
+        if version != self.edit_mode_version:
+            self._update_latest_version(
+                name, lambda current: self._higher_version(current, version))
+
     def _delete(self, name, version=None):
         items = [
             {
@@ -194,7 +316,7 @@ class DynamoDb(JourneyStore):
         ]
         if version is None:
             items = self._query(name,
-                                **{"ProjectionExpression": "{0}, {1}".format(self.hash_key, self.sort_key)})
+                                **self._projection(self.hash_key, self.sort_key))
 
         with self.table.batch_writer() as batch:
             for i in items:
@@ -205,13 +327,22 @@ class DynamoDb(JourneyStore):
                     }
                 )
 
+        if version is None:
+            self.table.delete_item(Key=self._latest_version_key(name))
+        elif version != self.edit_mode_version:
+            self._update_latest_version(
+                name, lambda current: self._find_latest_version(name)
+                if current in (None, version) else current)
+
     def _all(self):
-        response = self.table.query(
+        items = self._query_all_pages(
             KeyConditionExpression=Key(self.hash_key).eq(self.user)
         )
 
         results = dict()
-        for i in response.get('Items'):
+        for i in items:
+            if i[self.sort_key].startswith(self.latest_version_prefix):
+                continue
             name, version, others = i[self.sort_key].split("#")
 
             if not results.get(name):
@@ -224,6 +355,20 @@ class DynamoDb(JourneyStore):
         return results
 
     def flush(self):
-        all_records = self.table.scan()
-        for i in all_records['Items']:
-            self._delete(i[self.hash_key], i[self.sort_key])
+        # delete the raw items of this user, pointer items included
+        query_kwargs = self._projection(self.hash_key, self.sort_key)
+        query_kwargs['KeyConditionExpression'] = \
+            Key(self.hash_key).eq(self.user)
+        with self.table.batch_writer() as batch:
+            while True:
+                response = self.table.query(**query_kwargs)
+                for i in response['Items']:
+                    batch.delete_item(
+                        Key={
+                            self.hash_key: i[self.hash_key],
+                            self.sort_key: i[self.sort_key]
+                        }
+                    )
+                if not response.get('LastEvaluatedKey'):
+                    break
+                query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
@@ -1,4 +1,4 @@
-from ussd.store.journey_store import JourneyStore
+from ussd.store.journey_store import JourneyStore, version_sort_key
 import os
 import yaml
 from jinja2 import Template, Environment
@@ -63,6 +63,10 @@ def load_yaml(file_path) -> dict:
     return staticconf.config.configuration_namespaces[file_path].configuration_values
 
 
+# journey directory -> (directory mtime, versions sorted oldest first)
+_version_index = {}
+
+
 class YamlJourneyStore(JourneyStore):
     """
     Loader used for loading and using journeys in a yaml file
@@ -76,6 +80,10 @@ class YamlJourneyStore(JourneyStore):
         if not os.path.isdir(self.journey_directory):
             os.makedirs(self.journey_directory)
 
+    @property
+    def cache_key(self):
+        return self.__class__.__name__, self.journey_directory
+
     def _get_or_create_directory(self, name):
         directory = self._get_directory(name)
         if not os.path.isdir(directory):
@@ -89,14 +97,39 @@ class YamlJourneyStore(JourneyStore):
         return os.path.join(self._get_directory(name),
                             "{0}.yml".format(version))
 
+    def _get_versions(self, name):
+        """
+        Versions of the journey, oldest first. The directory is only listed
+        again when its mtime changes, saving or deleting through the store
+        drops the index as well in case the mtime resolution is too coarse
+        to notice.
+        """
+        directory = self._get_directory(name)
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            return ()
+
+        index = _version_index.get(directory)
+        if index is None or index[0] != mtime:
+            versions = tuple(sorted(
+                (i.replace(".yml", "") for i in os.listdir(directory)
+                 if i.endswith(".yml") and
+                 i.replace(".yml", "") != self.edit_mode_version),
+                key=version_sort_key
+            ))
+            index = _version_index[directory] = (mtime, versions)
+        return index[1]
+
+    def _get_latest_version(self, name):
+        versions = self._get_versions(name)
+        return versions[-1] if versions else None
+
     def _get(self, name, version, screen_name, **kwargs):
         if version is None:
-            files = os.listdir(self._get_directory(name))
-            files.sort()
-            version = files[-1]
-            if version.replace(".yml", "") == self.edit_mode_version:
-                version = files[-2]
-            version = version.replace(".yml", "")
+            version = self._get_latest_version(name)
+            if version is None:
+                return None
 
         file_path = self._get_file_path(name, version)
         if not os.path.isfile(file_path):
@@ -129,6 +162,7 @@ class YamlJourneyStore(JourneyStore):
         self._get_or_create_directory(name)
         with open(file_path, 'w') as outfile:
             yaml.dump(journey, outfile, default_flow_style=False)
+        _version_index.pop(self._get_directory(name), None)
 
     def _all(self):
         results = {}
@@ -146,6 +180,10 @@ class YamlJourneyStore(JourneyStore):
             self._delete_folder(directory)
         else:
             os.remove(self._get_file_path(name, version))
+        _version_index.pop(directory, None)
 
     def flush(self):
         self._delete_folder(self.journey_directory)
+        for directory in list(_version_index):
+            if directory.startswith(self.journey_directory + os.sep):
+                _version_index.pop(directory, None)
@@ -4,16 +4,48 @@ Any engine that implements this interface can be integrated with journey store.
 """
 import abc
 import inspect
+import re
 from copy import deepcopy
 from ussd.utils.module_loading import import_string
 import typing
 from marshmallow.exceptions import ValidationError
 
 
+_version_part_re = re.compile(r'(\d+)|([^\W\d_]+)')
+
+
+def _version_parts(text):
+    return tuple(
+        (1, int(number), '') if number else (0, 0, word)
+        for number, word in _version_part_re.findall(text)
+    )
+
+
+def version_sort_key(version):
+    """
+    Sort key that orders versions the way people read them, numbers are
+    compared as numbers ("0.0.10" comes after "0.0.9") and pre-releases
+    come before the release ("1.0.0-rc1" comes before "1.0.0").
+    Build metadata ("+build.1") is ignored.
+    """
+    version = str(version).split('+', 1)[0]
+    release, _, pre_release = version.partition('-')
+    return (_version_parts(release),
+            (0, _version_parts(pre_release)) if pre_release else (1,))
+
+
 class JourneyStore(object, metaclass=abc.ABCMeta):
 
     edit_mode_version = "edit_mode"
 
+    @property
+    def cache_key(self):
+        """
+        Identifies the journeys this store reads from, stores pointing at
+        the same journeys can share compiled journeys.
+        """
+        return self
+
     @abc.abstractmethod
     def _get(self, name, version, screen_name, **kwargs):
         pass
@@ -54,6 +86,20 @@ class JourneyStore(object, metaclass=abc.ABCMeta):
     def get_all_journey_version(self, name):
         return self._get_all_journey_version(name)
 
+    def get_latest_version(self, name):
+        """
+        Returns the version that :meth:`get` uses when no version is given,
+        None if the journey does not exist.
+        """
+        return self._get_latest_version(name)
+
+    def _get_latest_version(self, name):
+        # stores should override this with something cheaper
+        versions = [version
+                    for version in self._get_all_journey_version(name)
+                    if version != self.edit_mode_version]
+        return max(versions, key=version_sort_key) if versions else None
+
     def save(self, name: str, journey: dict, version=None, edit_mode=False):
 
         # version and editor mode should not be false
@@ -76,10 +122,18 @@ class JourneyStore(object, metaclass=abc.ABCMeta):
                 raise ValidationError(errors, "journey")
 
         # now create journey
-        return self._save(name, journey, version)
+        results = self._save(name, journey, version)
+        self._invalidate_compiled_journey(name, version)
+        return results
 
     def delete(self, name, version=None):
-        return self._delete(name, version)
+        results = self._delete(name, version)
+        self._invalidate_compiled_journey(name, version)
+        return results
+
+    def _invalidate_compiled_journey(self, name, version=None):
+        from ussd.core import CompiledJourney
+        CompiledJourney.invalidate(self, name, version)
 
 
 class JourneyStoreApi(object):
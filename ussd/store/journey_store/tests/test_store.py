@@ -1,7 +1,10 @@
+import os
 from copy import deepcopy
 from ussd.core import UssdEngine
-from ussd.store.journey_store import DummyStore, DynamoDb, YamlJourneyStore
-from unittest import TestCase
+from ussd.store.journey_store import DummyStore, DynamoDb, YamlJourneyStore, \
+    CachingJourneyStore, version_sort_key
+from unittest import TestCase, mock
+from botocore.exceptions import ClientError
 from marshmallow.exceptions import ValidationError
 
 
@@ -118,6 +121,49 @@ class TestDriverStore:
             self.driver.delete('journey_a')
             self.assertEqual(len(self.driver.get_all_journey_version('journey_a')), 0)
 
+        def test_getting_latest_version(self):
+            sample_journey = {
+                "initial_screen": {
+                    "type": "initial_screen",
+                    "next_screen": "end_screen",
+                    "default_language": "en"
+                },
+                "end_screen": {
+                    "type": "quit_screen",
+                    "text": "end screen"
+                }
+            }
+            self.assertIsNone(self.driver.get_latest_version("journey_d"))
+
+            self.driver.save(name="journey_d", journey=sample_journey, version="0.0.1")
+            self.driver.save(name="journey_d", journey=sample_journey, version="0.0.2")
+            self.driver.save(name="journey_d", journey=sample_journey, edit_mode=True)
+
+            self.assertEqual("0.0.2", self.driver.get_latest_version("journey_d"))
+
+            self.driver.delete("journey_d", version="0.0.2")
+            self.assertEqual("0.0.1", self.driver.get_latest_version("journey_d"))
+
+            self.driver.delete("journey_d")
+
+        def test_latest_version_is_ordered_numerically(self):
+            journey = {
+                "initial_screen": {
+                    "type": "initial_screen",
+                    "next_screen": "end_screen",
+                    "default_language": "en"
+                },
+                "end_screen": {
+                    "type": "quit_screen",
+                    "text": "end screen"
+                }
+            }
+            self.driver.save(name="journey_e", journey=journey, version="0.0.10")
+            self.driver.save(name="journey_e", journey=journey, version="0.0.9")
+            self.assertEqual("0.0.10", self.driver.get_latest_version("journey_e"))
+
+            self.driver.delete("journey_e")
+
         def test_saving_journeys_thats_still_in_edit_mode(self):
             sample_journey = {
                 "initial_screen": {
@@ -323,3 +369,175 @@ class TestYamlJourneyStore(TestDriverStore.BaseDriverStoreTestCase):
     @staticmethod
     def setup_driver(user="default") -> YamlJourneyStore:
         return YamlJourneyStore.YamlJourneyStore(user=user)
+
+    def test_versions_added_outside_the_store_are_picked_up(self):
+        journey = {
+            "initial_screen": {
+                "type": "initial_screen",
+                "next_screen": "end_screen",
+                "default_language": "en"
+            },
+            "end_screen": {
+                "type": "quit_screen",
+                "text": "end screen"
+            }
+        }
+        self.driver.save(name="journey_e", journey=journey, version="0.0.10")
+        self.assertEqual("0.0.10", self.driver.get_latest_version("journey_e"))
+
+        with open(self.driver._get_file_path("journey_e", "0.1.0"), "w") as f:
+            f.write("{}")
+        os.utime(self.driver._get_directory("journey_e"), ns=(0, 0))
+        self.assertEqual("0.1.0", self.driver.get_latest_version("journey_e"))
+
+
+class TestDynamodbProjection(TestCase):
+
+    def test_reserved_words_are_aliased(self):
+        self.assertEqual(
+            dict(ProjectionExpression="#p0, #p1",
+                 ExpressionAttributeNames={"#p0": "name", "#p1": "data"}),
+            DynamoDb.DynamoDb._projection("name", "data")
+        )
+
+
+class TestDynamodbLatestVersion(TestCase):
+
+    def setUp(self):
+        with mock.patch.object(DynamoDb, "dynamodb_table"):
+            self.driver = DynamoDb.DynamoDb("journeys", user="default")
+        self.table = self.driver.table
+
+    def pointer(self, *versions):
+        self.table.get_item.side_effect = [
+            {"Item": {"latestVersion": version}} if version else {}
+            for version in versions
+        ]
+
+    def test_pointer_is_only_moved_from_the_version_read(self):
+        self.pointer("0.0.1")
+        self.assertEqual("0.0.2", self.driver._update_latest_version(
+            "journey_a", lambda current: "0.0.2"))
+        condition = self.table.put_item.call_args[1]["ConditionExpression"]
+        self.assertEqual(("latestVersion", "0.0.1"),
+                         tuple(getattr(value, "name", value)
+                               for value in condition.get_expression()["values"]))
+
+    def test_moved_pointers_are_updated_again(self):
+        # another writer saved 0.0.3 after the pointer was read
+        self.pointer("0.0.1", "0.0.3")
+        self.table.put_item.side_effect = [
+            None,
+            ClientError({"Error": {"Code": "ConditionalCheckFailedException"}},
+                        "PutItem"),
+        ]
+        self.driver._save("journey_a", {}, "0.0.2")
+        # the pointer was read again and left on the higher version
+        self.assertEqual(2, self.table.get_item.call_count)
+        self.assertEqual(2, self.table.put_item.call_count)
+
+    def test_flush_only_deletes_the_users_items(self):
+        self.table.query.return_value = {"Items": []}
+        self.driver.flush()
+        self.table.scan.assert_not_called()
+        condition = self.table.query.call_args[1]["KeyConditionExpression"]
+        self.assertEqual("default", condition.get_expression()["values"][1])
+
+
+class TestVersionSortKey(TestCase):
+
+    def test_ordering(self):
+        versions = ["1.0.0", "0.0.9", "1.0.0-rc10", "0.0.10", "1.0.0-rc2",
+                    "1.0.0-beta", "2", "0.10.0+build.5"]
+        self.assertEqual(
+            ["0.0.9", "0.0.10", "0.10.0+build.5", "1.0.0-beta", "1.0.0-rc2",
+             "1.0.0-rc10", "1.0.0", "2"],
+            sorted(versions, key=version_sort_key)
+        )
+
+
+class TestCachingJourneyStore(TestDriverStore.BaseDriverStoreTestCase):
+
+    journey = {
+        "initial_screen": {
+            "type": "initial_screen",
+            "next_screen": "end_screen",
+            "default_language": "en"
+        },
+        "end_screen": {
+            "type": "quit_screen",
+            "text": "end screen"
+        }
+    }
+
+    @staticmethod
+    def setup_driver(user="default") -> CachingJourneyStore:
+        return CachingJourneyStore.CachingJourneyStore(
+            DummyStore.DummyStore(user="caching_{}".format(user)))
+
+    def tearDown(self):
+        self.driver.delete("journey_c")
+        super(TestCachingJourneyStore, self).tearDown()
+
+    def test_journey_is_read_once(self):
+        self.driver.save(name="journey_c", journey=self.journey, version="0.0.1")
+
+        with mock.patch.object(self.driver.store, "_get",
+                               wraps=self.driver.store._get) as backend_get:
+            for screen in ("initial_screen", "end_screen", "end_screen"):
+                self.assertEqual(
+                    self.journey[screen],
+                    self.driver.get("journey_c", "0.0.1", screen_name=screen))
+            self.assertEqual(self.journey, self.driver.get("journey_c", "0.0.1"))
+
+        backend_get.assert_called_once_with("journey_c", "0.0.1", None)
+
+    def test_cached_journeys_are_not_shared(self):
+        self.driver.save(name="journey_c", journey=self.journey, version="0.0.1")
+
+        journey = self.driver.get("journey_c", "0.0.1")
+        journey["end_screen"]["text"] = "changed"
+        self.driver.get("journey_c", "0.0.1",
+                        screen_name="end_screen")["text"] = "changed"
+        self.assertEqual(self.journey, self.driver.get("journey_c", "0.0.1"))
+
+    def test_saving_and_deleting_invalidates(self):
+        self.driver.save(name="journey_c", journey=self.journey, version="0.0.1")
+        self.assertEqual(self.journey, self.driver.get("journey_c"))
+
+        journey_two = deepcopy(self.journey)
+        journey_two['end_screen']['text'] = "end screen two"
+        self.driver.save(name="journey_c", journey=journey_two, version="0.0.2")
+        self.assertEqual(journey_two, self.driver.get("journey_c"))
+
+        self.driver.delete("journey_c", "0.0.2")
+        self.assertEqual(self.journey, self.driver.get("journey_c"))
+
+    def test_entries_expire(self):
+        now = [0]
+        self.driver.cache.timer = lambda: now[0]
+        self.driver.cache.ttl = 10
+        self.driver.save(name="journey_c", journey=self.journey, version="0.0.1")
+        self.driver.get("journey_c", "0.0.1")
+
+        # changed behind the cache's back
+        journey_two = deepcopy(self.journey)
+        journey_two['end_screen']['text'] = "end screen two"
+        self.driver.store._save("journey_c", journey_two, "0.0.1")
+
+        now[0] = 9
+        self.assertEqual(self.journey, self.driver.get("journey_c", "0.0.1"))
+
+        now[0] = 10
+        self.assertEqual(journey_two, self.driver.get("journey_c", "0.0.1"))
+
+    def test_max_size(self):
+        driver = CachingJourneyStore.CachingJourneyStore(
+            self.driver.store, maxsize=1)
+        driver.save(name="journey_c", journey=self.journey, version="0.0.1")
+        driver.save(name="journey_c", journey=self.journey, version="0.0.2")
+
+        driver.get("journey_c", "0.0.1")
+        driver.get("journey_c", "0.0.2")
+        self.assertEqual(1, len(driver.cache))
+        self.assertEqual(1, driver.cache.evictions)
@@ -0,0 +1,184 @@
+"""
+In process session store for single node deployments.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+from simplekv import KeyValueStore, TimeToLiveMixin, FOREVER, NOT_SET
+
+
+class _Shard(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> (data, expires_at), least recently used first
+        self.entries = OrderedDict()
+
+
+class MemoryStore(TimeToLiveMixin, KeyValueStore):
+    """
+    Keeps records in memory with a time to live per key.
+
+    Keys are spread over ``shards`` lock stripes so threads working on
+    different sessions rarely wait for each other. Each shard is a least
+    recently used list holding at most ``maxsize / shards`` records, when
+    it is full the least recently used record is evicted. Expired records
+    are never returned and a background thread removes them every
+    ``eviction_interval`` seconds, ``None`` disables the thread and leaves
+    the clean up to :meth:`evict_expired`.
+
+    The thread is started on the first write of each process, so a store
+    created before gunicorn forks its workers works in every worker.
+    Records are not shared between processes, use one worker process with
+    threads or a shared store when sessions can hit any worker.
+    """
+
+    def __init__(self, maxsize=None, default_ttl_secs=NOT_SET,
+                 shards=16, eviction_interval=60, timer=time.monotonic):
+        if maxsize is not None and maxsize < shards:
+            raise ValueError("maxsize should be at least the number of "
+                             "shards ({0})".format(shards))
+        self.maxsize = maxsize
+        self.shard_maxsize = None if maxsize is None else maxsize // shards
+        self.default_ttl_secs = default_ttl_secs
+        self.eviction_interval = eviction_interval
+        self.timer = timer
+        self.evictions = 0
+        self.expired = 0
+        self._shards = [_Shard() for _ in range(shards)]
+        self._thread_lock = threading.Lock()
+        self._evictor = None
+        self._evictor_pid = None
+        self._stopped = threading.Event()
+
+    def _get_shard(self, key) -> _Shard:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _expires_at(self, ttl_secs):
+        if ttl_secs in (FOREVER, NOT_SET):
+            return None
+        return self.timer() + ttl_secs
+
+    def _is_expired(self, expires_at, now):
+        return expires_at is not None and expires_at <= now
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self._shards)
+
+    def _get(self, key):
+        shard = self._get_shard(key)
+        with shard.lock:
+            data, expires_at = shard.entries[key]
+            if self._is_expired(expires_at, self.timer()):
+                del shard.entries[key]
+                self.expired += 1
+                raise KeyError(key)
+            shard.entries.move_to_end(key)
+            return data
+
+    def _open(self, key):
+        return BytesIO(self._get(key))
+
+    def _get_file(self, key, file):
+        file.write(self._get(key))
+
+    def _has_key(self, key):
+        try:
+            self._get(key)
+        except KeyError:
+            return False
+        return True
+
+    def _put(self, key, data, ttl_secs):
+        self._start_evictor()
+        shard = self._get_shard(key)
+        expires_at = self._expires_at(ttl_secs)
+        with shard.lock:
+            shard.entries[key] = (data, expires_at)
+            shard.entries.move_to_end(key)
+            if self.shard_maxsize is not None:
+                while len(shard.entries) > self.shard_maxsize:
+                    shard.entries.popitem(last=False)
+                    self.evictions += 1
+        return key
+
+    def _put_file(self, key, file, ttl_secs):
+        return self._put(key, file.read(), ttl_secs)
+
+    def _delete(self, key):
+        shard = self._get_shard(key)
+        with shard.lock:
+            shard.entries.pop(key, None)
+
+    def iter_keys(self, prefix=u""):
+        now = self.timer()
+        for shard in self._shards:
+            with shard.lock:
+                keys = [key for key, (_, expires_at) in shard.entries.items()
+                        if key.startswith(prefix) and
+                        not self._is_expired(expires_at, now)]
+            for key in keys:
+                yield key
+
+    def evict_expired(self) -> int:
+        """
+        Removes expired records and returns how many were removed.
+        """
+        removed = 0
+        for shard in self._shards:
+            now = self.timer()
+            with shard.lock:
+                expired = [key for key, (_, expires_at)
+                           in shard.entries.items()
+                           if self._is_expired(expires_at, now)]
+                for key in expired:
+                    del shard.entries[key]
+            removed += len(expired)
+        self.expired += removed
+        return removed
+
+    def clear(self):
+        for shard in self._shards:
+            with shard.lock:
+                shard.entries.clear()
+
+    def stats(self) -> dict:
+        return dict(
+            size=len(self),
+            maxsize=self.maxsize,
+            evictions=self.evictions,
+            expired=self.expired
+        )
+
+    def _start_evictor(self):
+        if self.eviction_interval is None or \
+                self._evictor_pid == os.getpid():
+            return
+        with self._thread_lock:
+            if self._evictor_pid == os.getpid():
+                return
+            self._stopped.clear()
+            self._evictor = threading.Thread(
+                target=self._run_evictor,
+                name="MemoryStore-evictor",
+                daemon=True
+            )
+            self._evictor.start()
+            self._evictor_pid = os.getpid()
+
+    def _run_evictor(self):
+        while not self._stopped.wait(self.eviction_interval):
+            self.evict_expired()
+
+    def close(self):
+        """
+        Stops the background eviction thread.
+        """
+        self._stopped.set()
+        evictor, self._evictor = self._evictor, None
+        self._evictor_pid = None
+        if evictor is not None and evictor is not threading.current_thread():
+            evictor.join()
@@ -0,0 +1,193 @@
+"""
+File per session store that spreads the files over nested directories.
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import uuid
+
+from simplekv import KeyValueStore, VALID_KEY_RE
+from simplekv.fs import FilesystemStore
+
+
+class ShardedFilesystemStore(FilesystemStore):
+    """
+    :class:`~simplekv.fs.FilesystemStore` that keeps every record in
+    ``levels`` nested directories named after the md5 of the key, ``width``
+    hex characters each. With the defaults a key is saved in
+    ``<root>/ab/cd/<key>``, so no directory holds more than a small share
+    of the sessions.
+
+    Writes go to a temporary file that is renamed over the record, readers
+    see either the old or the new session, never a partial one. Set
+    ``fsync`` to flush the temporary file to disk before the rename.
+
+    ``flat_fallback`` also reads records from ``<root>/<key>``, the layout
+    of a plain ``FilesystemStore``, so the store can be switched to before
+    :func:`migrate_flat_directory` has moved every record.
+    """
+
+    tmp_directory = '.tmp'
+
+    def __init__(self, root, levels=2, width=2, fsync=False,
+                 flat_fallback=False, **kwargs):
+        super(ShardedFilesystemStore, self).__init__(root, **kwargs)
+        self.levels = levels
+        self.width = width
+        self.fsync = fsync
+        self.flat_fallback = flat_fallback
+
+    def shard(self, key) -> list:
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+        return [digest[level * self.width:(level + 1) * self.width]
+                for level in range(self.levels)]
+
+    def _build_filename(self, key):
+        return os.path.abspath(
+            os.path.join(self.root, *(self.shard(key) + [key])))
+
+    def _build_flat_filename(self, key):
+        return os.path.abspath(os.path.join(self.root, key))
+
+    def _open(self, key):
+        try:
+            return super(ShardedFilesystemStore, self)._open(key)
+        except KeyError:
+            if not self.flat_fallback:
+                raise
+        try:
+            return open(self._build_flat_filename(key), 'rb')
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def _has_key(self, key):
+        return os.path.exists(self._build_filename(key)) or \
+            self.flat_fallback and \
+            os.path.isfile(self._build_flat_filename(key))
+
+    def _delete(self, key):
+        # shard directories are kept, removing them would race with
+        # writers creating files in them
+        paths = [self._build_filename(key)]
+        if self.flat_fallback:
+            paths.append(self._build_flat_filename(key))
+        for path in paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def _put_file(self, key, file):
+        target = self._build_filename(key)
+        self._ensure_dir_exists(os.path.dirname(target))
+        tmp_directory = os.path.join(self.root, self.tmp_directory)
+        self._ensure_dir_exists(tmp_directory)
+        tmp_path = os.path.join(tmp_directory, uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'wb') as tmp_file:
+                shutil.copyfileobj(file, tmp_file, self.bufsize)
+                if self.fsync:
+                    tmp_file.flush()
+                    os.fsync(tmp_file.fileno())
+            if self.perm is not None:
+                self._fix_permissions(tmp_path)
+            os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return key
+
+    def _put_filename(self, key, filename):
+        with open(filename, 'rb') as source:
+            self._put_file(key, source)
+        os.unlink(filename)
+        return key
+
+    def keys(self, prefix=u""):
+        root = os.path.abspath(self.root)
+        result = []
+        for path, directories, files in os.walk(root):
+            depth = len(os.path.relpath(path, root).split(os.sep)) \
+                if path != root else 0
+            if depth == 0:
+                directories[:] = [
+                    directory for directory in directories
+                    if directory != self.tmp_directory]
+                if not self.flat_fallback:
+                    continue
+            elif depth < self.levels:
+                continue
+            else:
+                directories[:] = []
+            if depth == 0:
+                # anything else in the root isn't a record
+                files = [name for name in files if VALID_KEY_RE.match(name)]
+            result.extend(name for name in files if name.startswith(prefix))
+        # not migrated yet and saved again
+        return list(dict.fromkeys(result))
+
+    def iter_prefixes(self, delimiter, prefix=u""):
+        return KeyValueStore.iter_prefixes(self, delimiter, prefix)
+
+
+def migrate_flat_directory(source, store: ShardedFilesystemStore,
+                           remove_source=True) -> int:
+    """
+    Moves records of a flat ``FilesystemStore`` directory, ``source``, into
+    ``store`` and returns how many were moved. ``source`` can be the root
+    of ``store`` itself. Records already in ``store`` were written after
+    the switch and win over the flat ones. Files are hard linked when both
+    are on the same file system and copied otherwise.
+
+    Stop every worker that still writes the flat layout before migrating:
+    a flat record written after it was linked and before it is removed is
+    lost. Workers using ``store`` with ``flat_fallback`` can keep running.
+    """
+    moved = 0
+    for entry in os.scandir(source):
+        if not entry.is_file() or not VALID_KEY_RE.match(entry.name):
+            continue
+        target = store._build_filename(entry.name)
+        store._ensure_dir_exists(os.path.dirname(target))
+        try:
+            # unlike a rename, a link never replaces a newer record
+            os.link(entry.path, target)
+            moved += 1
+        except FileExistsError:
+            pass
+        except OSError:
+            # another file system
+            if not os.path.exists(target):
+                with open(entry.path, 'rb') as source_file:
+                    store._put_file(entry.name, source_file)
+                moved += 1
+        if remove_source:
+            os.unlink(entry.path)
+    return moved
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Move sessions of a flat FilesystemStore directory into "
+                    "a ShardedFilesystemStore. Stop the workers writing the "
+                    "flat directory first.")
+    parser.add_argument('source', help="flat session directory")
+    parser.add_argument('destination', nargs='?',
+                        help="sharded session directory, defaults to source")
+    parser.add_argument('--levels', type=int, default=2)
+    parser.add_argument('--width', type=int, default=2)
+    parser.add_argument('--keep-source', action='store_true',
+                        help="copy the sessions instead of moving them")
+    args = parser.parse_args(argv)
+
+    store = ShardedFilesystemStore(args.destination or args.source,
+                                   levels=args.levels, width=args.width)
+    moved = migrate_flat_directory(args.source, store,
+                                   remove_source=not args.keep_source)
+    print("migrated {0} sessions".format(moved))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+"""
+Session stores are plain simplekv stores, any of them can be passed to
+``UssdRequest(session_store_backend=...)``. This package adds the ones that
+ship with ussd_airflow.
+
+.. code-block:: python
+
+    from ussd.store.session_store.MemoryStore import MemoryStore
+
+    session_store_backend = MemoryStore(maxsize=100000)
+
+    # or, for sessions that have to survive restarts
+    from ussd.store.session_store.ShardedFilesystemStore import \
+        ShardedFilesystemStore
+
+    session_store_backend = ShardedFilesystemStore("./session_data")
+
+Stores with time to live support (``ttl_support``) get the session expiry
+as the ttl of every record, so expired sessions are removed by the store.
+Sessions in other stores, e.g ``FilesystemStore``, are removed by
+:mod:`ussd.store.session_store.sweeper`.
+"""
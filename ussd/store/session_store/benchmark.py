@@ -0,0 +1,74 @@
+"""
+Session store throughput, every operation is one ussd hop: load the
+session, change it and save it.
+
+.. code-block:: bash
+
+    python -m ussd.store.session_store.benchmark --threads 8 --hops 2000
+"""
+import argparse
+import shutil
+import tempfile
+import threading
+import time
+
+from simplekv.fs import FilesystemStore
+
+from ussd.session_store import SessionStore
+from ussd.store.session_store.MemoryStore import MemoryStore
+
+
+def run_hops(kv_store, thread, sessions, hops):
+    for hop in range(hops):
+        session = SessionStore(
+            "benchmark{0}x{1}".format(thread, hop % sessions), kv_store)
+        session.set_expiry(180)
+        session['_ussd_state'] = dict(next_screen='screen_{0}'.format(hop))
+        session['ussd_interaction'] = \
+            (session.get('ussd_interaction') or [])[-9:] + [hop]
+        session.save()
+
+
+def benchmark(kv_store, threads, sessions, hops) -> float:
+    """
+    Returns hops per second.
+    """
+    workers = [
+        threading.Thread(target=run_hops,
+                         args=(kv_store, thread, sessions, hops))
+        for thread in range(threads)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * hops / (time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--sessions', type=int, default=100,
+                        help="sessions per thread")
+    parser.add_argument('--hops', type=int, default=2000,
+                        help="hops per thread")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    stores = [
+        ("FilesystemStore", FilesystemStore(directory)),
+        ("MemoryStore", MemoryStore(maxsize=args.threads * args.sessions))
+    ]
+    try:
+        for name, kv_store in stores:
+            rate = benchmark(kv_store, args.threads, args.sessions,
+                             args.hops)
+            print("{0:<16} {1:>10.0f} hops/s".format(name, rate))
+    finally:
+        stores[1][1].close()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Index of when sessions expire, so expired sessions can be found without
+reading every session. Used by :mod:`ussd.store.session_store.sweeper`.
+
+.. code-block:: python
+
+    from ussd.store.session_store.expiry_index import ExpiryIndex, \
+        configure_expiry_index
+
+    configure_expiry_index(ExpiryIndex("./session_expiry"))
+
+The index can also be configured with the
+``USSD_SESSION_EXPIRY_INDEX_DIRECTORY`` environment variable. Sessions
+saved in stores with time to live support are not indexed, the store
+expires them.
+"""
+import os
+import time
+import uuid
+
+from ussd import defaults as ussd_airflow_variables
+from ussd.utils.cache import LRUCache
+
+
+class ExpiryIndex(object):
+    """
+    Session keys grouped in buckets of ``bucket_secs`` seconds by expiry
+    time. Each bucket is a file in ``directory`` named after the time the
+    bucket ends, a line is appended to it every time a session is saved
+    with an expiry in that bucket. A session saved many times within the
+    same bucket is only indexed once per process.
+
+    A key in a bucket is a candidate, the session may have been saved
+    again with a later expiry since, so the sweeper checks the session
+    before removing it.
+    """
+
+    suffix = '.expiry'
+
+    def __init__(self, directory, bucket_secs=60, recent_keys=100000):
+        self.directory = os.path.abspath(directory)
+        self.bucket_secs = bucket_secs
+        # session key -> last bucket it was added to by this process
+        self._recent = LRUCache(recent_keys)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def bucket(self, expires_at: float) -> int:
+        return (int(expires_at) // self.bucket_secs + 1) * self.bucket_secs
+
+    def _bucket_path(self, bucket):
+        return os.path.join(self.directory, "{0}{1}".format(bucket,
+                                                            self.suffix))
+
+    def add(self, session_key, expires_at: float):
+        bucket = self.bucket(expires_at)
+        if self._recent.get(session_key) == bucket:
+            return
+        # a single append of a short line, safe with concurrent writers
+        with open(self._bucket_path(bucket), 'a') as bucket_file:
+            bucket_file.write(session_key + '\n')
+        self._recent.set(session_key, bucket)
+
+    def expired_buckets(self, now: float = None) -> list:
+        """
+        Buckets that ended before ``now``, oldest first.
+        """
+        now = time.time() if now is None else now
+        buckets = []
+        for entry in os.scandir(self.directory):
+            name = entry.name
+            if not name.endswith(self.suffix):
+                continue
+            bucket = int(name[:-len(self.suffix)])
+            if bucket <= now:
+                buckets.append(bucket)
+        return sorted(buckets)
+
+    def read_bucket(self, bucket) -> list:
+        try:
+            with open(self._bucket_path(bucket)) as bucket_file:
+                keys = [line.strip() for line in bucket_file]
+        except FileNotFoundError:
+            return []
+        # a session is in a bucket once for every process that saved it
+        return list(dict.fromkeys(key for key in keys if key))
+
+    def replace_bucket(self, bucket, keys):
+        """
+        Replaces the keys of an expired bucket, no keys removes it.
+        """
+        path = self._bucket_path(bucket)
+        if not keys:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return
+        tmp_path = "{0}.{1}.tmp".format(path, uuid.uuid4().hex)
+        with open(tmp_path, 'w') as bucket_file:
+            bucket_file.write(''.join(key + '\n' for key in keys))
+        os.replace(tmp_path, path)
+
+
+_expiry_index = None
+
+
+def configure_expiry_index(expiry_index: ExpiryIndex = None):
+    """
+    Sets the index sessions are added to when they are saved, ``None``
+    disables it.
+    """
+    global _expiry_index
+    _expiry_index = expiry_index
+
+
+def get_expiry_index() -> ExpiryIndex:
+    return _expiry_index
+
+
+if ussd_airflow_variables.session_expiry_index_directory:
+    configure_expiry_index(
+        ExpiryIndex(ussd_airflow_variables.session_expiry_index_directory))
@@ -0,0 +1,187 @@
+"""
+Removes expired sessions from stores without time to live support, e.g
+``FilesystemStore``. Expired sessions are found through the
+:class:`~ussd.store.session_store.expiry_index.ExpiryIndex`, so only
+sessions that may have expired are read.
+
+Work is done in slices bounded by ``max_sessions`` and ``time_slice``
+seconds, a slice that runs out continues where it stopped on the next
+call. Sessions are swept holding the configured session lock, so a session
+that's being saved isn't removed. Sessions that can't be swept are logged
+and left in the store. Run it in the background
+
+.. code-block:: python
+
+    sweeper = SessionSweeper(FilesystemStore("./session_data"),
+                             get_expiry_index())
+    sweeper.start(interval=60)
+
+or from the command line
+
+.. code-block:: bash
+
+    python -m ussd.store.session_store.sweeper ./session_data \\
+        --index-directory ./session_expiry --archive-directory ./archive
+"""
+import argparse
+import os
+import threading
+import time
+from datetime import datetime
+
+from simplekv import KeyValueStore
+from simplekv.fs import FilesystemStore
+from structlog import get_logger
+
+from ussd import defaults as ussd_airflow_variables
+from ussd.session_lock import SessionLock, SessionLockTimeout, \
+    get_session_lock
+from ussd.store.session_store.expiry_index import ExpiryIndex
+from ussd.utils.module_loading import import_string
+
+logger = get_logger(__name__)
+
+
+class SessionSweeper(object):
+    """
+    Deletes expired sessions in ``kv_store``, if ``archive`` is given
+    they are saved there first, one record per session. ``session_lock``
+    defaults to the lock configured for requests.
+    """
+
+    def __init__(self, kv_store: KeyValueStore, expiry_index: ExpiryIndex,
+                 archive: KeyValueStore = None, session_store_class=None,
+                 max_sessions=1000, time_slice=1.0, timer=time.monotonic,
+                 session_lock: SessionLock = None):
+        self.kv_store = kv_store
+        self.session_lock = session_lock
+        self.expiry_index = expiry_index
+        self.archive = archive
+        self.session_store_class = import_string(
+            session_store_class or ussd_airflow_variables.session_store_class)
+        self.max_sessions = max_sessions
+        self.time_slice = time_slice
+        self.timer = timer
+        self.swept = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def sweep(self, now: float = None) -> int:
+        """
+        Runs one slice and returns the number of sessions removed.
+        """
+        now = time.time() if now is None else now
+        deadline = self.timer() + self.time_slice
+        checked = removed = 0
+        for bucket in self.expiry_index.expired_buckets(now):
+            keys = self.expiry_index.read_bucket(bucket)
+            try:
+                while keys and checked < self.max_sessions and \
+                        self.timer() < deadline:
+                    session_key = keys.pop()
+                    checked += 1
+                    try:
+                        removed += self.sweep_session(session_key, now)
+                    except Exception:
+                        logger.exception("session_sweep_failed",
+                                         session_key=session_key)
+            finally:
+                # keys that weren't checked stay for the next slice
+                self.expiry_index.replace_bucket(bucket, keys)
+            if keys:
+                break
+        self.swept += removed
+        return removed
+
+    def sweep_session(self, session_key, now: float) -> bool:
+        session_lock = self.session_lock or get_session_lock()
+        if session_lock is None:
+            return self._sweep_session(session_key, now)
+        try:
+            with session_lock.lock(session_key):
+                return self._sweep_session(session_key, now)
+        except SessionLockTimeout:
+            # in use, it's indexed again when it's saved
+            return False
+
+    def _sweep_session(self, session_key, now: float) -> bool:
+        session = self.session_store_class(session_key, self.kv_store)
+        expiry = session.get(ussd_airflow_variables.session_expiry)
+        if not isinstance(expiry, datetime) or expiry.timestamp() > now:
+            # gone already or saved again, in which case it is in the
+            # bucket of its new expiry
+            return False
+        if self.archive is not None:
+            self.archive.put(session_key,
+                             session.encode(dict(session.items())))
+        session.delete()
+        return True
+
+    def sweep_all(self, now: float = None) -> int:
+        removed = 0
+        while self.expiry_index.expired_buckets(now):
+            removed += self.sweep(now)
+        return removed
+
+    def start(self, interval=60):
+        """
+        Sweeps a slice every ``interval`` seconds in a daemon thread.
+        """
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,),
+                                        name="SessionSweeper", daemon=True)
+        self._thread.start()
+
+    def _run(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("session_sweep_failed")
+
+    def close(self):
+        self._stopped.set()
+        thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Delete or archive expired ussd sessions.")
+    parser.add_argument('session_directory',
+                        help="directory of the FilesystemStore")
+    parser.add_argument(
+        '--index-directory',
+        default=ussd_airflow_variables.session_expiry_index_directory,
+        required=not ussd_airflow_variables.session_expiry_index_directory)
+    parser.add_argument('--archive-directory',
+                        help="move expired sessions here instead of "
+                             "deleting them")
+    parser.add_argument('--max-sessions', type=int, default=1000,
+                        help="sessions checked per slice")
+    parser.add_argument('--time-slice', type=float, default=1.0,
+                        help="seconds per slice")
+    parser.add_argument('--pause', type=float, default=0.0,
+                        help="seconds to wait between slices")
+    args = parser.parse_args(argv)
+
+    archive = None
+    if args.archive_directory:
+        os.makedirs(args.archive_directory, exist_ok=True)
+        archive = FilesystemStore(args.archive_directory)
+    sweeper = SessionSweeper(FilesystemStore(args.session_directory),
+                             ExpiryIndex(args.index_directory),
+                             archive=archive,
+                             max_sessions=args.max_sessions,
+                             time_slice=args.time_slice)
+    while sweeper.expiry_index.expired_buckets():
+        sweeper.sweep()
+        time.sleep(args.pause)
+    print("removed {0} expired sessions".format(sweeper.swept))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from simplekv.fs import FilesystemStore
+
+from ussd.session_store import SessionStore
+from ussd.store.session_store.ShardedFilesystemStore import \
+    ShardedFilesystemStore, migrate_flat_directory, main
+
+
+class TestShardedFilesystemStore(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.store = ShardedFilesystemStore(self.directory)
+
+    def test_records_are_saved_in_nested_directories(self):
+        self.store.put("254712345678", b"session")
+
+        first, second = self.store.shard("254712345678")
+        self.assertEqual(2, len(first))
+        self.assertEqual(2, len(second))
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.directory, first, second, "254712345678")))
+        self.assertEqual(b"session", self.store.get("254712345678"))
+        self.assertEqual(["254712345678"], self.store.keys())
+
+        self.store.delete("254712345678")
+        self.assertNotIn("254712345678", self.store)
+        self.assertEqual([], self.store.keys())
+        # deleting a missing record is not an error
+        self.store.delete("254712345678")
+
+    def test_levels_and_width(self):
+        store = ShardedFilesystemStore(self.directory, levels=3, width=1)
+        store.put("key", b"value")
+        self.assertEqual(3, len(store.shard("key")))
+        self.assertEqual(
+            os.path.join(self.directory, *(store.shard("key") + ["key"])),
+            store._build_filename("key"))
+        self.assertEqual(["key"], store.keys())
+
+    def test_writes_replace_the_record(self):
+        self.store.put("key", b"first")
+        with mock.patch("os.replace", wraps=os.replace) as replace:
+            self.store.put("key", b"second")
+        self.assertEqual(self.store._build_filename("key"),
+                         replace.call_args[0][1])
+        self.assertEqual(b"second", self.store.get("key"))
+        self.assertEqual([], os.listdir(
+            os.path.join(self.directory, self.store.tmp_directory)))
+
+    def test_failed_writes_leave_the_record(self):
+        self.store.put("key", b"first")
+
+        class BrokenFile(io.BytesIO):
+            def read(self, *args):
+                raise IOError("broken")
+
+        self.assertRaises(IOError, self.store.put_file, "key",
+                          BrokenFile())
+        self.assertEqual(b"first", self.store.get("key"))
+        self.assertEqual([], os.listdir(
+            os.path.join(self.directory, self.store.tmp_directory)))
+
+    def test_session_store(self):
+        session = SessionStore("sharded_session", self.store)
+        session['name'] = 'mwas'
+        session.save()
+        self.assertEqual(
+            'mwas', SessionStore("sharded_session", self.store)['name'])
+
+    def test_migrate_flat_directory(self):
+        flat = FilesystemStore(self.directory)
+        flat.put("first_session", b"first")
+        flat.put("second_session", b"old")
+        self.store.put("second_session", b"new")
+        with open(os.path.join(self.directory, "not a session"), "w"):
+            pass
+
+        store = ShardedFilesystemStore(self.directory, flat_fallback=True)
+        self.assertEqual(b"first", store.get("first_session"))
+        self.assertEqual(["first_session", "second_session"],
+                         sorted(store.keys()))
+
+        self.assertEqual(1, migrate_flat_directory(self.directory,
+                                                   self.store))
+        self.assertEqual(b"first", self.store.get("first_session"))
+        self.assertEqual(b"new", self.store.get("second_session"))
+        self.assertEqual(
+            ["not a session"],
+            [name for name in os.listdir(self.directory)
+             if os.path.isfile(os.path.join(self.directory, name))])
+
+    def test_migrate_command_line(self):
+        source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        FilesystemStore(source).put("flat_session", b"session")
+
+        with mock.patch('builtins.print') as print_:
+            main([source, self.directory, "--keep-source"])
+        print_.assert_called_once_with("migrated 1 sessions")
+        self.assertEqual(b"session", self.store.get("flat_session"))
+        self.assertEqual(["flat_session"], os.listdir(source))
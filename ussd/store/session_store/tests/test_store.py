@@ -0,0 +1,105 @@
+import threading
+from unittest import TestCase, mock
+
+from simplekv import FOREVER
+
+from ussd.store.session_store.MemoryStore import MemoryStore
+
+
+class TestMemoryStore(TestCase):
+
+    def setUp(self):
+        self.timer = mock.Mock(return_value=0)
+        self.store = MemoryStore(maxsize=8, shards=2, eviction_interval=None,
+                                 timer=self.timer)
+
+    def test_put_and_get(self):
+        self.store.put("key", b"value")
+        self.assertEqual(b"value", self.store.get("key"))
+        self.assertIn("key", self.store)
+        self.assertEqual(["key"], self.store.keys())
+
+        self.store.delete("key")
+        self.assertRaises(KeyError, self.store.get, "key")
+        # deleting a missing key is not an error
+        self.store.delete("key")
+
+    def test_records_expire_after_their_ttl(self):
+        self.store.put("short", b"value", ttl_secs=10)
+        self.store.put("forever", b"value", ttl_secs=FOREVER)
+        self.store.put("not_set", b"value")
+
+        self.timer.return_value = 9
+        self.assertEqual(b"value", self.store.get("short"))
+
+        self.timer.return_value = 10
+        self.assertRaises(KeyError, self.store.get, "short")
+        self.assertNotIn("short", self.store)
+        self.assertEqual(["forever", "not_set"], sorted(self.store.keys()))
+
+    def test_default_ttl(self):
+        store = MemoryStore(default_ttl_secs=5, eviction_interval=None,
+                            timer=self.timer)
+        store.put("key", b"value")
+        self.timer.return_value = 5
+        self.assertRaises(KeyError, store.get, "key")
+
+    def test_least_recently_used_records_are_evicted(self):
+        store = MemoryStore(maxsize=2, shards=1, eviction_interval=None)
+        store.put("first", b"1")
+        store.put("second", b"2")
+        store.get("first")
+        store.put("third", b"3")
+
+        self.assertEqual(["first", "third"], sorted(store.keys()))
+        self.assertEqual(1, store.stats()["evictions"])
+
+    def test_maxsize_is_split_between_shards(self):
+        for i in range(20):
+            self.store.put("key{0}".format(i), b"value")
+        self.assertLessEqual(len(self.store), 8)
+        self.assertRaises(ValueError, MemoryStore, maxsize=2, shards=4)
+
+    def test_evict_expired(self):
+        self.store.put("first", b"1", ttl_secs=10)
+        self.store.put("second", b"2", ttl_secs=20)
+        self.timer.return_value = 15
+
+        self.assertEqual(1, self.store.evict_expired())
+        self.assertEqual(1, len(self.store))
+        self.assertEqual(1, self.store.stats()["expired"])
+
+    def test_background_eviction(self):
+        store = MemoryStore(eviction_interval=0.01, timer=self.timer)
+        self.addCleanup(store.close)
+        evicted = threading.Event()
+        evict_expired = store.evict_expired
+
+        def wrapped():
+            removed = evict_expired()
+            if removed:
+                evicted.set()
+            return removed
+
+        store.evict_expired = wrapped
+        store.put("key", b"value", ttl_secs=1)
+        self.timer.return_value = 2
+        self.assertTrue(evicted.wait(5))
+        self.assertEqual(0, len(store))
+
+    def test_concurrent_writers(self):
+        store = MemoryStore(maxsize=1000, eviction_interval=None)
+
+        def write(thread):
+            for i in range(200):
+                key = "t{0}k{1}".format(thread, i)
+                store.put(key, key.encode())
+                self.assertEqual(key.encode(), store.get(key))
+
+        threads = [threading.Thread(target=write, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(len(store), 1000)
@@ -0,0 +1,157 @@
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from freezegun import freeze_time
+from simplekv.fs import FilesystemStore
+from simplekv.memory import DictStore
+
+from ussd.session_lock import LocalSessionLock
+from ussd.session_store import SessionStore, FieldSessionStore
+from ussd.store.session_store.expiry_index import ExpiryIndex, \
+    configure_expiry_index
+from ussd.store.session_store.MemoryStore import MemoryStore
+from ussd.store.session_store.sweeper import SessionSweeper, main
+
+
+class TestSessionSweeper(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.kv_store = FilesystemStore(self.directory + "/sessions")
+        self.expiry_index = ExpiryIndex(self.directory + "/index")
+        configure_expiry_index(self.expiry_index)
+        self.addCleanup(configure_expiry_index, None)
+
+    def save_session(self, session_key, expiry, now="2018-01-01 00:00:00",
+                     session_store_class=SessionStore):
+        with freeze_time(now):
+            session = session_store_class(session_key, self.kv_store)
+            session['name'] = 'mwas'
+            session.set_expiry(expiry)
+            session.save()
+
+    def sweeper(self, **kwargs):
+        kwargs.setdefault("session_store_class",
+                          "ussd.session_store.SessionStore")
+        return SessionSweeper(self.kv_store, self.expiry_index, **kwargs)
+
+    def test_expired_sessions_are_deleted(self):
+        self.save_session("expired_session", 60)
+        self.save_session("live_session", 600)
+
+        with freeze_time("2018-01-01 00:05:00"):
+            self.assertEqual(1, self.sweeper().sweep_all())
+        self.assertEqual(["live_session"], self.kv_store.keys())
+
+        with freeze_time("2018-01-01 00:20:00"):
+            self.assertEqual(1, self.sweeper().sweep_all())
+            self.assertEqual([], self.expiry_index.expired_buckets())
+        self.assertEqual([], self.kv_store.keys())
+
+    def test_sessions_saved_again_are_kept(self):
+        self.save_session("extended_session", 60)
+        self.save_session("extended_session", 600, now="2018-01-01 00:00:50")
+
+        with freeze_time("2018-01-01 00:05:00"):
+            self.assertEqual(0, self.sweeper().sweep_all())
+        self.assertEqual(["extended_session"], self.kv_store.keys())
+
+    def test_only_indexed_sessions_are_read(self):
+        self.kv_store.put("not_indexed", b"")
+        self.save_session("expired_session", 60)
+        with freeze_time("2018-01-01 00:05:00"), \
+                mock.patch.object(self.kv_store, "get",
+                                  wraps=self.kv_store.get) as get:
+            self.sweeper().sweep_all()
+        self.assertEqual([mock.call("expired_session")], get.call_args_list)
+
+    def test_sweeping_is_done_in_slices(self):
+        for i in range(5):
+            self.save_session("expired_session{0}".format(i), 60)
+
+        sweeper = self.sweeper(max_sessions=2)
+        with freeze_time("2018-01-01 00:05:00"):
+            self.assertEqual(2, sweeper.sweep())
+            self.assertEqual(3, len(self.kv_store.keys()))
+            self.assertEqual(2, sweeper.sweep())
+            self.assertEqual(1, sweeper.sweep())
+            self.assertEqual(0, sweeper.sweep())
+        self.assertEqual(5, sweeper.swept)
+
+        self.save_session("expired_session", 60)
+        timer = mock.Mock(side_effect=[0, 2])
+        with freeze_time("2018-01-01 00:05:00"):
+            self.assertEqual(0, self.sweeper(timer=timer).sweep())
+        self.assertEqual(["expired_session"], self.kv_store.keys())
+
+    def test_sessions_that_fail_do_not_stop_the_sweep(self):
+        self.save_session("failing_session", 60)
+        self.save_session("expired_session", 60)
+        sweeper = self.sweeper()
+        sweep_session = sweeper._sweep_session
+
+        def fail_once(session_key, now):
+            if session_key == "failing_session":
+                raise IOError("disk error")
+            return sweep_session(session_key, now)
+
+        with freeze_time("2018-01-01 00:05:00"), \
+                mock.patch.object(sweeper, "_sweep_session",
+                                  side_effect=fail_once), \
+                mock.patch("ussd.store.session_store.sweeper.logger") \
+                as logger:
+            self.assertEqual(1, sweeper.sweep_all())
+        logger.exception.assert_called_once_with(
+            "session_sweep_failed", session_key="failing_session")
+        self.assertEqual(["failing_session"], self.kv_store.keys())
+        self.assertEqual([], self.expiry_index.expired_buckets())
+
+    def test_sessions_in_use_are_not_swept(self):
+        session_lock = LocalSessionLock(timeout=0)
+        self.save_session("expired_session", 60)
+        handle = session_lock.acquire("expired_session")
+        with freeze_time("2018-01-01 00:05:00"):
+            self.assertEqual(
+                0, self.sweeper(session_lock=session_lock).sweep_all())
+        self.assertEqual(["expired_session"], self.kv_store.keys())
+
+        # the request holding the lock saves it, which indexes it again
+        session_lock.release(handle)
+        self.save_session("expired_session", 120)
+        with freeze_time("2018-01-01 00:05:00"):
+            self.assertEqual(
+                1, self.sweeper(session_lock=session_lock).sweep_all())
+
+    def test_expired_sessions_can_be_archived(self):
+        archive = DictStore()
+        self.save_session("expired_session", 60,
+                          session_store_class=FieldSessionStore)
+        with freeze_time("2018-01-01 00:05:00"):
+            self.sweeper(
+                archive=archive,
+                session_store_class="ussd.session_store.FieldSessionStore"
+            ).sweep_all()
+
+        self.assertEqual([], self.kv_store.keys())
+        self.assertEqual("mwas",
+                         SessionStore("expired_session", archive)["name"])
+
+    def test_sessions_in_stores_with_ttl_are_not_indexed(self):
+        session = SessionStore("memory_session", MemoryStore(
+            eviction_interval=None))
+        session['name'] = 'mwas'
+        session.save()
+        self.assertEqual([], self.expiry_index.expired_buckets(float('inf')))
+
+    def test_command_line(self):
+        self.save_session("expired_session", 60)
+        with freeze_time("2018-01-01 00:05:00"), \
+                mock.patch('builtins.print') as print_:
+            main([self.directory + "/sessions",
+                  "--index-directory", self.directory + "/index",
+                  "--archive-directory", self.directory + "/archive"])
+        print_.assert_called_once_with("removed 1 expired sessions")
+        self.assertEqual(["expired_session"],
+                         FilesystemStore(self.directory + "/archive").keys())
@@ -2,9 +2,11 @@ from celery import current_app as app
 import requests
 from structlog import get_logger
 from celery.exceptions import MaxRetriesExceededError
-from ussd.session_store import SessionStore
 from simplekv import KeyValueStore
 from simplekv.fs import FilesystemStore
+from ussd import defaults as ussd_airflow_variables
+from ussd.utils.module_loading import import_string
+from ussd.interaction_log import get_full_history
 
 
 @app.task(bind=True)
@@ -25,8 +27,10 @@ def report_session(self, session_id, screen_content, session_store_backend: KeyV
 
     ussd_report_session_data = screen_content['ussd_report_session']
 
-    session = SessionStore(session_key=session_id,
-                           kv_store=session_store_backend)
+    session_store_class = import_string(
+        ussd_airflow_variables.session_store_class)
+    session = session_store_class(session_key=session_id,
+                                  kv_store=session_store_backend)
 
     if session.get('posted'):
         logger.info("session_already_reported", posted=session['posted'])
@@ -34,7 +38,8 @@ def report_session(self, session_id, screen_content, session_store_backend: KeyV
 
     request_conf = UssdHandlerAbstract.render_request_conf(
         session,
-        ussd_report_session_data['request_conf']
+        ussd_report_session_data['request_conf'],
+        extra_context=dict(ussd_interaction=get_full_history(session))
     )
 
     UssdHandlerAbstract.make_request(
@@ -11,6 +11,43 @@ from ussd.session_store import SessionStore
 from simplekv.fs import FilesystemStore
 
 
+class UssdTestClient(object):
+    """
+    Sends requests of one session to the engine, ``extra_payload`` is
+    passed on to every :class:`UssdRequest`, e.g the journey and the
+    session store.
+    """
+
+    def __init__(self, session_id=None, phone_number=200,
+                 language='en', extra_payload=None, ):
+
+        if extra_payload is None:
+            extra_payload = {}
+        self.phone_number = phone_number
+        self.language = language
+        self.session_id = session_id \
+            if session_id is not None \
+            else str(uuid.uuid4())
+        self.extra_payload = extra_payload
+
+    def send(self, ussd_input, raw=False):
+        payload = {
+            "session_id": self.session_id,
+            "ussd_input": ussd_input,
+            "phone_number": self.phone_number,
+            "language": self.language,
+        }
+        payload.update(self.extra_payload)
+
+        ussd_request = UssdRequest(**payload)
+
+        response = UssdEngine(ussd_request).ussd_dispatcher()
+
+        if raw:
+            return response
+        return str(response)
+
+
 class UssdTestCase(object):
     """
     this contains two test that are required in each screen test case
@@ -124,36 +161,6 @@ class UssdTestCase(object):
             return SessionStore(session_id, kv_store=self.session_store)
 
         def ussd_client(self, generate_customer_journey=True, **kwargs):
-            class UssdTestClient(object):
-                def __init__(self, session_id=None, phone_number=200,
-                             language='en', extra_payload=None, ):
-
-                    if extra_payload is None:
-                        extra_payload = {}
-                    self.phone_number = phone_number
-                    self.language = language
-                    self.session_id = session_id \
-                        if session_id is not None \
-                        else str(uuid.uuid4())
-                    self.extra_payload = extra_payload
-
-                def send(self, ussd_input, raw=False):
-                    payload = {
-                        "session_id": self.session_id,
-                        "ussd_input": ussd_input,
-                        "phone_number": self.phone_number,
-                        "language": self.language,
-                    }
-                    payload.update(self.extra_payload)
-
-                    ussd_request = UssdRequest(**payload)
-
-                    response = UssdEngine(ussd_request).ussd_dispatcher()
-
-                    if raw:
-                        return response
-                    return str(response)
-
             customer_journey_conf = {
                 'journey_name': self.journey_name,
                 'journey_version': self.valid_version,
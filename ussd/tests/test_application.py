@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from simplekv.memory import DictStore
+
+from ussd import defaults as ussd_airflow_variables
+from ussd.application import UssdApplication
+from ussd.core import UssdResponse, get_environment, configure_environment
+from ussd.session_store import SessionStore
+from ussd.store.journey_store.YamlJourneyStore import YamlJourneyStore, \
+    load_yaml
+from ussd.tests.sample_screen_definition import path
+
+
+class TestUssdApplication(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.journey_store = YamlJourneyStore(journey_directory=directory)
+        self.journey_store.save(
+            "sample_journey",
+            load_yaml(os.path.join(path, "sample_journey",
+                                   "sample_using_inheritance.yml")),
+            "sample_using_inheritance"
+        )
+        self.session_store = DictStore()
+        self.application = self.create_application()
+
+    def create_application(self, **kwargs):
+        return UssdApplication(
+            journey_name="sample_journey",
+            journey_store=self.journey_store,
+            journey_version="sample_using_inheritance",
+            session_store_backend=self.session_store,
+            **kwargs
+        )
+
+    def test_dispatch(self):
+        response = self.application.dispatch("1234567890", "200", "")
+        self.assertIsInstance(response, UssdResponse)
+        self.assertEqual("Enter anything\n", str(response))
+        self.assertEqual("Enter anything\n", str(
+            self.application.dispatch("1234567890", "200", "Francis")))
+        self.assertEqual(
+            "First input was Francis and second input was Mwangi\n"
+            "1. Continue\n",
+            str(self.application.dispatch("1234567890", "200", "Mwangi")))
+
+        session = SessionStore("1234567890", self.session_store)
+        self.assertEqual(3, session["_ussd_state"]["interaction_count"])
+
+    def test_shared_parts_are_created_once(self):
+        with mock.patch.object(YamlJourneyStore, "__init__") as init:
+            for ussd_input in ("", "Francis"):
+                self.application.dispatch("1234567890", "200", ussd_input)
+        self.assertFalse(init.called)
+
+    def test_request_arguments(self):
+        application = self.create_application(customer_id="c1")
+        application.dispatch("1234567890", "200", "", language="sw",
+                             channel="web")
+        session = SessionStore("1234567890", self.session_store)
+        self.assertEqual("c1", session["customer_id"])
+        self.assertEqual("web", session["channel"])
+        self.assertEqual("sw", session["language"])
+
+    def test_environment(self):
+        self.addCleanup(
+            configure_environment,
+            ussd_airflow_variables.template_environment_allow_list,
+            ussd_airflow_variables.template_environment_prefixes
+        )
+        with mock.patch.dict("os.environ", {"USSD_NAME": "airflow",
+                                            "OTHER": "hidden"}):
+            self.create_application(environment_prefixes="USSD_")
+        self.assertEqual("airflow", get_environment()["USSD_NAME"])
+        self.assertNotIn("OTHER", get_environment())
+
+    def test_warm_up(self):
+        journey = self.application.warm_up()
+        self.assertEqual("sample_using_inheritance", journey.version)
+
+    def test_stats(self):
+        self.application.dispatch("1234567890", "200", "")
+        with mock.patch("ussd.application.UssdEngine.ussd_dispatcher",
+                        side_effect=ValueError):
+            self.assertRaises(ValueError, self.application.dispatch,
+                              "1234567890", "200", "Francis")
+
+        stats = self.application.stats()
+        self.assertEqual(2, stats["requests"])
+        self.assertEqual(1, stats["errors"])
+        self.assertGreater(stats["average_seconds"], 0)
+        self.assertIn("hits", stats["template_cache"])
+        self.assertIn("size", stats["compiled_journey_cache"])
+        self.assertIn("ratio", stats["session_compression"])
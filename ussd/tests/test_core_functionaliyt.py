@@ -1,14 +1,26 @@
+import threading
 import time
 from collections import OrderedDict
 from datetime import datetime
 
 from unittest import TestCase
 from freezegun import freeze_time
+from unittest import mock
 from ussd import defaults as ussd_airflow_variables
 from ussd.core import _registered_ussd_handlers, \
     UssdHandlerAbstract, MissingAttribute, \
-    InvalidAttribute, UssdRequest, convert_error_response_to_mermaid_error
-from ussd.tests import UssdTestCase
+    InvalidAttribute, UssdRequest, convert_error_response_to_mermaid_error, \
+    TemplateCache, RenderContext, configure_environment, \
+    refresh_environment, get_environment, CompiledJourney, UssdEngine, \
+    UssdResponse, env, _render_template, _evaluate_expression
+from ussd.session_store import SessionStore
+from ussd.store.journey_store.DummyStore import DummyStore
+from simplekv.memory import DictStore
+from ussd.interaction_log import KeyValueInteractionLog, \
+    configure_interaction_log, get_full_history
+from ussd.session_lock import LocalSessionLock, SessionLockTimeout, \
+    configure_session_lock
+from ussd.tests import UssdTestCase, UssdTestClient
 from ussd.utilities import datetime_to_string, string_to_datetime
 from marshmallow import Schema, fields
 
@@ -252,6 +264,140 @@ class TestInheritance(UssdTestCase.BaseUssdTestCase):
             expected_screen_interaction
         )
 
+    @freeze_time(datetime.now())
+    def test_bounded_history_with_interaction_log(self):
+        log = KeyValueInteractionLog(DictStore())
+        configure_interaction_log(log)
+        self.addCleanup(configure_interaction_log, None)
+
+        ussd_client = self.get_client()
+        with mock.patch.object(ussd_airflow_variables,
+                               "interaction_history_limit", 2):
+            for ussd_input in ('', 'Francis', 'Mwangi', '1', '2', '1', '1'):
+                ussd_client.send(ussd_input)
+
+        session = self.ussd_session(ussd_client.session_id)
+        screens = ["screen_one", "screen_two", "screen_three", "screen_four",
+                   "screen_three", "screen_four", "screen_five"]
+
+        self.assertEqual(screens[-2:], [i["screen_name"]
+                                        for i in session["ussd_interaction"]])
+        self.assertEqual(7, session["_ussd_state"]["interaction_count"])
+
+        # completed interactions and the last screen are in the log
+        logged = log.read(ussd_client.session_id)
+        self.assertEqual(screens, [i["screen_name"] for i in logged])
+        self.assertEqual(session["ussd_interaction"], logged[-2:])
+        self.assertEqual(logged, get_full_history(session))
+
+    def test_gateway_retries_get_the_previous_response(self):
+        ussd_client = self.get_client()
+        with mock.patch.object(ussd_airflow_variables,
+                               "session_replay_ttl", 5):
+            ussd_client.send('')
+            response = ussd_client.send('Francis')
+
+            with mock.patch.object(UssdEngine, "run_handlers") as \
+                    run_handlers:
+                self.assertEqual(response, ussd_client.send('Francis'))
+            self.assertFalse(run_handlers.called)
+            session = self.ussd_session(ussd_client.session_id)
+            self.assertEqual(2, session["_ussd_state"]["interaction_count"])
+
+            # a different input is a new request
+            self.assertEqual(
+                "First input was Francis and second input was Mwangi\n"
+                "1. Continue\n",
+                ussd_client.send('Mwangi'))
+
+            # and so is the same input once the retry window has passed
+            with mock.patch("ussd.core.time.time",
+                            return_value=time.time() + 10):
+                self.assertNotEqual(
+                    "First input was Francis and second input was Mwangi\n"
+                    "1. Continue\n",
+                    ussd_client.send('Mwangi'))
+
+    def test_gateway_retries_with_request_ids(self):
+        ussd_client = self.get_client()
+        with mock.patch.object(ussd_airflow_variables,
+                               "session_replay_ttl", 5):
+            ussd_client.extra_payload["request_id"] = "first"
+            ussd_client.send('')
+            ussd_client.extra_payload["request_id"] = "second"
+            response = ussd_client.send('1')
+            self.assertEqual(response, ussd_client.send('1'))
+            session = self.ussd_session(ussd_client.session_id)
+            self.assertEqual(2, session["_ussd_state"]["interaction_count"])
+
+            # the user sending the same input again is a new request
+            ussd_client.extra_payload["request_id"] = "third"
+            ussd_client.send('1')
+            session = self.ussd_session(ussd_client.session_id)
+            self.assertEqual(3, session["_ussd_state"]["interaction_count"])
+
+    def test_requests_that_change_nothing_are_not_written(self):
+        ussd_client = self.get_client()
+        response = ussd_client.send('')
+
+        with mock.patch.object(UssdEngine, "run_handlers",
+                               return_value=UssdResponse(response)), \
+                mock.patch.object(SessionStore, "put_record") as put_record:
+            self.assertEqual(response, ussd_client.send(''))
+        self.assertFalse(put_record.called)
+
+    def test_requests_of_a_session_are_serialized(self):
+        session_lock = LocalSessionLock(timeout=5)
+        configure_session_lock(session_lock)
+        self.addCleanup(configure_session_lock, None)
+        ussd_client = self.get_client()
+        ussd_client.send('')
+
+        responses = []
+        handle = session_lock.acquire(ussd_client.session_id)
+        request = threading.Thread(
+            target=lambda: responses.append(ussd_client.send('Francis')))
+        request.start()
+        request.join(0.1)
+        # waiting for the lock
+        self.assertTrue(request.is_alive())
+
+        # a request that held the lock moved the session on
+        session = self.ussd_session(ussd_client.session_id)
+        session["first_name"] = "Changed"
+        session.save()
+        session_lock.release(handle)
+        request.join()
+
+        self.assertEqual(["Enter anything\n"], responses)
+        session = self.ussd_session(ussd_client.session_id)
+        self.assertEqual("Changed", session["first_name"])
+        self.assertEqual(2, session["_ussd_state"]["interaction_count"])
+
+        handle = session_lock.acquire(ussd_client.session_id)
+        self.addCleanup(session_lock.release, handle)
+        session_lock.timeout = 0.01
+        self.assertRaises(SessionLockTimeout, ussd_client.send, 'Mwangi')
+
+    def test_session_is_read_once_with_the_lock_held(self):
+        session_lock = LocalSessionLock(timeout=5)
+        configure_session_lock(session_lock)
+        self.addCleanup(configure_session_lock, None)
+        ussd_client = self.get_client()
+        ussd_client.send('')
+
+        held = []
+
+        def get_session(request):
+            held.append(session_lock._locks[session_lock.stripe(
+                request.session_id, len(session_lock._locks))].locked())
+            return UssdRequest.get_session_from_store(request)
+
+        with mock.patch.object(UssdRequest, "get_session", autospec=True,
+                               side_effect=get_session):
+            ussd_client.send('Francis')
+        self.assertEqual([True], held)
+
     def testing_valid_customer_journey(self):
         self.journey_name = "sample_journey"
         self._test_ussd_validation(
@@ -306,6 +452,31 @@ class TestSessionManagement(UssdTestCase.BaseUssdTestCase):
                             prev_items
                             )
 
+    def test_session_expiry_with_session_lock(self):
+        session_lock = LocalSessionLock(timeout=5)
+        configure_session_lock(session_lock)
+        self.addCleanup(configure_session_lock, None)
+
+        phone_number = 201
+        req = self._create_ussd_request(phone_number)
+        req.session['foo'] = 'bar'
+        req.session.save()
+        time.sleep(2)
+
+        new_req = UssdRequest(
+            None, phone_number, '', 'en',
+            use_built_in_session_management=True, expiry=2,
+            journey_name='sample_journey',
+            journey_version='sample_used_for_testing_session_management',
+            journey_store=self.journey_store)
+        UssdEngine(new_req).ussd_dispatcher()
+
+        # the session was cycled once, inside the lock, keeping the
+        # link to the expired one
+        session = self.ussd_session(new_req.session.session_key)
+        previous = session[ussd_airflow_variables.previous_session_id]
+        self.assertEqual(self.ussd_session(previous)['foo'], 'bar')
+
     def test_session_expiry_using_inactivity(self):
         # Test session expiry is using last time session was updated
         phone_number = '201'
@@ -452,3 +623,343 @@ class TestCommonFunctionality(TestCase):
         for index, v in enumerate(mermaid_error_response):
             self.assertDictEqual(v, actual_error[index])
         self.assertListEqual(mermaid_error_response, actual_error)
+
+
+class TestTemplateCache(TestCase):
+
+    def test_hits_and_misses(self):
+        cache = TemplateCache(maxsize=10)
+
+        template = cache.get_template("Hello {{name}}")
+        self.assertEqual("Hello mwas", template.render(name="mwas"))
+        self.assertEqual(dict(hits=0, misses=1, evictions=0, size=1, maxsize=10),
+                         cache.stats())
+
+        self.assertIs(template, cache.get_template("Hello {{name}}"))
+        self.assertEqual(1, cache.hits)
+
+        # same source compiled as an expression is a different entry
+        expression = cache.get_expression("age > 18")
+        self.assertTrue(expression(age=20))
+        self.assertEqual(2, cache.misses)
+        self.assertEqual(2, len(cache))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TemplateCache(maxsize=2)
+
+        one = cache.get_template("one")
+        cache.get_template("two")
+        # touch "one" so that "two" becomes the least recently used
+        cache.get_template("one")
+        cache.get_template("three")
+
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(2, len(cache))
+        self.assertIs(one, cache.get_template("one"))
+
+        cache.get_template("two")
+        self.assertEqual(4, cache.misses)
+
+    def test_compile_errors_are_cached(self):
+        cache = TemplateCache(maxsize=2)
+
+        for _ in range(2):
+            self.assertRaises(Exception, cache.get_expression,
+                              "http://localhost/{{name}}")
+        self.assertEqual(1, cache.misses)
+        self.assertEqual(1, cache.hits)
+
+    def test_evaluating_expressions_uses_cache(self):
+        from ussd.core import template_cache
+
+        expression = "{{ number_one + number_two }}"
+        session = dict(number_one=1, number_two=2)
+
+        self.assertEqual(
+            3, UssdHandlerAbstract.evaluate_jija_expression(expression, session))
+        hits = template_cache.hits
+        self.assertEqual(
+            3, UssdHandlerAbstract.evaluate_jija_expression(expression, session))
+        self.assertEqual(hits + 1, template_cache.hits)
+
+
+class TestCompiledJourney(TestCase):
+
+    journey = {
+        "initial_screen": "enter_age",
+        "enter_age": {
+            "type": "input_screen",
+            "text": {"en": "Enter your age", "sw": "Ingiza umri {{name}}"},
+            "input_identifier": "age",
+            "next_screen": [
+                {"condition": "age|int > 18", "next_screen": "adult"},
+                {"expression": "{{age|int <= 18}}", "next_screen": "minor"}
+            ]
+        },
+        "adult": {"type": "quit_screen", "text": "Welcome {{name}}"},
+        "minor": {"type": "quit_screen", "text": "Too young"}
+    }
+
+    def setUp(self):
+        self.store = DummyStore(user="compiled_journey")
+        self.store.delete("sample")
+        self.store.save("sample", self.journey, "0.0.1")
+
+    def test_compiling_journey(self):
+        journey = CompiledJourney(self.journey)
+
+        self.assertEqual({"initial_screen": "enter_age"},
+                         journey.initial_screen)
+
+        screen = journey.get_screen("enter_age")
+        self.assertEqual("input_screen", screen.screen_type)
+        self.assertIs(_registered_ussd_handlers["input_screen"], screen.handler)
+        self.assertEqual(
+            (("age|int > 18", "adult"), ("{{age|int <= 18}}", "minor")),
+            screen.next_screen
+        )
+
+        # static texts are not compiled
+        self.assertTrue(journey.is_static("Enter your age"))
+        self.assertTrue(journey.is_static("Too young"))
+        self.assertFalse(journey.is_static("Welcome {{name}}"))
+        self.assertEqual("Welcome mwas",
+                         journey.templates["Welcome {{name}}"].render(
+                             name="mwas"))
+
+        self.assertTrue(journey.expressions["age|int > 18"](age="20"))
+        self.assertTrue(journey.expressions["{{age|int <= 18}}"](age="10"))
+
+    def test_compiled_journeys_are_cached_per_version(self):
+        journey = CompiledJourney.get(self.store, "sample", "0.0.1")
+        self.assertIs(journey,
+                      CompiledJourney.get(DummyStore(user="compiled_journey"),
+                                          "sample", "0.0.1"))
+
+        # edit mode journeys change all the time
+        self.store.save("sample", self.journey, edit_mode=True)
+        edit_mode = CompiledJourney.get(
+            self.store, "sample", self.store.edit_mode_version)
+        self.assertIsNot(edit_mode, CompiledJourney.get(
+            self.store, "sample", self.store.edit_mode_version))
+
+    def client(self, session_id, **extra_payload):
+        extra_payload.setdefault("journey_name", "sample")
+        extra_payload.setdefault("journey_store", self.store)
+        return UssdTestClient(session_id, extra_payload=extra_payload)
+
+    def test_latest_version_is_pinned_for_the_session(self):
+        session_store = DictStore()
+        client = self.client("pinned_version",
+                             session_store_backend=session_store)
+        self.assertEqual("Enter your age\n", client.send(""))
+
+        # a new version is deployed in the middle of the session
+        self.store.save("sample", dict(self.journey, adult={
+            "type": "quit_screen", "text": "Karibu"}), "0.0.2")
+
+        response = client.send("20", raw=True)
+        self.assertEqual("Welcome ", str(response))
+        self.assertEqual("0.0.1",
+                         response.session['_ussd_state']['journey_version'])
+
+        # new sessions get the new version
+        client = self.client("new_session",
+                             session_store_backend=session_store)
+        self.assertEqual("Enter your age\n", client.send(""))
+        self.assertEqual("Karibu", client.send("20"))
+
+    def test_journey_is_read_once_per_request(self):
+        request = UssdRequest(
+            "read_once", "200", "", "en",
+            journey_name="sample", journey_version="0.0.1",
+            journey_store=self.store, session_store_backend=DictStore()
+        )
+        with mock.patch.object(self.store, "_get",
+                               wraps=self.store._get) as store_get:
+            response = UssdEngine(request).ussd_dispatcher()
+            self.assertEqual(self.journey["adult"],
+                             request.forward("adult")[0].get_screens("adult"))
+
+        self.assertEqual("Enter your age\n", str(response))
+        store_get.assert_called_once_with("sample", "0.0.1", None)
+        self.assertNotIn("_journey", response.session)
+
+    def test_handler_prototype_is_built_once(self):
+        journey = CompiledJourney.get(self.store, "sample", "0.0.1")
+        handler_class = _registered_ussd_handlers["input_screen"]
+
+        with mock.patch.object(handler_class, "build_prototype",
+                               wraps=handler_class.build_prototype) as build:
+            for session_id in ("first_prototype", "second_prototype"):
+                self.assertEqual("Enter your age\n", str(UssdEngine(
+                    UssdRequest(
+                        session_id, "200", "", "en",
+                        journey_name="sample", journey_version="0.0.1",
+                        journey_store=self.store,
+                        session_store_backend=DictStore())
+                ).ussd_dispatcher()))
+
+        build.assert_called_once_with(journey.get_screen("enter_age").content,
+                                      journey.initial_screen)
+        self.assertIs(journey.get_screen("enter_age").prototype,
+                      journey.get_screen("enter_age").get_handler(
+                          mock.Mock(), journey.initial_screen).prototype)
+
+    def test_handler_logger_is_bound_when_used(self):
+        journey = CompiledJourney.get(self.store, "sample", "0.0.1")
+        request = mock.Mock()
+        handler = journey.get_screen("adult").get_handler(
+            request, journey.initial_screen)
+        request.all_variables.assert_not_called()
+
+        request.all_variables.return_value = {"session_id": "1234"}
+        self.assertIs(handler.logger, handler.logger)
+        request.all_variables.assert_called_once_with()
+
+    def test_failing_expressions_are_evaluated_once(self):
+        journey = CompiledJourney.get(self.store, "sample", "0.0.1")
+        failing = journey.expressions["age|int > 18"]
+        calls = []
+
+        def evaluate_expression(expression, context):
+            if expression is failing:
+                calls.append(expression)
+                raise ValueError("boom")
+            return _evaluate_expression(expression, context)
+
+        client = self.client("failing_expression", journey_version="0.0.1",
+                             session_store_backend=DictStore())
+
+        with mock.patch("ussd.core._evaluate_expression",
+                        side_effect=evaluate_expression):
+            client.send("")
+            # the failing route is skipped
+            self.assertEqual("Too young", client.send("10"))
+        self.assertEqual(1, len(calls))
+
+    def test_saving_invalidates_compiled_journey(self):
+        journey = CompiledJourney.get(self.store, "sample", "0.0.1")
+
+        self.store.delete("sample", "0.0.1")
+        self.store.save("sample", dict(self.journey, minor={
+            "type": "quit_screen", "text": "Come back later"}), "0.0.1")
+
+        new_journey = CompiledJourney.get(self.store, "sample", "0.0.1")
+        self.assertIsNot(journey, new_journey)
+        self.assertEqual("Come back later",
+                         new_journey.get_screen("minor").content["text"])
+
+
+class TestRenderContext(TestCase):
+
+    def test_lookup_precedence(self):
+        session = dict(name="session", city="Nairobi", now="session now")
+
+        with mock.patch.dict('os.environ', {"name": "environment"}):
+            refresh_environment()
+            self.addCleanup(refresh_environment)
+
+            context = UssdHandlerAbstract.get_context(session)
+            self.assertIsInstance(context, RenderContext)
+            self.assertEqual("environment", context["name"])
+            self.assertEqual("Nairobi", context["city"])
+            self.assertIsInstance(context["now"], datetime)
+
+            context = UssdHandlerAbstract.get_context(
+                session, extra_context=dict(name="extra"))
+            self.assertEqual("extra", context["name"])
+
+            self.assertEqual(
+                "extra Nairobi",
+                UssdHandlerAbstract.render_text(
+                    session, "{{name}} {{city}}", extra=dict(name="extra"))
+            )
+
+    def test_session_is_not_copied_or_modified(self):
+        session = dict(name="mwas")
+        context = UssdHandlerAbstract.get_context(session)
+
+        # later changes to the session are visible without rebuilding
+        session["age"] = 24
+        self.assertEqual(24, context["age"])
+
+        context["age"] = 30
+        self.assertEqual(30, context["age"])
+        self.assertEqual(24, session["age"])
+
+        UssdHandlerAbstract.render_text(session, "{{name}}",
+                                        context=context, extra=dict(name="x"))
+        self.assertEqual(dict(name="mwas", age=24), session)
+
+    def test_jinja_globals_are_available(self):
+        self.assertEqual(
+            "0,1,2",
+            UssdHandlerAbstract.render_text(
+                {}, "{{ range(3) | join(',') }}")
+        )
+        self.assertEqual(
+            [0, 1],
+            UssdHandlerAbstract.evaluate_jija_expression(
+                "{{ range(2) | list }}", {})
+        )
+
+    def test_public_jinja_api_fallback(self):
+        context = UssdHandlerAbstract.get_context(dict(name="mwas", age=24))
+        template = env.from_string("{{ name }} {{ age + 1 }}")
+        expression = env.compile_expression("missing or age > 18")
+
+        # objects without the jinja internals the fast path uses
+        public_template = mock.Mock(spec=["render"],
+                                    render=template.render)
+        public_expression = mock.Mock(spec=[], side_effect=expression)
+        self.assertEqual("mwas 25", _render_template(template, context))
+        self.assertEqual("mwas 25",
+                         _render_template(public_template, context))
+        self.assertIs(True, _evaluate_expression(expression, context))
+        self.assertIs(True,
+                      _evaluate_expression(public_expression, context))
+        self.assertIsNone(_evaluate_expression(
+            env.compile_expression("missing"), context))
+
+        with self.assertRaises(ZeroDivisionError):
+            _render_template(env.from_string("{{ age // 0 }}"), context)
+
+
+class TestEnvironmentSnapshot(TestCase):
+
+    def tearDown(self):
+        configure_environment(
+            ussd_airflow_variables.template_environment_allow_list,
+            ussd_airflow_variables.template_environment_prefixes
+        )
+
+    @mock.patch.dict('os.environ', {"USSD_NAME": "airflow",
+                                    "SECRET_KEY": "secret",
+                                    "REGION": "eu"})
+    def test_allow_list_and_prefixes(self):
+        environment = configure_environment(prefixes="USSD_",
+                                            allow_list=["REGION"])
+        self.assertEqual({"USSD_NAME": "airflow", "REGION": "eu"},
+                         dict(environment))
+
+        self.assertEqual(
+            "airflow eu ",
+            UssdHandlerAbstract.render_text(
+                {}, "{{USSD_NAME}} {{REGION}} {{SECRET_KEY}}")
+        )
+
+        # no filter exposes everything
+        self.assertEqual("secret", configure_environment()["SECRET_KEY"])
+
+    def test_snapshot_is_immutable_and_refreshed_explicitly(self):
+        environment = get_environment()
+        with self.assertRaises(TypeError):
+            environment["NEW_VARIABLE"] = "value"
+
+        with mock.patch.dict('os.environ', {"NEW_VARIABLE": "value"}):
+            self.assertNotIn("NEW_VARIABLE", get_environment())
+            self.assertEqual("value", refresh_environment()["NEW_VARIABLE"])
+            self.assertEqual("value", get_environment()["NEW_VARIABLE"])
+
+        self.assertNotIn("NEW_VARIABLE", refresh_environment())
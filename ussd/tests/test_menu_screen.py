@@ -2,8 +2,16 @@
 This module is involved in testing Menu screen only
 """
 from collections import OrderedDict
+from unittest import TestCase, mock
 
-from ussd.tests import UssdTestCase
+from simplekv.memory import DictStore
+
+from ussd.core import UssdHandlerAbstract, UssdRequest
+from ussd.screens.menu_screen import MenuScreen
+from ussd.session_store import SessionStore
+from ussd.store.journey_store.DummyStore import DummyStore
+from ussd.utils import gsm
+from ussd.tests import UssdTestCase, UssdTestClient
 
 
 class TestMenuHandler(UssdTestCase.BaseUssdTestCase):
@@ -308,10 +316,10 @@ class TestMenuHandler(UssdTestCase.BaseUssdTestCase):
             ussd_client.send('1')
         )
 
-        # select 98 to view more
+        # select 98 to view more, the first option doesn't fit with the
+        # rest of the text
         self.assertEqual(
             "both the prompt and options will be paginated.\n"
-            "1. go back to the previous screen\n"
             "00. Back\n"
             "98. More\n",
             ussd_client.send('98')
@@ -319,7 +327,15 @@ class TestMenuHandler(UssdTestCase.BaseUssdTestCase):
 
         # select 98 to view more
         self.assertEqual(
+            "1. go back to the previous screen\n"
             "2. quit this session\n"
+            "00. Back\n"
+            "98. More\n",
+            ussd_client.send('98')
+        )
+
+        # select 98 to view more
+        self.assertEqual(
             "3. this options will be showed in the next_screen\n"
             "00. Back\n",
             ussd_client.send('98')
@@ -333,64 +349,63 @@ class TestMenuHandler(UssdTestCase.BaseUssdTestCase):
             ussd_client.send('3')
         )
 
-        # Todo fix this tests
-        # # select 98 to view more
-        # self.assertEqual(
-        #     "of this text would be displayed in the next screen\n"
-        #     "1. apple\n"
-        #     "2. boy\n"
-        #     "00. Back\n"
-        #     "98. More\n",
-        #     ussd_client.send('98')
-        # )
-        #
-        # # select 98 to view more
-        # self.assertEqual(
-        #     "3. cat\n"
-        #     "4. dog\n"
-        #     "5. egg\n"
-        #     "6. frog\n"
-        #     "7. girl\n"
-        #     "8. house\n"
-        #     "9. ice\n"
-        #     "10. joyce\n"
-        #     "00. Back\n"
-        #     "98. More\n",
-        #     ussd_client.send('98')
-        # )
-        #
-        # # select 98 to view more
-        # self.assertEqual(
-        #     "11. kettle\n"
-        #     "12. lamp\n"
-        #     "13. mum\n"
-        #     "14. nurse\n"
-        #     "15. ostrich\n"
-        #     "16. pigeon\n"
-        #     "17. queen\n"
-        #     "00. Back\n"
-        #     "98. More\n",
-        #     ussd_client.send('98')
-        # )
-        #
-        # # select 98 to view more
-        # self.assertEqual(
-        #     "18. river\n"
-        #     "19. sweet\n"
-        #     "20. tiger\n"
-        #     "21. umbrella\n"
-        #     "22. van\n"
-        #     "23. water\n"
-        #     "24. quit_session\n"
-        #     "00. Back\n",
-        #     ussd_client.send('98')
-        # )
-        #
-        # # choose apple
-        # self.assertEqual(
-        #     "end of session apple",
-        #     ussd_client.send('1')
-        # )
+        # select 98 to view more
+        self.assertEqual(
+            "of this text would be displayed in the next screen\n"
+            "1. apple\n"
+            "2. boy\n"
+            "00. Back\n"
+            "98. More\n",
+            ussd_client.send('98')
+        )
+
+        # select 98 to view more
+        self.assertEqual(
+            "3. cat\n"
+            "4. dog\n"
+            "5. egg\n"
+            "6. frog\n"
+            "7. girl\n"
+            "8. house\n"
+            "9. ice\n"
+            "10. joyce\n"
+            "00. Back\n"
+            "98. More\n",
+            ussd_client.send('98')
+        )
+
+        # select 98 to view more
+        self.assertEqual(
+            "11. kettle\n"
+            "12. lamp\n"
+            "13. mum\n"
+            "14. nurse\n"
+            "15. ostrich\n"
+            "16. pigeon\n"
+            "17. queen\n"
+            "00. Back\n"
+            "98. More\n",
+            ussd_client.send('98')
+        )
+
+        # select 98 to view more
+        self.assertEqual(
+            "18. river\n"
+            "19. sweet\n"
+            "20. tiger\n"
+            "21. umbrella\n"
+            "22. van\n"
+            "23. water\n"
+            "24. quit_session\n"
+            "00. Back\n",
+            ussd_client.send('98')
+        )
+
+        # choose apple
+        self.assertEqual(
+            "end of session apple",
+            ussd_client.send('1')
+        )
 
     def test_routing_option(self):
         ussd_client = self.ussd_client(phone_number='200')
@@ -410,3 +425,281 @@ class TestMenuHandler(UssdTestCase.BaseUssdTestCase):
             "screen_two",
             ussd_client.send('3')  # choose option with routing
         )
+
+    def test_selecting_option_does_not_render_options(self):
+        ussd_client = self.ussd_client()
+        ussd_client.send('')  # dial in
+
+        with mock.patch.object(MenuScreen, 'get_menu_options', autospec=True,
+                               side_effect=MenuScreen.get_menu_options) \
+                as get_menu_options:
+            self.assertEqual(self.types_of_food, ussd_client.send('1'))
+
+        self.assertNotIn(
+            'choose_meal',
+            [call[0][0].handler for call in get_menu_options.call_args_list])
+
+
+class TestMenuLayouts(TestCase):
+
+    journey = {
+        "initial_screen": "choose_option",
+        "choose_option": {
+            "type": "menu_screen",
+            "text": "Choose an option",
+            "options": [
+                {"text": "option {0}".format(i), "next_screen": "greet"}
+                for i in range(1, 1501)
+            ]
+        },
+        "greet": {
+            "type": "menu_screen",
+            "text": "Hello {{phone_number}}",
+            "options": [{"text": "back", "next_screen": "choose_option"}]
+        }
+    }
+
+    def setUp(self):
+        self.store = DummyStore(user="menu_layouts")
+        self.store.delete("layouts")
+        self.store.save("layouts", self.journey, "0.0.1")
+        self.session_store = DictStore()
+
+    def client(self, session_id="layouts", phone_number="200",
+               journey_version="0.0.1"):
+        return UssdTestClient(session_id, phone_number, extra_payload=dict(
+            journey_name="layouts", journey_version=journey_version,
+            journey_store=self.store,
+            session_store_backend=self.session_store
+        ))
+
+    def test_long_menus_are_paginated(self):
+        client = self.client()
+        first_page = client.send("")
+        self.assertTrue(first_page.startswith(
+            "Choose an option\n1. option 1\n2. option 2\n"))
+        self.assertTrue(first_page.endswith("98. more\n"))
+
+        pages = [first_page]
+        while pages[-1].endswith("98. more\n"):
+            pages.append(client.send("98"))
+        self.assertEqual(1500, "".join(pages).count(". option "))
+        for page in pages:
+            self.assertLessEqual(len(page), 182)
+        self.assertTrue(pages[-1].endswith("1500. option 1500\n00. back\n"))
+
+        self.assertEqual(pages[-2], client.send("00"))
+        self.assertEqual("Hello 200\n1. back\n", client.send("1500"))
+
+    def test_static_layouts_are_cached(self):
+        first_client = self.client("first_layout")
+        second_client = self.client("second_layout")
+        with mock.patch.object(MenuScreen, 'get_pages', autospec=True,
+                               side_effect=MenuScreen.get_pages) \
+                as get_pages:
+            first_page = first_client.send("")
+            self.assertEqual(first_page, second_client.send(""))
+            second_client.send("98")
+            self.assertEqual(first_page, second_client.send("00"))
+            self.assertEqual(1, get_pages.call_count)
+
+            # session dependent screens are paginated on every request
+            self.assertEqual("Hello 200\n1. back\n", first_client.send("1"))
+            third_client = self.client("third_layout", "201")
+            third_client.send("")
+            self.assertEqual("Hello 201\n1. back\n", third_client.send("1"))
+            self.assertEqual(3, get_pages.call_count)
+
+    def test_pages_are_read_from_the_session_when_paging(self):
+        self.store.save("layouts", dict(
+            self.journey,
+            choose_option=dict(
+                self.journey["choose_option"],
+                text="Statement for {{phone_number}}"
+            )
+        ), "0.0.2")
+
+        client = self.client("statement", journey_version="0.0.2")
+
+        def dial(ussd_input):
+            with mock.patch.object(
+                    MenuScreen, 'get_pages', autospec=True,
+                    side_effect=MenuScreen.get_pages) as get_pages, \
+                    mock.patch.object(
+                        UssdHandlerAbstract, 'render_text',
+                        side_effect=UssdHandlerAbstract.render_text) \
+                    as render_text:
+                response = client.send(ussd_input)
+            return response, get_pages.call_count, render_text.call_count
+
+        first_page, get_pages, _ = dial("")
+        self.assertTrue(first_page.startswith("Statement for 200\n"))
+        self.assertEqual(1, get_pages)
+
+        pages = [first_page]
+        rendered = []
+        for _ in range(10):
+            page, get_pages, render_text = dial("98")
+            pages.append(page)
+            rendered.append(render_text)
+            # only the page asked for is rendered, from where it starts
+            self.assertEqual(0, get_pages)
+        self.assertEqual(10, len(set(pages[1:])))
+        # the work per page doesn't grow with the page number
+        self.assertEqual(1, len(set(rendered)))
+
+        self.assertEqual((pages[-2], 0, rendered[0]), dial("00"))
+        self.assertEqual((pages[-1], 0, rendered[0]), dial("98"))
+
+
+
+class TestLazyItems(TestCase):
+
+    journey = {
+        "initial_screen": "choose_account",
+        "choose_account": {
+            "type": "menu_screen",
+            "text": "Choose an account",
+            "items": {
+                "text": "account {{item}}",
+                "value": "{{item}}",
+                "session_key": "account",
+                "next_screen": "show_account",
+                "with_items": "{{range(1, 1001)|list}}"
+            }
+        },
+        "show_account": {"type": "quit_screen", "text": "You chose {{account}}"}
+    }
+
+    def setUp(self):
+        self.store = DummyStore(user="lazy_items")
+        self.store.delete("lazy_items")
+        self.store.save("lazy_items", self.journey, "0.0.1")
+        self.session_store = DictStore()
+        self.client = UssdTestClient("lazy_items", "200", extra_payload=dict(
+            journey_name="lazy_items", journey_version="0.0.1",
+            journey_store=self.store,
+            session_store_backend=self.session_store
+        ))
+
+    def dial(self, ussd_input):
+        with mock.patch.object(UssdHandlerAbstract, 'render_text',
+                               side_effect=UssdHandlerAbstract.render_text) \
+                as render_text:
+            response = self.client.send(ussd_input)
+        items_rendered = [call for call in render_text.call_args_list
+                          if call[0][1] == "account {{item}}"]
+        return response, len(items_rendered)
+
+    def test_only_displayed_items_are_rendered(self):
+        first_page, rendered = self.dial("")
+        self.assertTrue(first_page.startswith(
+            "Choose an account\n1. account 1\n2. account 2\n"))
+        self.assertTrue(first_page.endswith("98. more\n"))
+        # the items on the page and the ones looked at to fill it
+        self.assertLessEqual(rendered, first_page.count(". account ") + 2)
+        # where the first page and the next one start
+        self.assertEqual([[None, 0, False], ["", 11, True]],
+                         self.saved_pages()['starts'])
+
+        second_page, rendered = self.dial("98")
+        self.assertTrue(second_page.startswith("12. account 12\n"))
+        self.assertTrue(second_page.endswith("00. back\n98. more\n"))
+        self.assertLessEqual(rendered, second_page.count(". account ") + 2)
+        self.assertEqual(3, len(self.saved_pages()['starts']))
+
+        # going back renders the page again, from where it starts
+        page, rendered = self.dial("00")
+        self.assertEqual(first_page, page)
+        self.assertLessEqual(rendered, first_page.count(". account ") + 2)
+        self.assertEqual(2, len(self.saved_pages()['starts']))
+        self.assertEqual(second_page, self.dial("98")[0])
+
+        self.assertEqual(("You chose 500", 1), self.dial("500"))
+
+    def test_displayed_item_values_are_kept_in_the_session(self):
+        self.dial("")
+        saved_items = self.session_store_items()
+        self.assertEqual("choose_account", saved_items['screen'])
+        self.assertEqual(1000, saved_items['count'])
+        self.assertEqual(3, saved_items['values']['3'])
+
+        with mock.patch.object(MenuScreen, 'loop_items',
+                               new_callable=mock.PropertyMock) as loop_items:
+            self.assertEqual(("You chose 3", 0), self.dial("3"))
+        loop_items.assert_not_called()
+
+    def session_store_items(self):
+        return SessionStore("lazy_items", self.session_store)[
+            '_ussd_state']['items']
+
+    def saved_pages(self):
+        return SessionStore("lazy_items", self.session_store)[
+            '_ussd_state']['pages']
+
+
+class TestPaginateOptions(TestCase):
+
+    def test_pages_are_the_screens_pages(self):
+        screen = MenuScreen(
+            UssdRequest("paginate", "200", "", "en", journey_name="paginate",
+                        session_store_backend=DictStore()),
+            "choose_option",
+            {
+                "type": "menu_screen",
+                "text": "Choose an option",
+                "options": [{"text": "option {0}".format(i),
+                             "next_screen": "choose_option"}
+                            for i in range(1, 41)]
+            },
+            {"type": "initial_screen", "default_language": "en"}
+        )
+        pages = screen.paginate_options(
+            "Choose an option\n", [], screen.options)
+        self.assertGreater(len(pages), 1)
+        self.assertEqual(list(screen.pages), pages)
+
+
+class TestTextLength(TestCase):
+
+    def test_gsm7_texts(self):
+        self.assertEqual(11, gsm.text_length("Habari yako"))
+        # extension table characters take two
+        self.assertEqual(8, gsm.text_length("€ [1]"))
+        self.assertEqual(5, gsm.text_length("€ [1]", 'chars'))
+
+    def test_ucs2_texts(self):
+        self.assertEqual(182, gsm.text_length("ñ" * 79 + "ŵ"))
+        # emoji are two UTF-16 code units
+        self.assertEqual(3 * 182 / 80, gsm.text_length("a\U0001F600"))
+
+    def test_pages_fit_in_the_encoding(self):
+        store = DummyStore(user="text_length")
+        store.delete("emoji")
+        store.save("emoji", {
+            "initial_screen": "choose_fruit",
+            "choose_fruit": {
+                "type": "menu_screen",
+                "text": "Chagua tunda \U0001F34E",
+                "options": [
+                    {"text": "tunda {0}".format(i), "next_screen": "choose_fruit"}
+                    for i in range(1, 21)
+                ]
+            }
+        }, "0.0.1")
+        client = UssdTestClient("emoji", "200", extra_payload=dict(
+            journey_name="emoji", journey_version="0.0.1",
+            journey_store=store, session_store_backend=DictStore()
+        ))
+
+        pages = [client.send("")]
+        while pages[-1].endswith("98. more\n"):
+            pages.append(client.send("98"))
+
+        self.assertEqual(20, "".join(pages).count(". tunda "))
+        # only the first page has the emoji
+        self.assertLessEqual(len(pages[0].encode('utf-16-le')) // 2, 80)
+        self.assertGreater(len(pages[0]), 70)
+        for page in pages[1:]:
+            self.assertLessEqual(len(page), 182)
+        self.assertEqual(3, len(pages))
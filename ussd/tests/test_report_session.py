@@ -1,9 +1,11 @@
+import tempfile
 from unittest import mock
 from uuid import uuid4
 
 from celery.exceptions import MaxRetriesExceededError
 
 from ussd.tasks import report_session
+from ussd.interaction_log import FileInteractionLog, configure_interaction_log
 from ussd.tests import UssdTestCase
 from ussd.tests.utils import MockResponse
 from celery import current_app
@@ -208,6 +210,46 @@ class TestingUssdReportSession(UssdTestCase.BaseUssdTestCase):
             )
         )
 
+    @mock.patch('ussd.core.requests.request')
+    def test_full_history_is_read_from_interaction_log(self, mock_request):
+        mock_request.return_value = MockResponse({"balance": 250})
+        log = FileInteractionLog(tempfile.mkdtemp())
+        configure_interaction_log(log)
+        self.addCleanup(configure_interaction_log, None)
+
+        interactions = [dict(screen_name="screen_{}".format(i))
+                        for i in range(3)]
+
+        session = self.ussd_session(str(uuid4()))
+        session['session_id'] = session.session_key
+        # the first two were completed and logged, the session only keeps
+        # the last two
+        for position, interaction in enumerate(interactions[:2]):
+            log.append(session.session_key, position, interaction)
+        session['ussd_interaction'] = interactions[1:]
+        session['_ussd_state'] = dict(interaction_count=3)
+        session.save()
+
+        report_session.delay(session.session_key, {
+            "ussd_report_session": {
+                "session_key": "reported",
+                "validate_response": [
+                    {"expression": "{{reported.status_code}} == 200"}
+                ],
+                "request_conf": {
+                    "url": "localhost:8006/api",
+                    "method": "post",
+                    "data": {"ussd_interaction": "{{ussd_interaction}}"}
+                }
+            }
+        })
+
+        mock_request.assert_called_once_with(
+            url="localhost:8006/api",
+            method="post",
+            data=dict(ussd_interaction=interactions)
+        )
+
     @mock.patch("ussd.tasks.requests.request")
     def test_if_session_is_already_posted_wont_post_again(self, mock_request):
         mock_response = MockResponse({"balance": 250})
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from ussd.session_lock import FileSessionLock, LocalSessionLock, \
+    SessionLockTimeout
+
+
+class SessionLockTest(object):
+    class SessionLockTestsMixin(TestCase):
+
+        def session_lock(self, timeout):
+            raise NotImplementedError
+
+        def test_lock(self):
+            session_lock = self.session_lock(timeout=0.05)
+            with session_lock.lock("session_one"):
+                self.assertRaises(SessionLockTimeout, session_lock.acquire,
+                                  "session_one")
+            session_lock.release(session_lock.acquire("session_one"))
+
+        def test_waiting_requests_get_the_lock_once_it_is_released(self):
+            session_lock = self.session_lock(timeout=5)
+            handle = session_lock.acquire("session_one")
+            acquired = threading.Event()
+
+            def request():
+                with session_lock.lock("session_one"):
+                    acquired.set()
+
+            thread = threading.Thread(target=request)
+            thread.start()
+            self.assertFalse(acquired.wait(0.05))
+            session_lock.release(handle)
+            self.assertTrue(acquired.wait(5))
+            thread.join()
+
+
+class TestLocalSessionLock(SessionLockTest.SessionLockTestsMixin):
+
+    def session_lock(self, timeout):
+        return LocalSessionLock(timeout=timeout)
+
+
+class TestFileSessionLock(SessionLockTest.SessionLockTestsMixin):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def session_lock(self, timeout):
+        return FileSessionLock(self.directory, timeout=timeout, stripes=16)
+
+    def test_lock_files_are_striped(self):
+        session_lock = self.session_lock(timeout=1)
+        for i in range(100):
+            with session_lock.lock("session{0}".format(i)):
+                pass
+        self.assertLessEqual(len(os.listdir(self.directory)), 16)
@@ -1,10 +1,20 @@
-from unittest import TestCase
+import base64
+from unittest import TestCase, skipUnless, mock
 from simplekv.fs import FilesystemStore
-from ussd.session_store import SessionStore, SESSION_COOKIE_AGE
+from simplekv.memory import DictStore
+from ussd.session_store import SessionStore, SESSION_COOKIE_AGE, \
+    JSONSerializer, CompactJSONSerializer, MsgpackSerializer, \
+    FieldSessionStore, compression_stats
+from ussd.store.session_store.MemoryStore import MemoryStore
 from datetime import datetime, timedelta
 from freezegun import freeze_time
 import uuid
 
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
 
 class SessionTest(object):
     class SessionTestsMixin(TestCase):
@@ -285,3 +295,386 @@ class TestWithFileObject(SessionTest.SessionTestsMixin):
 
     def backend(self, session_key=None):
         return SessionStore(session_key, FilesystemStore("./session_data_test"))
+
+
+class TestWithFieldSessionStore(SessionTest.SessionTestsMixin):
+    kv_store = DictStore()
+
+    def backend(self, session_key=None):
+        # every value in its own record
+        return FieldSessionStore(session_key, self.kv_store, inline_size=0)
+
+
+class TestWithMemoryStore(SessionTest.SessionTestsMixin):
+    kv_store = MemoryStore(eviction_interval=None)
+
+    def backend(self, session_key=None):
+        return SessionStore(session_key, self.kv_store)
+
+    def test_session_expiry_is_the_record_ttl(self):
+        self.session['cat'] = 'dog'
+        self.session.set_expiry(120)
+        with mock.patch.object(self.kv_store, "put",
+                               wraps=self.kv_store.put) as put:
+            self.session.save()
+        self.assertIn(put.call_args[1]['ttl_secs'], (119, 120))
+
+    def test_expired_session_is_removed(self):
+        timer = mock.Mock(return_value=0)
+        kv_store = MemoryStore(eviction_interval=None, timer=timer)
+        session = SessionStore("expiring_session", kv_store)
+        session['cat'] = 'dog'
+        session.set_expiry(60)
+        session.save()
+
+        self.assertEqual('dog', SessionStore("expiring_session",
+                                             kv_store)['cat'])
+        timer.return_value = 61
+        self.assertNotIn('cat', SessionStore("expiring_session", kv_store))
+
+
+class TestFieldSessionStoreWithMemoryStore(SessionTest.SessionTestsMixin):
+    kv_store = MemoryStore(eviction_interval=None)
+
+    def backend(self, session_key=None):
+        return FieldSessionStore(session_key, self.kv_store, inline_size=0)
+
+    def test_fields_outlive_the_session(self):
+        with freeze_time("2018-01-01 00:00:00"):
+            self.session['response'] = {"body": "x" * 100}
+            self.session.set_expiry(60)
+            with mock.patch.object(self.kv_store, "put",
+                                   wraps=self.kv_store.put) as put:
+                self.session.save()
+        ttls = {args[0]: kwargs['ttl_secs']
+                for args, kwargs in put.call_args_list}
+        self.assertEqual(60, ttls[self.session.session_key])
+        self.assertEqual(120, ttls[FieldSessionStore.field_key(
+            self.session.session_key, 'response')])
+
+    def test_unchanged_fields_are_refreshed_every_other_expiry(self):
+        response_key = FieldSessionStore.field_key("refreshed", 'response')
+
+        def save_request(now):
+            with freeze_time(now):
+                session = FieldSessionStore("refreshed", self.kv_store,
+                                            inline_size=0)
+                if 'response' not in session:
+                    session['response'] = {"body": "x" * 100}
+                # sessions that didn't change aren't written at all
+                session['last_request'] = now
+                session.set_expiry(60)
+                with mock.patch.object(self.kv_store, "put",
+                                       wraps=self.kv_store.put) as put:
+                    session.save()
+                return [args[0] for args, _ in put.call_args_list]
+
+        self.assertIn(response_key, save_request("2018-01-01 00:00:00"))
+        self.assertNotIn(response_key, save_request("2018-01-01 00:00:30"))
+        self.assertIn(response_key, save_request("2018-01-01 00:01:01"))
+        FieldSessionStore("refreshed", self.kv_store).delete()
+
+
+class TestFieldSessionStore(TestCase):
+
+    def setUp(self):
+        self.kv_store = DictStore()
+        session = FieldSessionStore("field_session", self.kv_store,
+                                    inline_size=60)
+        session.update({"name": "mwas", "response": {"body": "x" * 100},
+                        "state": {"page": 1}})
+        session.save()
+
+    def session(self):
+        return FieldSessionStore("field_session", self.kv_store,
+                                 inline_size=60)
+
+    def test_big_fields_are_read_when_used(self):
+        response_key = FieldSessionStore.field_key("field_session", "response")
+        self.assertIn(response_key, self.kv_store.keys())
+
+        session = self.session()
+        with mock.patch.object(self.kv_store, "get",
+                               wraps=self.kv_store.get) as get:
+            self.assertEqual("mwas", session["name"])
+            self.assertEqual({"page": 1}, session["state"])
+            self.assertIn("response", session)
+            get.assert_called_once_with("field_session")
+
+            self.assertEqual({"body": "x" * 100}, session["response"])
+            get.assert_called_with(response_key)
+
+    def test_only_changed_fields_are_written(self):
+        session = self.session()
+        session["state"]["page"] = 2
+        with mock.patch.object(self.kv_store, "put",
+                               wraps=self.kv_store.put) as put:
+            session.save()
+        # small values live in the index, the response was not touched
+        self.assertEqual(["field_session"], [i[0][0] for i in put.call_args_list])
+
+        session = self.session()
+        session["response"] = {"body": "y" * 100}
+        with mock.patch.object(self.kv_store, "put",
+                               wraps=self.kv_store.put) as put:
+            session.save()
+        self.assertEqual(
+            [FieldSessionStore.field_key("field_session", "response")],
+            [i[0][0] for i in put.call_args_list])
+
+        session = self.session()
+        self.assertEqual({"page": 2}, session["state"])
+        self.assertEqual({"body": "y" * 100}, session["response"])
+
+    def test_deleted_and_shrunk_fields_are_removed(self):
+        session = self.session()
+        session["response"] = "small"
+        session.save()
+
+        self.assertEqual(["field_session"], list(self.kv_store.keys()))
+        self.assertEqual("small", self.session()["response"])
+
+        session = self.session()
+        session.delete()
+        self.assertEqual([], list(self.kv_store.keys()))
+
+    def test_reading_sessions_saved_by_session_store(self):
+        session = SessionStore("plain_session", self.kv_store)
+        session["name"] = "mwas"
+        session.save()
+
+        session = FieldSessionStore("plain_session", self.kv_store)
+        self.assertEqual("mwas", session["name"])
+        session.save()
+        self.assertEqual({"name", "_session_expiry"},
+                         set(session.decode(
+                             self.kv_store.get("plain_session"))["inline"]))
+
+
+class TestSerializers(TestCase):
+
+    data = {
+        "name": "mwas",
+        "amount": 10.5,
+        "items": [1, "two", None, True],
+        "nested": {"when": datetime(2020, 1, 2, 3, 4, 5, 6)},
+        "_session_expiry": datetime(2020, 1, 2, 3, 4, 5, 6),
+    }
+
+    def session(self, serializer=None, kv_store=None):
+        return SessionStore("serializer_test", kv_store or DictStore(),
+                            serializer=serializer)
+
+    def test_the_original_format_is_the_default(self):
+        self.assertEqual(
+            base64.b64encode(JSONSerializer().dumps(self.data)),
+            self.session().encode(self.data))
+
+    def test_compact_json(self):
+        encoded = self.session(CompactJSONSerializer).encode(self.data)
+        self.assertEqual(b'\x00j', encoded[:2])
+        self.assertEqual(self.data, self.session().decode(encoded))
+
+    def test_compact_json_keeps_dicts_that_look_like_datetimes(self):
+        data = {
+            "a": {"$datetime": "not a date"},
+            "b": [{"$$datetime": 1}, {"$other": {"$x": 2}}],
+            "c": {"$datetime": "x", "d": datetime(2020, 1, 2)},
+            "when": datetime(2020, 1, 2, 3, 4, 5, 6),
+        }
+        serializer = CompactJSONSerializer()
+        self.assertEqual(data, serializer.loads(serializer.dumps(data)))
+
+    def test_legacy_sessions_are_still_loaded(self):
+        kv_store = DictStore()
+        legacy = self.session(JSONSerializer, kv_store)
+        legacy.update({"name": "mwas"})
+        legacy.save()
+        # original format, base64 json without a header
+        self.assertEqual(
+            legacy.key_pair(),
+            JSONSerializer().loads(base64.b64decode(kv_store.get(legacy.session_key)))
+        )
+
+        session = self.session(CompactJSONSerializer, kv_store)
+        self.assertEqual("mwas", session["name"])
+        self.assertIsInstance(session["_session_expiry"], datetime)
+
+        # and it's written back in the new format
+        session.save()
+        self.assertEqual(b'\x00j', kv_store.get(session.session_key)[:2])
+
+    def test_sessions_are_read_with_the_serializer_that_wrote_them(self):
+        encoded = self.session(CompactJSONSerializer).encode(self.data)
+        self.assertEqual(self.data,
+                         self.session("ussd.session_store.JSONSerializer").decode(encoded))
+
+    def test_dumps_items(self):
+        serializers = [JSONSerializer(), CompactJSONSerializer()]
+        if msgpack:
+            serializers.append(MsgpackSerializer())
+        for serializer in serializers:
+            for data in ({"name": "mwas", "items": [1, {"a": 2}]},
+                         {"$datetime": "x"}):
+                serialized = serializer.dumps_items(
+                    [(key, serializer.dumps(value))
+                     for key, value in data.items()])
+                self.assertEqual(serializer.loads(serializer.dumps(data)),
+                                 serializer.loads(serialized))
+
+    @skipUnless(msgpack, "msgpack is not installed")
+    def test_msgpack(self):
+        encoded = self.session(MsgpackSerializer).encode(self.data)
+        self.assertEqual(b'\x00m', encoded[:2])
+        self.assertEqual(self.data, self.session().decode(encoded))
+
+
+class TestCompression(TestCase):
+    big = {"response": {"body": "balance " * 500}}
+
+    def setUp(self):
+        self.kv_store = DictStore()
+        compression_stats.reset()
+
+    def session(self, compression='zlib', serializer=CompactJSONSerializer,
+                **kwargs):
+        kwargs.setdefault('compression_threshold', 1024)
+        return SessionStore("compressed_session", self.kv_store,
+                            compression=compression, serializer=serializer,
+                            **kwargs)
+
+    def save(self, data, **kwargs):
+        session = self.session(**kwargs)
+        session.update(data)
+        session.save()
+        return self.kv_store.get("compressed_session")
+
+    def test_small_sessions_are_not_compressed(self):
+        self.assertEqual(b'\x00j', self.save({"name": "mwas"})[:2])
+        self.assertEqual(1, compression_stats.stats()["skipped"])
+        self.assertIsNone(compression_stats.ratio)
+
+    def test_big_sessions_are_compressed(self):
+        saved = self.save(self.big)
+        self.assertEqual(b'\x01z', saved[:2])
+        self.assertEqual(self.big["response"],
+                         self.session(compression='')["response"])
+
+        stats = compression_stats.stats()
+        self.assertEqual(1, stats["compressed"])
+        self.assertEqual(len(saved), stats["compressed_bytes"])
+        self.assertLess(stats["ratio"], 0.1)
+
+    def test_lzma(self):
+        self.assertEqual(b'\x01x', self.save(self.big, compression='lzma')[:2])
+        self.assertEqual(self.big["response"], self.session()["response"])
+
+    def test_data_that_does_not_get_smaller_is_not_compressed(self):
+        session = self.session(compression_threshold=0)
+        self.assertEqual(b'\x00j', session.encode({"a": 1})[:2])
+        self.assertEqual(1, compression_stats.stats()["skipped"])
+
+    def test_legacy_format_is_not_compressed(self):
+        saved = self.save(self.big, serializer=JSONSerializer)
+        self.assertEqual(self.big["response"], JSONSerializer().loads(
+            base64.b64decode(saved))["response"])
+
+    def test_field_records_are_compressed(self):
+        session = FieldSessionStore("compressed_session", self.kv_store,
+                                    compression='zlib',
+                                    compression_threshold=1024)
+        session.update(self.big)
+        session.save()
+        field_key = FieldSessionStore.field_key("compressed_session",
+                                                "response")
+        self.assertEqual(b'\x01z', self.kv_store.get(field_key)[:2])
+
+        session = FieldSessionStore("compressed_session", self.kv_store)
+        self.assertEqual(self.big["response"], session["response"])
+        self.assertEqual(set(), session.get_changed_keys())
+
+
+class TestDirtyTracking(TestCase):
+
+    def setUp(self):
+        self.kv_store = DictStore()
+        session = SessionStore("dirty_tracking", self.kv_store)
+        session.update({"name": "mwas", "state": {"page": 1}, "age": 10})
+        session.save()
+        self.session = SessionStore("dirty_tracking", self.kv_store)
+
+    def save(self):
+        with mock.patch.object(self.session, "_save_changes",
+                               wraps=self.session._save_changes) as save_changes:
+            self.session.save()
+        return save_changes
+
+    def test_unchanged_session_is_not_written(self):
+        self.session["name"] = "mwas"
+        self.session.update({"age": 10})
+        self.session.get("state")["page"] = 1
+        self.assertFalse(self.save().called)
+
+    def test_only_changed_keys_are_reported(self):
+        self.session["name"] = "mwas"
+        self.session["age"] = 11
+        # nested changes are picked up too
+        self.session["state"]["page"] = 2
+        del self.session["name"]
+        self.session["new"] = True
+
+        save_changes = self.save()
+        save_changes.assert_called_once_with(
+            self.session.key_pair(), {"age", "state", "new"}, {"name"}, False)
+
+        self.assertEqual(
+            {"age": 11, "state": {"page": 2}, "new": True},
+            {key: value for key, value in
+             SessionStore("dirty_tracking", self.kv_store).items()
+             if key != "_session_expiry"}
+        )
+
+        # saved changes are clean
+        self.assertFalse(self.save().called)
+
+    def test_values_are_serialized_once_and_only_when_needed(self):
+        serializer = self.session.serializer
+        with mock.patch.object(serializer, "dumps",
+                               wraps=serializer.dumps) as dumps:
+            self.assertEqual(10, self.session["age"])
+            # values that aren't read aren't fingerprinted
+            self.assertFalse(dumps.called)
+            state = self.session["state"]
+            self.assertEqual([mock.call({"page": 1})], dumps.call_args_list)
+
+            state["page"] = 2
+            dumps.reset_mock()
+            self.session.save()
+            # every value once, the one compared is the one written
+            self.assertEqual(len(self.session.keys()), dumps.call_count)
+            self.assertNotIn(mock.call(self.session.key_pair()),
+                             dumps.call_args_list)
+
+        # values held on to are still tracked after a save
+        state["page"] = 3
+        self.assertTrue(self.save().called)
+        self.assertEqual(
+            {"page": 3},
+            SessionStore("dirty_tracking", self.kv_store)["state"])
+
+    def test_setting_the_same_expiry_is_not_a_change(self):
+        self.session.set_expiry(60)
+        self.assertTrue(self.save().called)
+
+        self.session = SessionStore("dirty_tracking", self.kv_store)
+        self.session.set_expiry(60)
+        self.assertFalse(self.save().called)
+        self.session.set_expiry(120)
+        self.assertTrue(self.save().called)
+
+    def test_new_and_cleared_sessions_are_written_in_full(self):
+        self.session.clear()
+        self.assertTrue(self.save().call_args[0][3])
+
+        self.session = SessionStore("new_session", self.kv_store)
+        self.assertTrue(self.save().call_args[0][3])
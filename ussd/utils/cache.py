@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Bounded, thread safe, least recently used cache.
+
+    ``hits``, ``misses`` and ``evictions`` are exposed to help size it.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self._entries),
+            maxsize=self.maxsize
+        )
+
+
+class TTLCache(LRUCache):
+    """
+    :class:`LRUCache` whose entries expire ``ttl`` seconds after they were
+    set. A ``ttl`` of ``None`` keeps entries until they are evicted.
+    """
+
+    def __init__(self, maxsize, ttl=None, timer=time.monotonic):
+        super(TTLCache, self).__init__(maxsize)
+        self.ttl = ttl
+        self.timer = timer
+
+    def get(self, key, default=None):
+        entry = super(TTLCache, self).get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= self.timer():
+            with self._lock:
+                # count it as a miss, it has to be fetched again.
+                self.hits -= 1
+                self.misses += 1
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            return default
+        return value
+
+    def set(self, key, value):
+        expires_at = None if self.ttl is None else self.timer() + self.ttl
+        super(TTLCache, self).set(key, (value, expires_at))
+
+    def pop(self, key, default=None):
+        entry = super(TTLCache, self).pop(key)
+        return default if entry is None else entry[0]
@@ -0,0 +1,47 @@
+"""
+Length of ussd texts the way the network counts it.
+
+A ussd message carries 160 octets. Texts made only of GSM 03.38 characters
+are sent in GSM-7, 182 characters, with the characters of the extension
+table taking two. Any other character, e.g emoji, switches the whole
+message to UCS-2 where only 80 characters (UTF-16 code units) fit.
+
+Lengths are given in GSM-7 characters so they can be compared with
+``ussd_text_limit`` whatever the encoding of the text.
+"""
+GSM7_BASIC = frozenset(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+GSM7_EXTENSION = frozenset("^{}\\[~]|€\f")
+
+GSM7_MESSAGE_LENGTH = 182
+UCS2_MESSAGE_LENGTH = 80
+
+ENCODINGS = ('gsm7', 'chars')
+
+
+def is_gsm7(text: str) -> bool:
+    return all(c in GSM7_BASIC or c in GSM7_EXTENSION for c in text)
+
+
+def text_length(text: str, encoding='gsm7'):
+    """
+    ``gsm7`` measures the text in the encoding it will be sent in,
+    ``chars`` counts python characters.
+    """
+    if encoding == 'chars':
+        return len(text)
+    if encoding != 'gsm7':
+        raise ValueError("unknown ussd text encoding {0}".format(encoding))
+    length = 0
+    for c in text:
+        if c in GSM7_BASIC:
+            length += 1
+        elif c in GSM7_EXTENSION:
+            length += 2
+        else:
+            # UCS-2, every character costs the same
+            units = len(text.encode('utf-16-le')) // 2
+            return units * GSM7_MESSAGE_LENGTH / UCS2_MESSAGE_LENGTH
+    return length